@@ -193,6 +193,7 @@ class Answerfile:
         results = {};
 
         results.update(self.parseSource())
+        results['resume-install'] = getBoolAttribute(self.top_node, ['resume'], default=False)
 
         nodes = getElementsByTagName(self.top_node, ['bootloader'])
         if len(nodes) > 0:
@@ -6,7 +6,11 @@ import stat
 import subprocess
 import datetime
 import re
+import sys
+import json
 import tempfile
+import threading
+import concurrent.futures
 
 import repository
 import generalui
@@ -51,11 +55,14 @@ class Task:
     'returns' is a list of the labels of the return values, or a function
            that, when given the 'args' labels list, returns the list of the
            labels of the return values.
+    'parallel' marks a task that may run concurrently with the adjacent
+           tasks that are also marked, subject to the dependencies implied
+           by the labels they read and write.
     """
 
     def __init__(self, fn, args, returns, args_sensitive=False,
                  progress_scale=1, pass_progress_callback=False,
-                 progress_text=None):
+                 progress_text=None, parallel=False):
         self.fn = fn
         self.args = args
         self.returns = returns
@@ -63,6 +70,21 @@ class Task:
         self.progress_scale = progress_scale
         self.pass_progress_callback = pass_progress_callback
         self.progress_text = progress_text
+        self.parallel = parallel
+        self.usage = None
+
+    def name(self):
+        return getattr(self.fn, '__qualname__', str(self.fn))
+
+    def reads(self):
+        """ The labels read when the task runs, or None if unknown. """
+        return getattr(self.args, 'labels', None)
+
+    def writes(self):
+        """ The labels written by the task, or None if unknown. """
+        if callable(self.returns):
+            return None
+        return self.returns
 
     def execute(self, answers, progress_callback=lambda x: ()):
         args = self.args(answers)
@@ -76,7 +98,13 @@ class Task:
         if self.pass_progress_callback:
             args.insert(0, progress_callback)
 
-        rv = self.fn(*args)
+        before = util.ResourceSample()
+        try:
+            rv = self.fn(*args)
+        finally:
+            self.usage = util.ResourceSample().since(before)
+            self.usage['start'] = before.time
+            logger.log("TASK: %s took %.1fs" % (self.name(), self.usage['wall']))
         if type(rv) is not tuple:
             rv = (rv,)
         myrv = {}
@@ -97,8 +125,17 @@ class Task:
 #    the labels when the function is called (late-binding)
 # As: As above but evaluated immediately (early-binding)
 # Use A when you require state values as well as the initial input values
-A = lambda ans, *params: ( lambda a: [a.get(param) for param in params] )
-As = lambda ans, *params: ( lambda _: [ans.get(param) for param in params] )
+# Both record the labels read at execution time so that the dependencies
+# between tasks can be worked out.
+def A(ans, *params):
+    fn = lambda a: [a.get(param) for param in params]
+    fn.labels = params
+    return fn
+
+def As(ans, *params):
+    fn = lambda _: [ans.get(param) for param in params]
+    fn.labels = ()
+    return fn
 
 def getPrepSequence(ans, interactive):
     seq = [
@@ -157,7 +194,7 @@ def getPrepSequence(ans, interactive):
 
 def getMainRepoSequence(ans, repos):
     seq = []
-    seq.append(Task(repository.installFromRepos, lambda a: [repos] + [a.get('mounts')], [],
+    seq.append(Task(repository.installFromRepos, lambda a: [repos] + [a.get('mounts'), a.get('deferred-verification', False)], [],
                 progress_scale=100,
                 pass_progress_callback=True,
                 progress_text="Installing %s..." % (", ".join([repo.name() for repo in repos]))))
@@ -169,7 +206,7 @@ def getMainRepoSequence(ans, repos):
 def getRepoSequence(ans, repos):
     seq = []
     for repo in repos:
-        seq.append(Task(repo.installPackages, A(ans, 'mounts'), [],
+        seq.append(Task(repo.installPackages, lambda a: [a.get('mounts'), a.get('deferred-verification', False)], [],
                      progress_scale=100,
                      pass_progress_callback=True,
                      progress_text="Installing %s..." % repo.name()))
@@ -180,9 +217,9 @@ def getRepoSequence(ans, repos):
 def getFinalisationSequence(ans):
     seq = [
         Task(scripts.run_scripts, lambda a: ['packages-installed',  a['mounts']['root']], []),
-        Task(writeResolvConf, A(ans, 'mounts', 'manual-hostname', 'manual-nameservers'), []),
-        Task(writeMachineID, A(ans, 'mounts'), []),
-        Task(writeKeyboardConfiguration, A(ans, 'mounts', 'keymap'), []),
+        Task(writeResolvConf, A(ans, 'mounts', 'manual-hostname', 'manual-nameservers'), [], parallel=True),
+        Task(writeMachineID, A(ans, 'mounts'), [], parallel=True),
+        Task(writeKeyboardConfiguration, A(ans, 'mounts', 'keymap'), [], parallel=True),
         Task(configureNetworking, A(ans, 'mounts', 'net-admin-interface', 'net-admin-bridge', 'net-admin-configuration', 'manual-hostname', 'manual-nameservers', 'network-hardware', 'preserve-settings', 'network-backend'), []),
         Task(prepareSwapfile, A(ans, 'mounts', 'primary-disk', 'swap-partnum', 'disk-label-suffix'), []),
         Task(writeFstab, A(ans, 'mounts', 'primary-disk', 'logs-partnum', 'swap-partnum', 'disk-label-suffix', 'fs-type'), []),
@@ -195,8 +232,12 @@ def getFinalisationSequence(ans):
                                'branding', 'net-admin-configuration', 'host-config', 'install-type'), []),
         Task(writeXencommons, A(ans, 'control-domain-uuid', 'mounts'), []),
         Task(configureISCSI, A(ans, 'mounts', 'primary-disk'), []),
-        Task(mkinitrd, A(ans, 'mounts', 'primary-disk', 'primary-partnum'), []),
-        Task(prepFallback, A(ans, 'mounts', 'primary-disk', 'primary-partnum'), []),
+        Task(configureDracut, A(ans, 'mounts', 'primary-disk', 'primary-partnum'), []),
+        # The dracut runs only read the configuration written above so they
+        # can overlap with each other.  Task dependencies only cover answers,
+        # so tasks which write to the chroot's /etc or /boot stay serial.
+        Task(mkinitrd, A(ans, 'mounts', 'primary-disk', 'primary-partnum'), [], parallel=True),
+        Task(prepFallback, A(ans, 'mounts', 'primary-disk', 'primary-partnum'), [], parallel=True),
         Task(installBootLoader, A(ans, 'mounts', 'primary-disk', 'primary-partnum',
                                   'disk-label-suffix', 'bootloader-location',
                                   'serial-console', 'boot-serial', 'host-config',), []),
@@ -234,6 +275,7 @@ def getFinalisationSequence(ans):
     # run the users's scripts
     seq.append( Task(scripts.run_scripts, lambda a: ['filesystem-populated',  a['mounts']['root']], []) )
 
+    seq.append(Task(removeCheckpoint, A(ans, 'mounts'), ['resumable']))
     seq.append(Task(umountVolumes, A(ans, 'primary-disk', 'mounts', 'cleanup'), ['cleanup']))
     seq.append(Task(writeLog, A(ans, 'primary-disk', 'primary-partnum', 'logs-partnum', 'swraid'), []))
 
@@ -249,7 +291,103 @@ def prettyLogAnswers(answers):
             val = answers[a]
         logger.log("%s := %s %s" % (a, val, type(val)))
 
-def executeSequence(sequence, seq_name, answers, ui, cleanup):
+def groupSequence(sequence):
+    """ Split sequence into lists of tasks to be run together: each run of
+    adjacent parallel tasks forms one group, any other task is alone. """
+    groups = []
+    for task in sequence:
+        if task.parallel and groups and groups[-1][-1].parallel:
+            groups[-1].append(task)
+        else:
+            groups.append([task])
+    return groups
+
+def taskDependencies(group):
+    """ For each task in group, return the set of indices of the earlier
+    tasks that must complete before it can start.  A task must wait for
+    the tasks that write a label it reads or writes, and for the tasks
+    that read a label it writes.  Tasks whose labels are unknown are
+    ordered against everything else in the group. """
+    deps = []
+    for i, task in enumerate(group):
+        reads, writes = task.reads(), task.writes()
+        after = set()
+        for j in range(i):
+            other_reads, other_writes = group[j].reads(), group[j].writes()
+            if None in (reads, writes, other_reads, other_writes) or \
+               set(writes) & (set(other_reads) | set(other_writes)) or \
+               set(reads) & set(other_writes):
+                after.add(j)
+        deps.append(after)
+    return deps
+
+def executeTaskGroup(group, answers, max_workers, progress):
+    """ Run the tasks in group on a pool of up to max_workers threads,
+    starting each one as soon as the tasks it depends on have completed.
+    State updates are applied as tasks complete.  If a task fails no
+    further tasks are started and, once the running ones have finished,
+    the first failure is raised. """
+    deps = taskDependencies(group)
+    done = set()
+    running = {}
+    partial = {}
+    failure = None
+
+    def taskProgress(i):
+        def callback(x):
+            partial[i] = x
+        return callback
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while True:
+            if not failure:
+                for i, task in enumerate(group):
+                    if i not in done and i not in running.values() and deps[i] <= done:
+                        running[pool.submit(task.execute, answers, taskProgress(i))] = i
+            if not running:
+                break
+
+            finished, _ = concurrent.futures.wait(running, timeout=0.5,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                i = running.pop(future)
+                partial.pop(i, None)
+                try:
+                    updated_state = future.result()
+                except BaseException:
+                    if not failure:
+                        failure = sys.exc_info()
+                    continue
+                done.add(i)
+                applyState(answers, updated_state)
+
+            progress(sum(group[i].progress_scale for i in done) + sum(partial.values()))
+
+    if failure:
+        raise failure[1].with_traceback(failure[2])
+
+def applyState(answers, updated_state):
+    if len(updated_state) > 0:
+        logger.log(
+            "DISPATCH: Updated state: %s" %
+            "; ".join(["%s -> %s" % (k, v) for k, v in updated_state.items()])
+            )
+        for state_item in updated_state:
+            answers[state_item] = updated_state[state_item]
+
+timeline = []
+
+def writeTimeline(phase):
+    """ Add the timings of a phase to the timeline kept next to the install
+    log.  Failing to do so is not fatal. """
+    timeline.append(phase)
+    try:
+        with open(constants.TIMELINE_FILE, 'w') as fh:
+            json.dump(timeline, fh, indent=1)
+    except Exception as e:
+        logger.log("Failed to write timeline: %s" % e)
+
+def executeSequence(sequence, seq_name, answers, ui, cleanup, max_workers=1, checkpoint=None):
     answers['cleanup'] = []
     answers['ui'] = ui
 
@@ -263,6 +401,8 @@ def executeSequence(sequence, seq_name, answers, ui, cleanup):
             seq_name, progress_total
             )
     logger.log("DISPATCH: NEW PHASE: %s" % seq_name)
+    phase_start = util.ResourceSample(whole_process=True)
+    outcome = 'failed'
 
     def doCleanup(actions):
         for tag, f, a in actions:
@@ -277,24 +417,34 @@ def executeSequence(sequence, seq_name, answers, ui, cleanup):
 
     try:
         current = 0
-        for item in sequence:
-            if pd:
-                if item.progress_text:
-                    text = item.progress_text
-                else:
-                    text = seq_name
-
-                ui.progress.displayProgressDialog(current, pd, updated_text=text)
-            updated_state = item.execute(answers, progressCallback)
-            if len(updated_state) > 0:
-                logger.log(
-                    "DISPATCH: Updated state: %s" %
-                    "; ".join(["%s -> %s" % (k, v) for k, v in updated_state.items()])
-                    )
-                for state_item in updated_state:
-                    answers[state_item] = updated_state[state_item]
-
-            current = current + item.progress_scale
+        completed = 0
+        for group in groupSequence(sequence):
+            if len(group) > 1 and max_workers > 1:
+                if pd:
+                    ui.progress.displayProgressDialog(current, pd, updated_text=seq_name)
+                executeTaskGroup(group, answers, max_workers, progressCallback)
+                current = current + sum(item.progress_scale for item in group)
+                completed += len(group)
+                if checkpoint:
+                    checkpoint.save(answers, completed)
+                continue
+
+            for item in group:
+                if pd:
+                    if item.progress_text:
+                        text = item.progress_text
+                    else:
+                        text = seq_name
+
+                    ui.progress.displayProgressDialog(current, pd, updated_text=text)
+                updated_state = item.execute(answers, progressCallback)
+                applyState(answers, updated_state)
+
+                current = current + item.progress_scale
+                completed += 1
+                if checkpoint:
+                    checkpoint.save(answers, completed)
+        outcome = 'completed'
     except:
         doCleanup(answers['cleanup'])
         raise
@@ -305,6 +455,265 @@ def executeSequence(sequence, seq_name, answers, ui, cleanup):
         if cleanup:
             doCleanup(answers['cleanup'])
             del answers['cleanup']
+    finally:
+        phase = util.ResourceSample(whole_process=True).since(phase_start)
+        phase.update({'phase': seq_name, 'start': phase_start.time, 'outcome': outcome,
+                      'tasks': []})
+        for group in groupSequence(sequence):
+            for item in group:
+                if item.usage:
+                    task = {'task': item.name(), 'concurrent': len(group) > 1 and max_workers > 1}
+                    task.update(item.usage)
+                    phase['tasks'].append(task)
+        writeTimeline(phase)
+
+def partitionLayout(disk):
+    tool = PartitionTool(disk)
+    return [[num, part['start'], part['size'], part['id']] for num, part in tool.items()]
+
+def repositoryIdentity(repos):
+    return sorted(list(repo.identity()) for repo in repos)
+
+class Checkpoint:
+    """ Records progress through the finalisation sequence on the root
+    filesystem of the target, so that an installation which fails late can
+    be resumed without partitioning the disk and installing the packages
+    again. """
+
+    CHECKPOINT_VERSION = 2
+
+    # answers which are only meaningful in this run or must not be written
+    # to the disk, so are taken from the answers of the run which resumes:
+    # the sources may include credentials, and the installed repositories
+    # are recorded by identity
+    VOLATILE = ['ui', 'cleanup', 'mounts', 'root-password', 'pool-token', 'installed-repos',
+                'sources', 'source-media', 'source-address', 'extra-repos']
+
+    # what a checkpoint must contain
+    FIELDS = [('layout', list), ('repositories', list), ('tasks', list),
+              ('completed', int), ('answers', dict), ('unsaved', list)]
+
+    # answers which hold objects, written as their attributes
+    OBJECTS = {'net-admin-configuration': netinterface.NetInterface,
+               'serial-console': hardware.SerialPort}
+
+    def __init__(self, answers, sequence, completed=0, repositories=None):
+        self.layout = None
+        if not answers.get('swraid'):
+            self.layout = partitionLayout(answers['primary-disk'])
+        if repositories is None:
+            repositories = repositoryIdentity(answers.get('installed-repos', {}).values())
+        self.repositories = repositories
+        self.tasks = [task.name() for task in sequence]
+        self.completed = completed
+        self.unsaved = set()
+
+    @classmethod
+    def encodeAnswer(cls, key, value):
+        """ Returns value in a form which can be written as JSON. """
+        if key in cls.OBJECTS and isinstance(value, cls.OBJECTS[key]):
+            return vars(value)
+        if key == 'upgrader':
+            # the installation it upgrades is found again on resume
+            return {'class': type(value).__name__,
+                    'state': dict((k, v) for k, v in vars(value).items() if k != 'source')}
+        return value
+
+    @classmethod
+    def decodeAnswer(cls, key, value, answers):
+        """ Reverses encodeAnswer, raising an exception if the answer can't
+        be restored. """
+        if key in cls.OBJECTS and isinstance(value, dict):
+            obj = cls.OBJECTS[key].__new__(cls.OBJECTS[key])
+            obj.__dict__.update(value)
+            return obj
+        if key == 'upgrader':
+            if 'installation-to-overwrite' not in answers:
+                raise RuntimeError("No installation to upgrade")
+            upgrader = upgrade.getUpgrader(answers['installation-to-overwrite'])
+            if type(upgrader).__name__ != value['class']:
+                raise RuntimeError("Upgrader is now %s, not %s" % (type(upgrader).__name__, value['class']))
+            upgrader.__dict__.update(value['state'])
+            return upgrader
+        return value
+
+    def save(self, answers, completed):
+        """ Record that another completed tasks of the sequence have
+        finished.  Failing to do so is not fatal. """
+        if not self.layout or not answers.get('resumable', True) or 'mounts' not in answers:
+            return
+
+        # Each answer is kept as its own JSON text so that it is only
+        # serialised once.  Those which can't be are listed, so that resuming
+        # can check they are available from the new run.
+        state = {}
+        unsaved = set()
+        for key, value in answers.items():
+            if key in self.VOLATILE:
+                continue
+            try:
+                state[key] = json.dumps(self.encodeAnswer(key, value))
+            except (TypeError, ValueError) as e:
+                if key not in self.unsaved:
+                    logger.log("CHECKPOINT: Not saving %s: %s" % (key, e))
+                    self.unsaved.add(key)
+                unsaved.add(key)
+
+        data = {'version': self.CHECKPOINT_VERSION,
+                'layout': self.layout,
+                'repositories': self.repositories,
+                'tasks': self.tasks,
+                'completed': self.completed + completed,
+                'answers': state,
+                'unsaved': sorted(unsaved)}
+        path = os.path.join(answers['mounts']['root'], constants.CHECKPOINT_FILE)
+        try:
+            fd = os.open(path + '.new', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as fh:
+                json.dump(data, fh)
+            os.rename(path + '.new', path)
+        except Exception as e:
+            logger.log("CHECKPOINT: Failed to save: %s" % e)
+
+    @staticmethod
+    def load(disk):
+        """ Returns the checkpoint saved on the root filesystem of disk, or
+        None if there is not one. """
+        try:
+            root = diskutil.probeDisk(disk).root
+            if not root[0]:
+                return None
+            root_fs = util.TempMount(root[1], 'resume-', options=['ro'])
+            try:
+                path = os.path.join(root_fs.mount_point, constants.CHECKPOINT_FILE)
+                if not os.path.exists(path):
+                    return None
+                with open(path, 'r') as fh:
+                    data = json.load(fh)
+            finally:
+                root_fs.unmount()
+            if not isinstance(data, dict) or data.get('version') != Checkpoint.CHECKPOINT_VERSION:
+                return None
+            for key, kind in Checkpoint.FIELDS:
+                if not isinstance(data.get(key), kind):
+                    raise RuntimeError("Checkpoint has no valid %s" % key)
+            data['answers'] = dict((key, json.loads(value)) for key, value in data['answers'].items())
+        except Exception as e:
+            logger.log("CHECKPOINT: Failed to load checkpoint from %s" % disk)
+            logger.logException(e)
+            return None
+        return data
+
+def removeCheckpoint(mounts):
+    path = os.path.join(mounts['root'], constants.CHECKPOINT_FILE)
+    if os.path.exists(path):
+        os.unlink(path)
+    return False
+
+def resumeInstallation(answers, ui_package):
+    """ Complete an installation from the checkpoint left on the target by
+    an earlier attempt.  Returns False if there is no usable checkpoint, in
+    which case nothing has been changed. """
+
+    if answers.get('swraid'):
+        logger.log("RESUME: Not supported for software RAID installations")
+        return False
+
+    if 'installation-to-overwrite' in answers:
+        disk = answers['installation-to-overwrite'].primary_disk
+    else:
+        disk = answers['primary-disk']
+
+    data = Checkpoint.load(disk)
+    if not data:
+        logger.log("RESUME: No checkpoint found on %s" % disk)
+        return False
+    if data['layout'] != partitionLayout(disk):
+        logger.log("RESUME: Partition layout of %s has changed" % disk)
+        return False
+    main_repositories, update_repositories = findRepositories(answers)
+    if data['repositories'] != repositoryIdentity(main_repositories + update_repositories):
+        logger.log("RESUME: Installation repositories have changed")
+        return False
+
+    missing = [key for key in data['unsaved'] if key not in answers]
+    if missing:
+        logger.log("RESUME: Checkpoint does not include %s" % ", ".join(missing))
+        return False
+    try:
+        saved = dict((key, Checkpoint.decodeAnswer(key, value, answers))
+                     for key, value in data['answers'].items() if key not in Checkpoint.VOLATILE)
+        resumed = dict(answers)
+        resumed.update(saved)
+        fin_seq = getFinalisationSequence(resumed)
+        checkpoint = Checkpoint(resumed, fin_seq, data['completed'], data['repositories'])
+    except Exception as e:
+        logger.log("RESUME: Failed to restore the installation from the checkpoint")
+        logger.logException(e)
+        return False
+
+    if [task.name() for task in fin_seq] != data['tasks']:
+        logger.log("RESUME: Finalisation sequence has changed")
+        return False
+
+    logger.log("RESUME: Resuming after task %d of %d" % (data['completed'], len(fin_seq)))
+    answers.update(saved)
+    prettyLogAnswers(answers)
+
+    mount_seq = [Task(mountVolumes, A(answers, 'primary-disk', 'physical-disks', 'boot-partnum', 'primary-partnum', 'logs-partnum', 'cleanup', 'swraid'), ['mounts', 'cleanup'])]
+    executeSequence(mount_seq, "Preparing for installation...", answers, ui_package, False)
+    executeSequence(fin_seq[data['completed']:], "Completing installation...", answers, ui_package, True,
+                    max_workers=constants.MAX_TASK_WORKERS,
+                    checkpoint=checkpoint)
+    return True
+
+def findRepositories(answers):
+    """ Returns the main and update repositories from the sources listed in
+    answers. """
+
+    # A list needs to be used rather than a set since the order of updates is
+    # important.  However, since the same repository might exist in multiple
+    # locations or the same location might be listed multiple times, care is
+    # needed to ensure that there are no duplicates.
+    main_repositories = []
+    update_repositories = []
+
+    def add_repos(main_repositories, update_repositories, repos):
+        """Add repositories to the appropriate list, ensuring no duplicates,
+        that the main repository is at the beginning, and that the order of the
+        rest is maintained."""
+
+        for repo in repos:
+            if isinstance(repo, repository.UpdateYumRepository):
+                repo_list = update_repositories
+            else:
+                repo_list = main_repositories
+
+            if repo not in repo_list:
+                if repo.identifier() == MAIN_REPOSITORY_NAME:
+                    repo_list.insert(0, repo)
+                else:
+                    repo_list.append(repo)
+
+    # A list of sources coming from the answerfile
+    if 'sources' in answers:
+        for i in answers['sources']:
+            repos = repository.repositoriesFromDefinition(i['media'], i['address'])
+            add_repos(main_repositories, update_repositories, repos)
+
+    # A single source coming from an interactive install
+    if 'source-media' in answers and 'source-address' in answers:
+        repos = repository.repositoriesFromDefinition(answers['source-media'], answers['source-address'])
+        add_repos(main_repositories, update_repositories, repos)
+
+    for media, address in answers['extra-repos']:
+        repos = repository.repositoriesFromDefinition(media, address)
+        add_repos(main_repositories, update_repositories, repos)
+
+    if not main_repositories or main_repositories[0].identifier() != MAIN_REPOSITORY_NAME:
+        raise RuntimeError("No main repository found")
+
+    return main_repositories, update_repositories
 
 def performInstallation(answers, ui_package, interactive):
     logger.log("INPUT ANSWERS DICTIONARY:")
@@ -312,6 +721,9 @@ def performInstallation(answers, ui_package, interactive):
     logger.log("SCRIPTS DICTIONARY:")
     prettyLogAnswers(scripts.script_dict)
 
+    if answers.get('resume-install') and resumeInstallation(answers, ui_package):
+        return
+
     dom0_mem = xcp.dom0.default_memory_for_version(
                     hardware.getHostTotalMemoryKB(),
                     Version.from_string(version.PLATFORM_VERSION)) // 1024
@@ -385,47 +797,7 @@ def performInstallation(answers, ui_package, interactive):
 
     answers['installed-repos'] = {}
 
-    # A list needs to be used rather than a set since the order of updates is
-    # important.  However, since the same repository might exist in multiple
-    # locations or the same location might be listed multiple times, care is
-    # needed to ensure that there are no duplicates.
-    main_repositories = []
-    update_repositories = []
-
-    def add_repos(main_repositories, update_repositories, repos):
-        """Add repositories to the appropriate list, ensuring no duplicates,
-        that the main repository is at the beginning, and that the order of the
-        rest is maintained."""
-
-        for repo in repos:
-            if isinstance(repo, repository.UpdateYumRepository):
-                repo_list = update_repositories
-            else:
-                repo_list = main_repositories
-
-            if repo not in repo_list:
-                if repo.identifier() == MAIN_REPOSITORY_NAME:
-                    repo_list.insert(0, repo)
-                else:
-                    repo_list.append(repo)
-
-    # A list of sources coming from the answerfile
-    if 'sources' in answers_pristine:
-        for i in answers_pristine['sources']:
-            repos = repository.repositoriesFromDefinition(i['media'], i['address'])
-            add_repos(main_repositories, update_repositories, repos)
-
-    # A single source coming from an interactive install
-    if 'source-media' in answers_pristine and 'source-address' in answers_pristine:
-        repos = repository.repositoriesFromDefinition(answers_pristine['source-media'], answers_pristine['source-address'])
-        add_repos(main_repositories, update_repositories, repos)
-
-    for media, address in answers_pristine['extra-repos']:
-        repos = repository.repositoriesFromDefinition(media, address)
-        add_repos(main_repositories, update_repositories, repos)
-
-    if not main_repositories or main_repositories[0].identifier() != MAIN_REPOSITORY_NAME:
-        raise RuntimeError("No main repository found")
+    main_repositories, update_repositories = findRepositories(answers_pristine)
 
     handleMainRepos(main_repositories, answers)
     if update_repositories:
@@ -459,7 +831,9 @@ def performInstallation(answers, ui_package, interactive):
 
     # complete the installation:
     fin_seq = getFinalisationSequence(answers)
-    executeSequence(fin_seq, "Completing installation...", answers, ui_package, True)
+    executeSequence(fin_seq, "Completing installation...", answers, ui_package, True,
+                    max_workers=constants.MAX_TASK_WORKERS,
+                    checkpoint=Checkpoint(answers, fin_seq))
 
 def rewriteNTPConf(root, ntp_servers):
     ntpsconf = open("%s/etc/chrony.conf" % root, 'r')
@@ -553,6 +927,7 @@ def setupSWRAIDDevice(disk_label_suffix, physical_disks, guest_disks):
         rc = util.runCmd2(['mdadm', '--manage', primary_disk, '--add', physical_disks[1], '--run'])
         if rc != 0:
             raise RuntimeError("Failed to add second disk: '%s' to SWRAID device: '%s'" % (physical_disks[1], primary_disk))
+    diskutil.refreshInventory()
 
     with open('/proc/sys/dev/raid/speed_limit_max', 'w') as speed_file:
         speed_file.write(str(constants.swraid_speed_write_max))
@@ -632,6 +1007,7 @@ def removeBlockingVGs(disks):
         util.runCmd2(['vgreduce', '--removemissing', vg])
         util.runCmd2(['lvremove', vg])
         util.runCmd2(['vgremove', vg])
+    LVMTool.invalidateSnapshot()
 
 ###
 # Functions to write partition tables to disk
@@ -888,14 +1264,12 @@ def _generateBFS(mounts, primary_disk): #pylint: disable=invalid-name
 
     util.runCmd2(["chroot", mounts["root"], "/usr/sbin/multipath", "-a", wwid])
 
-def __mkinitrd(mounts, primary_disk, partition, kernel_version):
+def configureDracut(mounts, primary_disk, primary_partnum):
+    partition = partitionDevice(primary_disk, primary_partnum)
     if isDeviceMapperNode(partition):
         # Generate a valid multipath configuration
         _generateBFS(mounts, primary_disk)
 
-    # Run dracut inside dom0 chroot
-    output_file = os.path.join("/boot", "initrd-%s.img" % kernel_version)
-
     # default to only including host specific kernel modules in initrd
     # disable multipath on root partition
     try:
@@ -906,6 +1280,10 @@ def __mkinitrd(mounts, primary_disk, partition, kernel_version):
     except:
         pass
 
+def __mkinitrd(mounts, kernel_version):
+    # Run dracut inside dom0 chroot
+    output_file = os.path.join("/boot", "initrd-%s.img" % kernel_version)
+
     cmd = ['dracut', '-f', output_file, kernel_version]
 
     if util.runCmd2(['chroot', mounts['root']] + cmd) != 0:
@@ -996,10 +1374,8 @@ def mkinitrd(mounts, primary_disk, primary_partnum):
     xen_kernel_version = getKernelVersion(mounts['root'])
     if not xen_kernel_version:
         raise RuntimeError("Unable to determine kernel version.")
-    partition = partitionDevice(primary_disk, primary_partnum)
-
 
-    __mkinitrd(mounts, primary_disk, partition, xen_kernel_version)
+    __mkinitrd(mounts, xen_kernel_version)
 
 def prepFallback(mounts, primary_disk, primary_partnum):
     kernel_version =  getKernelVersion(mounts['root'])
@@ -1180,6 +1556,7 @@ def writeBootEntries(write_boot_entry, mounts, disks, boot_partnum, install_type
 def mountVolumes(primary_disk, physical_disks, boot_partnum, primary_partnum, logs_partnum, cleanup, swraid):
     if swraid:
         util.runCmd2(['mdadm', '--assemble', primary_disk] + physical_disks)
+        diskutil.refreshInventory()
 
     mounter = DeviceMounter()
     mounter.mount()
@@ -1642,6 +2019,7 @@ def isSWRAIDSyncd(primary_disk):
 def writeLog(primary_disk, primary_partnum, logs_partnum, swraid=False):
     if swraid:
         util.runCmd2(['mdadm', '--assemble', '--scan'])
+        diskutil.refreshInventory()
 
     tool = PartitionTool(primary_disk)
 
@@ -1657,6 +2035,7 @@ def writeLog(primary_disk, primary_partnum, logs_partnum, swraid=False):
                     log_location = os.path.join(primary_fs.mount_point, os.readlink(log_location).lstrip("/"))
                 util.assertDir(log_location)
                 xelogging.collectLogs(log_location, os.path.join(primary_fs.mount_point,"root"))
+                repository.verification_cache.save(os.path.join(log_location, VERIFICATION_CACHE_FILE))
             except:
                 pass
             primary_fs.unmount()
@@ -115,6 +115,8 @@ EULA_PATH = "/opt/xensource/installer/EULA"
 INSTALLER_DIR="/opt/xensource/installer"
 timezone_data_file = '/opt/xensource/installer/timezones'
 kbd_data_file = '/opt/xensource/installer/keymaps'
+TIMELINE_FILE = '/tmp/install-timeline.json'
+VERIFICATION_CACHE_FILE = 'verified-packages.json'
 ANSWERFILE_PATH = '/tmp/answerfile'
 ANSWERFILE_GENERATOR_PATH = '/tmp/answerfile_generator'
 SCRIPTS_DIR = "/tmp/scripts"
@@ -125,6 +127,8 @@ SYSFS_IBFT_DIR = "/sys/firmware/ibft"
 # host filesystem - always absolute paths from root of install
 # and never start with a '/', so they can be used safely with
 # os.path.join.
+CHECKPOINT_FILE = "var/lib/installer-checkpoint"
+STAGING_DIR = "var/cache/yum/staging"
 ANSWERS_FILE = "upgrade_answers"
 INVENTORY_FILE = "etc/xensource-inventory"
 XENCOMMONS_FILE = "etc/sysconfig/xencommons"
@@ -167,6 +171,22 @@ AUTO_EXIT_TIMER = 10 * 1000
 # bootloader timeout
 BOOT_MENU_TIMEOUT = 50
 
+# maximum number of install tasks run concurrently
+MAX_TASK_WORKERS = 4
+
+# maximum number of devices probed for repositories concurrently
+MAX_PROBE_WORKERS = 8
+
+# maximum number of files copied concurrently when backing up
+MAX_COPY_WORKERS = 8
+
+# how long to wait for a disk to report its serial number
+SERIAL_NUMBER_TIMEOUT = 5
+
+# how long no new block devices must appear for, after loading drivers or
+# attaching iSCSI disks, before the devices found are taken to be all
+BLOCK_DEVICE_QUIET_TIME = 1
+
 # timeout used for multipath iscsi
 MPATH_ISCSI_TIMEOUT = 15
 
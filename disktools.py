@@ -3,6 +3,13 @@
 import constants
 import errno
 import re, subprocess, types, os, time
+import stat
+import json
+import threading
+import concurrent.futures
+import struct
+import uuid
+import zlib
 from pprint import pprint
 from copy import copy, deepcopy
 import util
@@ -85,6 +92,11 @@ class LVMTool:
     # Evacuate this many more extents than pvresize theoretically requires
     PVRESIZE_EXTENT_MARGIN = 0
 
+    # Moving 16 extents takes only slightly more time than moving 1, so pvmove at least
+    # this many at a time, and otherwise enough to report progress in this many steps
+    MOVE_MIN_EXTENTS = 16
+    MOVE_PROGRESS_STEPS = 20
+
     # Volume group prefixes
     VG_SWAP_PREFIX = 'VG_XenSwap'
     VG_CONFIG_PREFIX = 'VG_XenConfig'
@@ -127,6 +139,10 @@ class LVMTool:
         'integer_options' : ['pe_start', 'pv_size', 'pv_free', 'pv_pe_count', 'dev_size']
     }
 
+    # Cached LVM state shared by all instances, see snapshot()
+    _snapshot = None
+    _snapshotLock = threading.Lock()
+
     def __init__(self):
         self.readAllInfo()
         self.pvsToDelete = []
@@ -146,25 +162,31 @@ class LVMTool:
                 raise Exception(str(err)+"\nError="+str(rv))
         return out
 
-    def readInfo(self, info):
+    @classmethod
+    def readRecord(cls, info, data):
+        allOptions = info['string_options'] + info['integer_options']
+        # Create a dict of the form 'option_name':value
+        data = dict(zip(allOptions, data))
+        if len(data) != len(allOptions):
+            raise Exception("Wrong number of options in reply")
+        for name in info['integer_options']:
+            # Convert integer options to integer type
+            data[name] = int(data[name])
+        return data
+
+    @classmethod
+    def readInfo(cls, info):
         retVal = []
         allOptions = info['string_options'] + info['integer_options']
         cmd = info['command'] + info['arguments'] + ['--options', ','.join(allOptions)]
-        out = self.cmdWrap(cmd)
+        out = cls.cmdWrap(cmd)
 
         for line in out.strip().split('\n'):
             # skip blank lines
             if line == '':
                 continue
             try:
-                # Create a dict of the form 'option_name':value
-                data = dict(zip(allOptions, line.lstrip().split(self.SEP)))
-                if len(data) != len(allOptions):
-                    raise Exception("Wrong number of options in reply")
-                for name in info['integer_options']:
-                    # Convert integer options to integer type
-                    data[name] = int(data[name])
-                retVal.append(data)
+                retVal.append(cls.readRecord(info, line.lstrip().split(cls.SEP)))
             except Exception as e:
                 logger.log("Discarding corrupt LVM output line '"+str(line)+"'")
                 logger.log("  Command was '"+str(cmd)+"'")
@@ -172,18 +194,83 @@ class LVMTool:
 
         return retVal
 
-    def readAllInfo(self):
-        self.vgs = self.readInfo(self.VGS_INFO)
-        self.lvs = self.readInfo(self.LVS_INFO)
-        self.lvSegs = self.readInfo(self.LVS_SEG_INFO)
-        self.pvs = self.readInfo(self.PVS_INFO)
+    @classmethod
+    def readFullReport(cls):
+        """Reads the records of all four reports from a single 'lvm fullreport'"""
+        reports = [('vgs', 'vg', cls.VGS_INFO), ('lvs', 'lv', cls.LVS_INFO),
+                   ('lvSegs', 'seg', cls.LVS_SEG_INFO), ('pvs', 'pv', cls.PVS_INFO)]
+        cmd = ['/sbin/lvm', 'fullreport', '--reportformat', 'json', '--nosuffix', '--units', 'b']
+        for _, name, info in reports:
+            cmd += ['--configreport', name, '--options', ','.join(info['string_options'] + info['integer_options'])]
+        out = cls.cmdWrap(cmd)
+
+        retVal = dict((key, []) for key, _, _ in reports)
+        for report in json.loads(out)['report']:
+            for key, name, info in reports:
+                allOptions = info['string_options'] + info['integer_options']
+                for record in report.get(name, []):
+                    data = cls.readRecord(info, [record[option] for option in allOptions])
+                    # PVs not in a VG are reported in an internal orphan VG
+                    if data.get('vg_name', '').startswith('#'):
+                        if key == 'vgs':
+                            continue
+                        data['vg_name'] = ''
+                    retVal[key].append(data)
+        return retVal
+
+    @classmethod
+    def readSnapshot(cls):
+        try:
+            snapshot = cls.readFullReport()
+        except Exception as e:
+            logger.log("LVM full report failed, falling back to separate reports: %s" % str(e))
+            snapshot = {
+                'vgs': cls.readInfo(cls.VGS_INFO),
+                'lvs': cls.readInfo(cls.LVS_INFO),
+                'lvSegs': cls.readInfo(cls.LVS_SEG_INFO),
+                'pvs': cls.readInfo(cls.PVS_INFO)
+            }
+
         # For DM nodes "pvs" incorrectly returns /dev/dm-n, which does not exist.
         # Replace occurrences of /dev/dm-n with the correct node under /dev/mapper/
-        for pv in self.pvs:
+        snapshot['pvsByName'] = {}
+        snapshot['pvsByDevNum'] = {}
+        for pv in snapshot['pvs']:
             name = pv['pv_name']
             if name.startswith('/dev/dm-'):
                 n = int(name[8:])
                 pv['pv_name'] = getDeviceMapperNode(n)
+            snapshot['pvsByName'][pv['pv_name']] = pv
+            try:
+                snapshot['pvsByDevNum'][os.stat(pv['pv_name']).st_rdev] = pv
+            except OSError as e:
+                logger.log("Unable to stat PV %s: %s" % (pv['pv_name'], str(e)))
+        return snapshot
+
+    @classmethod
+    def snapshot(cls):
+        """Returns a private copy of the LVM state, which is read once and
+        then cached until invalidateSnapshot() is called"""
+        with cls._snapshotLock:
+            if cls._snapshot is None:
+                cls._snapshot = cls.readSnapshot()
+            return deepcopy(cls._snapshot)
+
+    @classmethod
+    def invalidateSnapshot(cls):
+        """Must be called after changing LVM state, or partition tables which
+        may contain PVs, so that LVMTool instances see the change"""
+        with cls._snapshotLock:
+            cls._snapshot = None
+
+    def readAllInfo(self):
+        snapshot = self.snapshot()
+        self.vgs = snapshot['vgs']
+        self.lvs = snapshot['lvs']
+        self.lvSegs = snapshot['lvSegs']
+        self.pvs = snapshot['pvs']
+        self.pvsByName = snapshot['pvsByName']
+        self.pvsByDevNum = snapshot['pvsByDevNum']
 
     @classmethod
     def decodeSegmentRange(cls, segRange):
@@ -286,10 +373,7 @@ class LVMTool:
     def deviceToPVOrNone(self, device):
         """ Returns the PV record for a given device (partition), or None if there is no PV
         for that device."""
-        for pv in self.pvs:
-            if os.path.samefile(pv['pv_name'], device):
-                return pv
-        return None
+        return self.pvsByDevNum.get(os.stat(device).st_rdev)
 
     def deviceToPV(self, device):
         pv = self.deviceToPVOrNone(device)
@@ -375,10 +459,10 @@ class LVMTool:
         vgsToDelete = []
         lvsToDelete = []
 
-        for pv in self.pvs:
-            if os.path.samefile(pv['pv_name'], device):
-                pvsToDelete.append(pv['pv_name'])
-                vgsToDelete.append(pv['vg_name'])
+        pv = self.deviceToPVOrNone(device)
+        if pv is not None:
+            pvsToDelete.append(pv['pv_name'])
+            vgsToDelete.append(pv['vg_name'])
 
         for lv in self.lvs:
             if lv['vg_name'] in vgsToDelete:
@@ -404,75 +488,117 @@ class LVMTool:
             except Exception as e:
                 logger.logException(e)
 
+    @classmethod
+    def planMoves(cls, moveList):
+        """Returns the moves of moveList as the fewest pvmove-sized MoveChunks.  Moves
+        which follow on from each other in both source and destination are merged, as
+        long as the merged source and destination don't overlap, and the result is split
+        into chunks of at least MOVE_MIN_EXTENTS so that progress is reported in about
+        MOVE_PROGRESS_STEPS steps"""
+        merged = []
+        for move in moveList:
+            if merged:
+                last = merged[-1]
+                if move.src == last.src + last.size and move.dest == last.dest + last.size:
+                    size = last.size + move.size
+                    if last.src + size <= last.dest or last.dest + size <= last.src:
+                        merged[-1] = MoveChunk(last.src, last.dest, size)
+                        continue
+            merged.append(MoveChunk(move.src, move.dest, move.size))
+
+        totalExtents = sum(move.size for move in merged)
+        sizeStep = max(cls.MOVE_MIN_EXTENTS, -(-totalExtents // cls.MOVE_PROGRESS_STEPS))
+        plan = []
+        for move in merged:
+            for offset in range(0, move.size, sizeStep):
+                plan.append(MoveChunk(move.src + offset, move.dest + offset,
+                                      min(sizeStep, move.size - offset)))
+        return plan
+
     @classmethod
     def executeMoves(cls, progress_callback, device, moveList):
         # Call commit instead this method unless you have special requirements
         """Issues pvmove commands to move MoveChunks specified by the MoveList.  Doesn't
         handle overlapping source and destination segments in a single MoveChunk, but in
         a makeSpaceAtEnd scenario those aren't generated"""
-        sizeStep = 16 # Moving 16 extents takes only slightly more time than moving 1
         totalExtents = sum(move.size for move in moveList)
         extentsSoFar = 0
-        for move in moveList:
-            offset = 0
-            while offset < move.size:
-                progress_callback((100 * extentsSoFar) / totalExtents)
-                chunkSize = min(sizeStep, move.size - offset)
-                srcRange = cls.encodeSegmentRange(device, move.src + offset, chunkSize)
-                destRange = cls.encodeSegmentRange(device, move.dest + offset, chunkSize)
-                cls.cmdWrap(cls.PVMOVE +
-                    [
-                    '--alloc',
-                    'anywhere',
-                    srcRange,
-                    destRange
-                ])
-                offset += chunkSize
-                extentsSoFar += chunkSize
+        for move in cls.planMoves(moveList):
+            progress_callback((100 * extentsSoFar) / totalExtents)
+            srcRange = cls.encodeSegmentRange(device, move.src, move.size)
+            destRange = cls.encodeSegmentRange(device, move.dest, move.size)
+            cls.cmdWrap(cls.PVMOVE +
+                [
+                '--alloc',
+                'anywhere',
+                srcRange,
+                destRange
+            ])
+            extentsSoFar += move.size
+        progress_callback(100)
 
     def commit(self, progress_callback=lambda _ : ()):
         """Commit the changes queued up by issuing LVM commands, delete our queues as they
         succeed, and then reread the new configuration from LVM"""
-        progress_callback(0)
-        # Abort pvmoves if any have been left partiially completed by e.g. a crash
-        self.cmdWrap(self.PVMOVE + ['--abort'])
-        self.deactivateAll()
-        progress_callback(1)
-
-        # Process delete lists
-        for lv in self.lvsToDelete:
-            self.cmdWrap(self.LVREMOVE + [lv])
-        self.lvsToDelete = []
-        progress_callback(2)
-        for vg in self.vgsToDelete:
-            self.cmdWrap(self.VGREMOVE + [vg])
-        self.vgsToDelete = []
-        progress_callback(3)
-        for pv in self.pvsToDelete:
-            self.cmdWrap(self.PVREMOVE + ['--force', '--yes', pv])
-        self.pvsToDelete = []
-        progress_callback(4)
-
-        # Process move lists.  Most of the code here is for calculating smoothly
-        # increasing progress values
-        totalExtents = 0
-        for moveList in self.moveLists.values():
-            totalExtents += sum([ move.size for move in moveList ])
-        extentsSoFar = 0
-
-        for device, moveList in sorted(self.moveLists.items()):
-            thisSize = sum([ move.size for move in moveList ])
-            callback = lambda percent : (progress_callback( 5 + (98 - 5) * (extentsSoFar + thisSize * percent / 100) / totalExtents) )
-            self.executeMoves(callback, device, moveList)
-            extentsSoFar +=  thisSize
-        self.moveLists = {}
-
-        # Process resize list
-        progress_callback(98)
-        for resize in self.resizeList:
-            self.cmdWrap(self.PVRESIZE + ['--setphysicalvolumesize', str(resize['bytesize']//1024)+'k', resize['device']])
-        self.resizeList = []
-
+        try:
+            progress_callback(0)
+            # Abort pvmoves if any have been left partiially completed by e.g. a crash
+            self.cmdWrap(self.PVMOVE + ['--abort'])
+            self.deactivateAll()
+            progress_callback(1)
+
+            # Process delete lists
+            for lv in self.lvsToDelete:
+                self.cmdWrap(self.LVREMOVE + [lv])
+            self.lvsToDelete = []
+            progress_callback(2)
+            for vg in self.vgsToDelete:
+                self.cmdWrap(self.VGREMOVE + [vg])
+            self.vgsToDelete = []
+            progress_callback(3)
+            for pv in self.pvsToDelete:
+                self.cmdWrap(self.PVREMOVE + ['--force', '--yes', pv])
+            self.pvsToDelete = []
+            progress_callback(4)
+
+            # Process move lists.  pvmoves within a VG are serialised by LVM, so devices
+            # are grouped by VG and the groups are moved concurrently, with progress
+            # reported from this thread
+            totalExtents = 0
+            for moveList in self.moveLists.values():
+                totalExtents += sum([ move.size for move in moveList ])
+            movedExtents = dict((device, 0) for device in self.moveLists)
+
+            vgMoves = {}
+            for device, moveList in sorted(self.moveLists.items()):
+                vgMoves.setdefault(self.deviceToPV(device)['vg_name'], []).append((device, moveList))
+
+            def moveVG(moves):
+                for device, moveList in moves:
+                    thisSize = sum([ move.size for move in moveList ])
+                    def callback(percent, device=device, thisSize=thisSize):
+                        movedExtents[device] = thisSize * percent / 100
+                    self.executeMoves(callback, device, moveList)
+
+            if totalExtents > 0:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=len(vgMoves)) as pool:
+                    results = [pool.submit(moveVG, moves) for _, moves in sorted(vgMoves.items())]
+                    pending = results
+                    while pending:
+                        _, pending = concurrent.futures.wait(pending, timeout=0.2)
+                        progress_callback( 5 + (98 - 5) * sum(movedExtents.values()) / totalExtents )
+                    for result in results:
+                        result.result()
+            self.moveLists = {}
+
+            # Process resize list
+            progress_callback(98)
+            for resize in self.resizeList:
+                self.cmdWrap(self.PVRESIZE + ['--setphysicalvolumesize', str(resize['bytesize']//1024)+'k', resize['device']])
+            self.resizeList = []
+        finally:
+            # even if a command failed part way, the layout may have changed
+            self.invalidateSnapshot()
         self.readAllInfo() # Reread the new LVM configuration
         progress_callback(99)
         self.deactivateAll() # Stop active LVs preventing changes to the partition structure
@@ -562,14 +688,22 @@ class PartitionToolBase:
         except:
             logger.log('udevsettle with %d second timeout failed' % timeout)
 
-    def waitForDeviceNodes(self):
-        # Ensure new device nodes are available before we continue.
-        # Wait a second to ensure that udev picks up the change event from
-        # the kernel, then call settle to wait for all events complete.
-        time.sleep(1)
-        self.settleUdev()
+    def waitForDeviceNodes(self, partitions=None, since=None):
+        # Ensure the device nodes of this disk's partitions are available before
+        # we continue.  After the disk has been opened for writing at time since,
+        # udev's watch re-reads the partition table and sends events for the disk
+        # and each partition, so wait for those to be processed.  Device mapper
+        # nodes aren't watched.  Fall back to waiting for all udev events.
+        if partitions is None:
+            partitions = self.partitions
+        if isDeviceMapperNode(self.device):
+            since = None
+        paths = [self.device] + [self._partitionDevice(number) for number in partitions]
+        if util.waitForDevices(paths, since=since):
+            self.settleUdev()
 
     def writePartitionTable(self, dryrun=False, log=False):
+        since = time.time()
         try:
             self.writeThisPartitionTable(self.partitions, dryrun, log)
         except Exception as e:
@@ -580,7 +714,11 @@ class PartitionToolBase:
                 raise Exception('The new partition table could not be written: '+str(e)+'\nReversion also failed: '+str(e2))
             raise Exception('The new partition table could not be written but was reverted successfully: '+str(e))
         else:
-            self.waitForDeviceNodes()
+            self.waitForDeviceNodes(since=None if dryrun else since)
+        finally:
+            invalidatePartitionTool(self.device)
+            # PVs may have been removed or exposed
+            LVMTool.invalidateSnapshot()
 
     # Public methods from here onward:
     def getPartition(self, number, default=None):
@@ -845,8 +983,10 @@ class DOSPartitionTool(PartitionToolBase):
     def commitActivePartitiontoDisk(self, part_num):
         self.settleUdev()
         # BIOS bootable flag set for one and unset for others partition
+        since = time.time()
         self.cmdWrap([self.SFDISK, '--no-reread', '-A', self.device, part_num])
-        self.waitForDeviceNodes()
+        invalidatePartitionTool(self.device)
+        self.waitForDeviceNodes(since=since)
 
     def writeThisPartitionTable(self, table, dryrun=False, log=False):
         cmd_input = 'unit: sectors\n\n'
@@ -960,12 +1100,76 @@ class GPTPartitionTool(PartitionToolBase):
         self.sectorLastUsable  = self.sectorExtent - self.sectorFirstUsable
         self.sectorAlignment   = 2 ** 20 // self.sectorSize
 
+    # GPT header fields, after the signature
+    HEADER_FORMAT = '<4sII4sQQQQ16sQIII'
+    ENTRY_FORMAT = '<16s16sQQQ72s'
+    ATTR_LEGACY_BIOS_BOOTABLE = 1 << 2
+    ATTR_HIDDEN = 1 << 62
+
+    def readGPT(self):
+        """Reads the primary GPT directly from the device, returning the partitions
+        or None if sgdisk must be used because the GPT is missing or damaged"""
+        with open(self.device, 'rb') as f:
+            mbr = f.read(self.sectorSize)
+            header = f.read(self.sectorSize)
+            if header[:8] != b'EFI PART':
+                if mbr[510:512] == b'\x55\xaa':
+                    # Let sgdisk convert an MBR partition table
+                    return None
+                logger.log("No partition table found on disk %s" % self.device)
+                return {}
+
+            (revision, headerSize, headerCRC, _, myLBA, _, _, _, _,
+             entriesLBA, numEntries, entrySize, entriesCRC) = struct.unpack_from(self.HEADER_FORMAT, header, 8)
+            if (headerSize < struct.calcsize(self.HEADER_FORMAT) + 8 or headerSize > self.sectorSize or
+                myLBA != 1 or entrySize < struct.calcsize(self.ENTRY_FORMAT) or numEntries * entrySize > 2**20):
+                logger.log("Unsupported GPT header on disk %s" % self.device)
+                return None
+            check = header[:16] + b'\0\0\0\0' + header[20:headerSize]
+            if zlib.crc32(check) != headerCRC:
+                logger.log("GPT header checksum mismatch on disk %s" % self.device)
+                return None
+
+            f.seek(entriesLBA * self.sectorSize)
+            entries = f.read(numEntries * entrySize)
+            if len(entries) != numEntries * entrySize or zlib.crc32(entries) != entriesCRC:
+                logger.log("GPT partition entries checksum mismatch on disk %s" % self.device)
+                return None
+
+        partitions = {}
+        for i in range(numEntries):
+            typeGUID, partGUID, first, last, attributes, name = \
+                struct.unpack_from(self.ENTRY_FORMAT, entries, i * entrySize)
+            if typeGUID == b'\0' * 16:
+                continue
+            partitions[i + 1] = {
+                'start': first,
+                'size': last + 1 - first,
+                'partlabel': name.decode('utf-16-le', 'replace').split('\0', 1)[0],
+                'active': bool(attributes & self.ATTR_LEGACY_BIOS_BOOTABLE),
+                'hidden': bool(attributes & self.ATTR_HIDDEN),
+                'id': str(uuid.UUID(bytes_le=typeGUID)).upper(),
+                'partuuid': str(uuid.UUID(bytes_le=partGUID)).upper(),
+                }
+        return partitions
+
     def partitionTable(self):
+        try:
+            partitions = self.readGPT()
+        except Exception as e:
+            logger.log("Failed to read GPT from disk %s: %s" % (self.device, str(e)))
+            partitions = None
+        if partitions is not None:
+            return partitions
+        return self.sgdiskPartitionTable()
+
+    def sgdiskPartitionTable(self):
         cmd = [self.SGDISK, '--print', self.device]
+        since = time.time()
         rv, out, err = util.runCmd2(cmd, True, True)
         if rv != 0:
             logger.log('Invalid or corrupt partition table found on disk %s. Skipping...' % self.device)
-            self.waitForDeviceNodes()
+            self.waitForDeviceNodes({}, since)
             return {}
 
         matchWarning   = re.compile('Found invalid GPT and valid MBR; converting MBR to GPT format.')
@@ -1019,7 +1223,7 @@ class GPTPartitionTool(PartitionToolBase):
         # sgdisk opens the device with O_WRONLY even when not changing anything
         # so settle udev to ensure device nodes are available for subsequent
         # commands.
-        self.waitForDeviceNodes()
+        self.waitForDeviceNodes(partitions, since)
         return partitions
 
     def commitActivePartitiontoDisk(self, partnum):
@@ -1030,10 +1234,13 @@ class GPTPartitionTool(PartitionToolBase):
             else:
                 args += ['--attributes=%d:clear:2' % num] # BIOS bootable flag clear
 
+        since = None
         if args:
+            since = time.time()
             self.cmdWrap([self.SGDISK] + args + [self.device])
+            invalidatePartitionTool(self.device)
 
-        self.waitForDeviceNodes()
+        self.waitForDeviceNodes(since=since)
 
     def writeThisPartitionTable(self, table, dryrun=False, log=False):
         for part in table.values():
@@ -1144,17 +1351,77 @@ def probePartitioningScheme(device):
     logger.debug("probePartitioningScheme(%r) => %r", device, partitionType)
     return partitionType
 
+# Partition tools read from each disk, keyed by tool class and device number,
+# and the partitioning scheme of each disk, keyed by device number
+_partitionTools = {}
+_partitionSchemes = {}
+_partitionToolsLock = threading.RLock()
+_partitionTableGeneration = 0
+
+def partitionTableGeneration():
+    """Returns a number which changes whenever a partition table is changed"""
+    with _partitionToolsLock:
+        return _partitionTableGeneration
+
+def invalidatePartitionTool(device):
+    """Discards the partition model read from device, which must be called
+    whenever its partition table is changed"""
+    global _partitionTableGeneration
+    try:
+        rdev = os.stat(device).st_rdev
+    except OSError:
+        rdev = None
+    with _partitionToolsLock:
+        _partitionTableGeneration += 1
+        for key in list(_partitionTools):
+            if rdev is None or key[1] == rdev:
+                del _partitionTools[key]
+        if rdev is None:
+            _partitionSchemes.clear()
+        else:
+            _partitionSchemes.pop(rdev, None)
+
 def PartitionTool(device, partitionType=None):
     """
     By default PartitionTool() will return the tool appropriate to the partitioning
     system currently in use on device
+
+    The partition table of each disk is read once and each caller is given its
+    own copy, until the table is written by a tool
     """
-    if partitionType is None:
-        partitionType = probePartitioningScheme(device)
-    if partitionType == constants.PARTITION_DOS:
-        return DOSPartitionTool(device)
-    elif partitionType == constants.PARTITION_GPT:
-        return GPTPartitionTool(device)
+    try:
+        st = os.stat(device)
+        rdev = st.st_rdev if stat.S_ISBLK(st.st_mode) else None
+    except OSError:
+        rdev = None
+
+    with _partitionToolsLock:
+        if partitionType is None:
+            partitionType = _partitionSchemes.get(rdev)
+            if partitionType is None:
+                partitionType = probePartitioningScheme(device)
+                if rdev is not None:
+                    _partitionSchemes[rdev] = partitionType
+        if partitionType == constants.PARTITION_DOS:
+            cls = DOSPartitionTool
+        elif partitionType == constants.PARTITION_GPT:
+            cls = GPTPartitionTool
+        else:
+            return None
+
+        if rdev is None:
+            return cls(device)
+        tool = _partitionTools.get((cls, rdev))
+        if tool is None:
+            tool = cls(device)
+            _partitionTools[(cls, rdev)] = tool
+        tool = deepcopy(tool)
+
+    # The same disk may be known by several names
+    if tool.device != device:
+        tool.device = device
+        tool.midfix = determineMidfix(device)
+    return tool
 
 def destroyPartnodes(dev):
     # Destroy partition nodes for a device-mapper device
@@ -1163,6 +1430,7 @@ def destroyPartnodes(dev):
     for partition in partitions:
         # the obvious way to do this is to use "kpartx -d" but that's broken!
         rv = util.runCmd2(['dmsetup', 'remove', partition])
+        invalidateDeviceGraph()
         if rv: return rv
     return 0
 
@@ -1175,10 +1443,14 @@ def destroyMpathPartnodes():
 
 def createPartnodes(dev):
     # Create partition nodes for a device-mapper device
-    return util.runCmd2(['kpartx', '-a', dev])
+    rv = util.runCmd2(['kpartx', '-a', dev])
+    invalidateDeviceGraph()
+    return rv
 
 def createMpathPartnodes():
-    return util.runCmd2(['dmsetup', 'ls', '--target', 'multipath', '--exec', "kpartx -a"])
+    rv = util.runCmd2(['dmsetup', 'ls', '--target', 'multipath', '--exec', "kpartx -a"])
+    invalidateDeviceGraph()
+    return rv
 
 def getMpathNodes():
     nodes = []
@@ -1213,30 +1485,94 @@ def isDeviceMapperNode(dev):
     except OSError:
         return False
 
+class DeviceGraph(object):
+    """ The holder/slave relationships between the block devices in sysfs
+    and the /dev/mapper nodes of device mapper devices, keyed by device
+    number. """
+
+    def __init__(self):
+        self.generation = partitionTableGeneration()
+        self.names = {}
+        self.partitions = set()
+        self.holders = {}
+        self.slaves = {}
+        self.mapperNodes = {}
+
+        for name in os.listdir('/sys/class/block'):
+            sysdir = '/sys/class/block/' + name
+            try:
+                devnum = self._readDevNum(sysdir)
+            except EnvironmentError:
+                continue
+            self.names[devnum] = name
+            if os.path.exists(sysdir + '/partition'):
+                self.partitions.add(devnum)
+            self.holders[devnum] = self._readLinks(sysdir + '/holders')
+            self.slaves[devnum] = self._readLinks(sysdir + '/slaves')
+
+        if os.path.isdir('/dev/mapper'):
+            for node in os.listdir('/dev/mapper'):
+                try:
+                    self.mapperNodes[os.stat('/dev/mapper/' + node).st_rdev] = '/dev/mapper/' + node
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _readDevNum(sysdir):
+        major, minor = map(int, open(sysdir + '/dev').read().split(':'))
+        return os.makedev(major, minor)
+
+    @classmethod
+    def _readLinks(cls, directory):
+        devnums = []
+        if os.path.isdir(directory):
+            for name in sorted(os.listdir(directory)):
+                try:
+                    devnums.append(cls._readDevNum(os.path.join(directory, name)))
+                except EnvironmentError:
+                    pass
+        return devnums
+
+    def isDisk(self, devnum):
+        return devnum in self.names and devnum not in self.partitions
+
+_deviceGraph = None
+_deviceGraphLock = threading.Lock()
+
+def invalidateDeviceGraph():
+    """ Must be called after device mapper, multipath or md devices have
+    been created or removed. """
+    global _deviceGraph
+    with _deviceGraphLock:
+        _deviceGraph = None
+
+def getDeviceGraph(devnum=None):
+    """ Returns the device graph, rebuilding it if it is out of date or
+    does not know about devnum. """
+    global _deviceGraph
+    with _deviceGraphLock:
+        graph = _deviceGraph
+        if graph is None or graph.generation != partitionTableGeneration() or \
+                (devnum is not None and devnum not in graph.names):
+            graph = _deviceGraph = DeviceGraph()
+        return graph
+
 def getSysfsDir(dev):
-    major, minor = getMajMin(dev)
-    parts = open("/proc/partitions")
-    partlines = [re.sub(" +", " ", x).strip() for x in parts.readlines()]
-    parts.close()
-    # parse it:
-    disks = []
-    for l in partlines:
-        try:
-           (_major, _minor, size, name) = l.split(" ")
-           if (major, minor) == (int(_major), int(_minor)):
-               name = name.replace('/','!')
-               return '/sys/block/%s' % name
-        except:
-            pass
+    devnum = os.stat(dev).st_rdev
+    graph = getDeviceGraph(devnum)
+    if devnum in graph.names:
+        return '/sys/block/%s' % graph.names[devnum]
     raise RuntimeError("Couldn't find sysfs dir for device %s" % dev)
 
 def hasDeviceMapperHolder(dev):
-    sysfs = getSysfsDir(dev)
-    if os.path.exists('%s/holders' % sysfs):
-        for holder in os.listdir('%s/holders' % sysfs):
-            if holder.startswith('dm-'):
-                return True
-    return False
+    devnum = os.stat(dev).st_rdev
+    graph = getDeviceGraph(devnum)
+    if devnum not in graph.names:
+        raise RuntimeError("Couldn't find sysfs dir for device %s" % dev)
+    # only whole disks are listed under /sys/block
+    if not graph.isDisk(devnum):
+        return False
+    return any(graph.names[holder].startswith('dm-') for holder in graph.holders[devnum])
 
 
 def getDeviceMapperNode(n):
@@ -1251,41 +1587,34 @@ def getDeviceMapperNode(n):
 
 def getDeviceSlaves(disk):
     """ Return the list of slaves for an device or an empty list """
-    slaves = []
-    major, minor = getMajMin(disk)
-    rv, out = util.runCmd2(['sh','-c','ls -d1 /sys/block/*/holders/*/dev'],with_stdout=True)
-    lines = out.strip().split('\n')
-    lines = [x for x in lines if x != '']
-    for f in lines:
-        _, _, _, dev, _, _, _ = f.split('/')
-        __major, __minor = map(int, open(f).read().split(':'))
-        if (__major, __minor) == (major, minor):
-            dev = '/dev/' + dev.replace("!", "/")
-            slaves.append(dev)
-    return slaves
+    devnum = os.stat(disk).st_rdev
+    graph = getDeviceGraph(devnum)
+    slaves = [slave for slave in graph.slaves.get(devnum, []) if graph.isDisk(slave)]
+    return sorted('/dev/' + graph.names[slave].replace("!", "/") for slave in slaves)
 
 def getMpathMaster(dev):
     "Returns master device or None"
     try:
-        d = getSysfsDir(dev)
+        devnum = os.stat(dev).st_rdev
+        graph = getDeviceGraph(devnum)
+        if devnum not in graph.names:
+            raise RuntimeError("Couldn't find sysfs dir for device %s" % dev)
 
         if dev.startswith('/dev/dm-'):
-            holder = dev[5:]
+            master = devnum
         else:
-            holders = os.listdir('%s/holders' % d)
-            if len(holders) != 1 or (not holders[0].startswith('dm-')):
-                logger.log('getMpathMaster: contents of %s/holders/ is %s' % (d,str(holders)))
+            holders = graph.holders[devnum] if graph.isDisk(devnum) else None
+            if holders is None:
                 return None
-            else:
-                holder = holders[0]
-
-        (major,minor) = map(int,open('/sys/block/%s/dev' % holder).read().strip().split(':'))
-        for i in os.listdir('/dev/mapper'):
-            dmdev = '/dev/mapper/%s' % i
-            if getMajMin(dmdev) == (major,minor):
-                logger.log('getMpathMaster: %s has master %s' % (dev,dmdev))
-                return dmdev
-        logger.log('getMpathMaster: could not find master %d:%d of %s in /dev/mapper/' % (major,minor,dev))
+            if len(holders) != 1 or (not graph.names[holders[0]].startswith('dm-')):
+                logger.log('getMpathMaster: holders of %s are %s' % (dev, [graph.names[h] for h in holders]))
+                return None
+            master = holders[0]
+
+        if master in graph.mapperNodes:
+            logger.log('getMpathMaster: %s has master %s' % (dev, graph.mapperNodes[master]))
+            return graph.mapperNodes[master]
+        logger.log('getMpathMaster: could not find master %d:%d of %s in /dev/mapper/' % (os.major(master), os.minor(master), dev))
 
     except OSError:
         return None
@@ -8,6 +8,10 @@ from constants import MultipathConfig
 import fcntl
 import glob
 import shutil
+import struct
+import subprocess
+import threading
+import concurrent.futures
 import util
 import netutil
 from util import dev_null
@@ -38,6 +42,31 @@ def wait_for_multipathd():
     logger.log(msg)
     raise Exception(msg)
 
+def _blockDeviceNames():
+    # loop, ram and similar devices are never probed, and udev may not
+    # record anything for them
+    return sorted(name for name in os.listdir('/sys/class/block')
+                  if not re.match(r'(loop|ram|zram|fd|nbd)\d', name))
+
+def waitForBlockDevices(timeout=30, settle=False):
+    """ Waits for udev to process each disk and partition the kernel knows
+    about, rather than for every udev event, falling back to udevsettle if
+    they don't appear.
+
+    After loading drivers, settle should be set: drivers may find disks a
+    while after they load, so all queued udev events are waited for, and
+    then until no more block devices have appeared for a short time. """
+    deadline = time.monotonic() + timeout
+    if settle:
+        util.runCmd2(util.udevsettleCmd())
+        names = util.waitUntilStable(_blockDeviceNames, constants.BLOCK_DEVICE_QUIET_TIME, timeout)
+    else:
+        names = _blockDeviceNames()
+    paths = ['/dev/' + name.replace('!', '/') for name in names]
+    if util.waitForDevices(paths, max(deadline - time.monotonic(), 0)):
+        util.runCmd2(util.udevsettleCmd())
+    refreshInventory()
+
 def mpath_part_scan(force=False):
     global use_mpath
 
@@ -45,7 +74,7 @@ def mpath_part_scan(force=False):
         return 0
     ret = createMpathPartnodes()
     if ret == 0:
-         util.runCmd2(util.udevsettleCmd())
+         waitForBlockDevices()
     return ret
 
 def mpath_enable(mpath_config):
@@ -61,8 +90,7 @@ def mpath_enable(mpath_config):
 
     # launch manually to make possible to wait initialization
     util.runCmd2(["/sbin/multipath", "-v0", "-B"])
-    time.sleep(1)
-    util.runCmd2(util.udevsettleCmd())
+    waitForBlockDevices()
 
     # This creates maps for all disks at start of day (because -e is ommitted)
     assert 0 == util.runCmd2('multipathd -d > /var/log/multipathd 2>&1 &')
@@ -79,6 +107,7 @@ def mpath_disable():
     destroyMpathPartnodes()
     util.runCmd2(['killall','multipathd'])
     util.runCmd2(['/sbin/multipath','-F'])
+    refreshInventory()
     use_mpath = False
 
 # hd* -> (ide has majors 3, 22, 33, 34, 56, 57, 88, 89, 90, 91, each major has
@@ -190,13 +219,7 @@ def getQualifiedPartitionList():
     return [getQualifiedDeviceName(x) for x in getPartitionList()]
 
 def getRemovableDeviceList():
-    devs = os.listdir('/sys/block')
-    removable_devs = []
-    for d in devs:
-        if isRemovable(d):
-            removable_devs.append(d.replace("!", "/"))
-
-    return removable_devs
+    return sorted(dev.name for dev in getInventory().byName.values() if dev.removable)
 
 def removable(device):
     if device.startswith('/dev/'):
@@ -236,89 +259,231 @@ def __readOneLineFile__(filename):
     except Exception as e:
         raise e
 
-def getDiskDeviceVendor(dev):
+class BlockDevice(object):
+    """ What sysfs says about a disk or partition; names are relative to /dev. """
+    __slots__ = ('name', 'devnum', 'partition', 'size', 'block_size', 'vendor', 'model',
+                 'serial', 'removable', 'holders', 'slaves', 'dm_name', 'dm_uuid', 'md', 'md_name')
+
+    def __init__(self, name):
+        self.name = name
+        sysdir = '/sys/class/block/' + name.replace('/', '!')
+
+        def read(attr, default=None):
+            try:
+                return __readOneLineFile__(os.path.join(sysdir, attr)).strip()
+            except EnvironmentError:
+                return default
+
+        major, minor = read('dev').split(':')
+        self.devnum = os.makedev(int(major), int(minor))
+        self.partition = os.path.exists(os.path.join(sysdir, 'partition'))
+        self.size = int(read('device/block/size') or read('size', 0))
+        self.block_size = int(read('queue/logical_block_size', 0))
+        self.vendor = read('device/vendor', '')
+        self.model = read('device/model', '')
+        self.serial = read('device/serial') or None
+        self.removable = not self.partition and isRemovable('/dev/' + name)
+        self.holders = sorted(n.replace('!', '/') for n in os.listdir(os.path.join(sysdir, 'holders')))
+        self.slaves = sorted(n.replace('!', '/') for n in os.listdir(os.path.join(sysdir, 'slaves')))
+        self.dm_name = read('dm/name')
+        self.dm_uuid = read('dm/uuid')
+        self.md = read('md/array_state') not in (None, 'clear', 'inactive')
+        self.md_name = None
+
+    def isMultipath(self):
+        return bool(self.dm_uuid and self.dm_uuid.startswith('mpath-'))
+
+class DiskInventory(object):
+    """ A snapshot of the block devices in sysfs, indexed by name and
+    device number, so that disk details can be looked up repeatedly without
+    reading sysfs.  refresh() must be called after devices change; partition
+    table changes made through disktools are noticed automatically. """
+
+    def __init__(self):
+        self.refresh()
+
+    def refresh(self):
+        self.generation = partitionTableGeneration()
+        self.byName = {}
+        self.byDevNum = {}
+        for name in os.listdir('/sys/class/block'):
+            try:
+                dev = BlockDevice(name.replace('!', '/'))
+            except Exception as e:
+                logger.log("Skipping block device %s: %s" % (name, e))
+                continue
+            self.byName[dev.name] = dev
+            self.byDevNum[dev.devnum] = dev
+
+        # mdadm reports an array's name as that of its link in /dev/md/
+        if os.path.isdir('/dev/md'):
+            for link in os.listdir('/dev/md'):
+                try:
+                    dev = self.byDevNum.get(os.stat(os.path.join('/dev/md', link)).st_rdev)
+                except OSError:
+                    continue
+                if dev and dev.md:
+                    dev.md_name = link
+
+    def lookup(self, dev):
+        """ Returns the record for dev, e.g. 'sda', '/dev/sda' or a link to
+        it, or None if there is no such block device. """
+        if self.generation != partitionTableGeneration():
+            self.refresh()
+        path = dev if dev.startswith('/dev/') else '/dev/' + dev
+        try:
+            return self.byDevNum.get(os.stat(path).st_rdev)
+        except OSError:
+            return self.byName.get(path[5:])
+
+    def slaves(self, dev):
+        """ Returns the records of the devices underlying dev. """
+        return [self.byName[name] for name in dev.slaves if name in self.byName]
+
+    def physical(self, dev):
+        """ Returns the record holding the details of dev, which is that of
+        the first device beneath any device mapper nodes stacked on it. """
+        record = self.lookup(dev)
+        seen = set()
+        while record is not None and record.dm_uuid is not None:
+            if record.devnum in seen:
+                return None
+            seen.add(record.devnum)
+            slaves = self.slaves(record)
+            record = slaves[0] if slaves else None
+        return record
+
+_inventory = None
+
+def getInventory():
+    global _inventory
+    if _inventory is None:
+        _inventory = DiskInventory()
+    return _inventory
+
+def refreshInventory():
+    invalidateDeviceGraph()
+    if _inventory is not None:
+        _inventory.refresh()
+
+def _raidSlaveDetails(record, fn):
+    return '/'.join(sorted(set(fn('/dev/' + slave.name) for slave in getInventory().slaves(record))))
 
+def getDiskDeviceVendor(dev):
     # For Multipath nodes return info about 1st slave
-    if not dev.startswith("/dev/"):
-        dev = '/dev/' + dev
-    if isDeviceMapperNode(dev):
-        return getDiskDeviceVendor(getDeviceSlaves(dev)[0])
-    if is_raid(dev):
-        vendors = set(map(getDiskDeviceVendor, getDeviceSlaves(dev)))
-        return '/'.join(vendors)
-
-    if dev.startswith("/dev/"):
-        dev = re.match("/dev/(.*)", dev).group(1)
-    dev = dev.replace("/", "!")
-    if os.path.exists("/sys/block/%s/device/vendor" % dev):
-        return __readOneLineFile__("/sys/block/%s/device/vendor" % dev).strip(' \n')
-    else:
+    record = getInventory().physical(dev)
+    if record is None:
         return ""
+    if record.md:
+        return _raidSlaveDetails(record, getDiskDeviceVendor)
+    return record.vendor
 
 def getDiskDeviceModel(dev):
-
     # For Multipath nodes return info about 1st slave
-    if not dev.startswith("/dev/"):
-        dev = '/dev/' + dev
-    if isDeviceMapperNode(dev):
-        return getDiskDeviceModel(getDeviceSlaves(dev)[0])
-    if is_raid(dev):
-        models = set(map(getDiskDeviceModel, getDeviceSlaves(dev)))
-        return '/'.join(models)
-
-    if dev.startswith("/dev/"):
-        dev = re.match("/dev/(.*)", dev).group(1)
-    dev = dev.replace("/", "!")
-    if os.path.exists("/sys/block/%s/device/model" % dev):
-        return __readOneLineFile__("/sys/block/%s/device/model" % dev).strip('  \n')
-    else:
+    record = getInventory().physical(dev)
+    if record is None:
         return ""
+    if record.md:
+        return _raidSlaveDetails(record, getDiskDeviceModel)
+    return record.model
 
 def getDiskDeviceSize(dev):
-
     # For Multipath nodes return info about 1st slave
-    if not dev.startswith("/dev/"):
-        dev = '/dev/' + dev
-    if isDeviceMapperNode(dev):
-        return getDiskDeviceSize(getDeviceSlaves(dev)[0])
+    record = getInventory().physical(dev)
+    return record.size if record is not None else 0
 
-    if dev.startswith("/dev/"):
-        dev = re.match("/dev/(.*)", dev).group(1)
-    dev = dev.replace("/", "!")
-    if os.path.exists("/sys/block/%s/device/block/size" % dev):
-        return int(__readOneLineFile__("/sys/block/%s/device/block/size" % dev))
-    elif os.path.exists("/sys/block/%s/size" % dev):
-        return int(__readOneLineFile__("/sys/block/%s/size" % dev))
+def getDiskBlockSize(dev):
+    record = getInventory().physical(dev)
+    if record is None:
+        raise Exception("No such block device: %s" % dev)
+    return record.block_size
 
-    return 0
+# serial numbers by device number, kept for the life of the installer
+_serialNumbers = {}
+_serialNumbersLock = threading.Lock()
 
-def getDiskBlockSize(dev):
-    if not dev.startswith("/dev/"):
-        dev = '/dev/' + dev
-    if isDeviceMapperNode(dev):
-        return getDiskBlockSize(getDeviceSlaves(dev)[0])
-    if dev.startswith("/dev/"):
-        dev = re.match("/dev/(.*)", dev).group(1)
-    dev = dev.replace("/", "!")
-    return int(__readOneLineFile__("/sys/block/%s/queue/logical_block_size"
-                                   % dev))
+def _readSerialNumber(record):
+    sysdir = '/sys/class/block/%s/device' % record.name.replace('/', '!')
+
+    # the Unit Serial Number VPD page, as cached by the kernel
+    try:
+        with open(sysdir + '/vpd_pg80', 'rb') as fh:
+            page = fh.read()
+        if len(page) > 4:
+            serial = page[4:4 + struct.unpack('>H', page[2:4])[0]].decode('ascii', 'replace').strip(' \0')
+            if serial:
+                return serial
+    except (EnvironmentError, struct.error):
+        pass
+
+    if record.serial:
+        return record.serial
+
+    properties = util.readUdevProperties(record.devnum)
+    for key in ('ID_SCSI_SERIAL', 'ID_SERIAL_SHORT'):
+        if properties.get(key):
+            return properties[key]
+
+    try:
+        rc, out = util.runCmd2(['/bin/sdparm', '-q', '-i', '-p', 'sn', '/dev/' + record.name],
+                               with_stdout=True, timeout=constants.SERIAL_NUMBER_TIMEOUT)
+        if rc == 0:
+            lines = out.split('\n')
+            if len(lines) >= 2 and lines[1].strip():
+                return lines[1].strip()
+    except subprocess.TimeoutExpired:
+        logger.log("Timed out reading the serial number of %s" % record.name)
+
+    return ""
+
+def _serialNumberFutures(devs):
+    """ Returns a dictionary of the futures for the serial numbers of each
+    of devs, and a list of the (record, future) pairs which nothing is
+    reading yet. """
+    futures = {}
+    pending = []
+    with _serialNumbersLock:
+        for dev in devs:
+            record = getInventory().physical(dev)
+            if record is not None and record.md:
+                records = getInventory().slaves(record)
+            else:
+                records = [record] if record is not None else []
+            for r in records:
+                if r.devnum not in _serialNumbers:
+                    _serialNumbers[r.devnum] = concurrent.futures.Future()
+                    pending.append((r, _serialNumbers[r.devnum]))
+            futures[dev] = [_serialNumbers[r.devnum] for r in records]
+    return futures, pending
+
+def _readSerialNumbers(pending):
+    def read(record, future):
+        try:
+            future.set_result(_readSerialNumber(record))
+        except Exception as e:
+            future.set_exception(e)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=constants.MAX_PROBE_WORKERS) as pool:
+        for record, future in pending:
+            pool.submit(read, record, future)
+
+def prefetchDiskSerialNumbers(devs):
+    """ Starts reading the serial numbers of devs in the background. """
+    _, pending = _serialNumberFutures(devs)
+    if pending:
+        threading.Thread(target=_readSerialNumbers, args=(pending,), daemon=True).start()
+
+def getDiskSerialNumbers(devs):
+    """ Returns a dictionary of the serial numbers of devs, reading those
+    not already known concurrently. """
+    futures, pending = _serialNumberFutures(devs)
+    _readSerialNumbers(pending)
+    return dict((dev, '/'.join(sorted(set(f.result() for f in dev_futures))))
+                for dev, dev_futures in futures.items())
 
 def getDiskSerialNumber(dev):
     # For Multipath nodes return info about 1st slave
-    if not dev.startswith("/dev/"):
-        dev = '/dev/' + dev
-    if isDeviceMapperNode(dev):
-        return getDiskSerialNumber(getDeviceSlaves(dev)[0])
-    if is_raid(dev):
-        serials = set(map(getDiskSerialNumber, getDeviceSlaves(dev)))
-        return '/'.join(serials)
-
-    rc, out = util.runCmd2(['/bin/sdparm', '-q', '-i', '-p', 'sn', dev], with_stdout=True)
-    if rc == 0:
-        lines = out.split('\n')
-        if len(lines) >= 2:
-            return lines[1].strip()
-    return ""
+    return getDiskSerialNumbers([dev])[dev]
 
 def isRemovable(path):
 
@@ -353,6 +518,17 @@ def isRemovable(path):
     else:
         return False
 
+def isRotational(dev):
+    """ Returns whether dev, a disk or a partition, is on rotating or optical
+    media, assuming so if it cannot be determined. """
+    sysdir = "/sys/class/block/%s" % os.path.basename(os.path.realpath(dev))
+    if os.path.exists(os.path.join(sysdir, "partition")):
+        sysdir = os.path.dirname(os.path.realpath(sysdir))
+    try:
+        return int(__readOneLineFile__(os.path.join(sysdir, "queue/rotational"))) == 1
+    except:
+        return True
+
 def isLargeBlockDisk(dev):
     """
     Determines whether a disk's logical block size is larger than 512 bytes
@@ -391,12 +567,23 @@ def getExtendedDiskInfo(disk, inMb=0):
             inMb and (getDiskDeviceSize(disk)//2048) or getDiskDeviceSize(disk))
 
 
+def readExtSuperblockLabel(partition):
+    """Returns the label of the ext filesystem on partition, read from its
+    superblock, or None if it does not contain one."""
+    with open(partition, 'rb') as fh:
+        fh.seek(1024)
+        superblock = fh.read(1024)
+    if superblock[56:58] != b'\x53\xef':
+        return None
+    return superblock[120:136].split(b'\0', 1)[0].decode('utf-8', 'replace').strip()
+
 def readExtPartitionLabel(partition):
     """Read the ext partition label."""
-    rc, out = util.runCmd2(['/sbin/e2label', partition], with_stdout=True)
-    if rc == 0:
-        label = out.strip()
-    else:
+    try:
+        label = readExtSuperblockLabel(partition)
+    except EnvironmentError:
+        label = None
+    if label is None:
         raise Exception("%s is not ext partition" % partition)
     return label
 
@@ -427,14 +614,17 @@ def getHumanDiskName(disk):
     # For Multipath nodes return info about 1st slave
     if not disk.startswith("/dev/"):
         disk = '/dev/' + disk
-    if isDeviceMapperNode(disk):
-        return getHumanDiskName(getDeviceSlaves(disk)[0])
-    if is_raid(disk):
-        name = getMdDeviceName(disk)
+    record = getInventory().lookup(disk)
+    if record is not None and record.dm_uuid is not None:
+        slaves = getInventory().slaves(record)
+        if slaves:
+            return getHumanDiskName(slaves[0].name)
+    if record is not None and record.md:
+        name = record.md_name or getMdDeviceName(disk)
         # mdadm may append an _ followed by a number (e.g. d0_0) to prevent
         # name collisions. Strip it if necessary.
         name = re.match("([^_]*)(_\d+)?$", name).group(1)
-        return 'RAID: %s(%s)' % (name, ','.join(dev[5:] for dev in getDeviceSlaves(disk)))
+        return 'RAID: %s(%s)' % (name, ','.join(record.slaves))
 
     if disk.startswith('/dev/disk/by-id/'):
         return disk[16:]
@@ -525,9 +715,10 @@ STORAGE_LVM = 1
 STORAGE_OTHER = 2
 STORAGE_GFS2 = 3
 
-def probeDisk(device):
+def probeDisk(device, lv_tool=None):
     """Examines device and reports the apparent presence of a XenServer installation and/or related usage
     Returns a Disk object with XenServer partitions and state (boot, root, storage, logs, swap)
+    lv_tool, if given, is an LVMTool used to look up the PVs on device
 
     Where:
 
@@ -579,7 +770,8 @@ def probeDisk(device):
         possible_srs.add(device)
 
     srs = []
-    lv_tool = len(possible_srs) and LVMTool()
+    if possible_srs and lv_tool is None:
+        lv_tool = LVMTool()
     for part_device in possible_srs:
         if lv_tool.isPartitionConfig(part_device):
             disk.state = (True, part_device)
@@ -603,6 +795,19 @@ def probeDisk(device):
 
     return disk
 
+def probeDisks(devices):
+    """Probes devices concurrently, sharing one view of the LVM state.
+    Returns a list of futures for their Disk objects, in the order of devices"""
+    try:
+        lv_tool = LVMTool()
+    except Exception as e:
+        # let each probe fail, or not, as it would have on its own
+        logger.log("Failed to read LVM state: %s" % str(e))
+        lv_tool = None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=constants.MAX_PROBE_WORKERS) as pool:
+        return [pool.submit(probeDisk, device, lv_tool) for device in devices]
+
 
 # Keep track of iscsi disks we have logged into
 iscsi_disks = []
@@ -826,17 +1031,33 @@ def process_ibft(ui, interactive):
     if rv:
         raise RuntimeError('Failed to attach iSCSI target disk(s)')
 
+    def attachedDisks():
+        rv, out = util.runCmd2([ 'iscsiadm', '-m', 'session', '-P', '3' ],
+                               with_stdout=True)
+        if rv:
+            raise RuntimeError('Failed to find attached disks')
+        disks = []
+        for line in out.split('\n'):
+            m = re.match(r'\s*Attached scsi disk (\w+)\s+.*$', line)
+            if m:
+                disks.append('/dev/' + m.group(1))
+        return disks
+
+    # The disks are attached asynchronously, so after the udev events so
+    # far are handled, wait for a disk on each target, and then until no
+    # more LUNs appear, and for those devices to be ready
     util.runCmd2(util.udevsettleCmd())
-    time.sleep(5)
-
-    rv, out = util.runCmd2([ 'iscsiadm', '-m', 'session', '-P', '3' ],
-                           with_stdout=True)
-    if rv:
-        raise RuntimeError('Failed to find attached disks')
-    for line in out.split('\n'):
-        m = re.match(r'\s*Attached scsi disk (\w+)\s+.*$', line)
-        if m:
-            iscsi_disks.append('/dev/' + m.group(1))
+    deadline = time.monotonic() + 30
+    while True:
+        disks = attachedDisks()
+        if len(disks) >= targets or time.monotonic() > deadline:
+            break
+        time.sleep(0.5)
+    disks = util.waitUntilStable(attachedDisks, constants.BLOCK_DEVICE_QUIET_TIME,
+                                 max(deadline - time.monotonic(), 0))
+    if util.waitForDevices(disks):
+        util.runCmd2(util.udevsettleCmd())
+    iscsi_disks.extend(disks)
 
     logger.log('process_ibft: iSCSI Disks: %s' % (str(iscsi_disks),))
     logger.log('process_ibft: Reserved NICs: %s' % (str(list(ibft_reserved_nics)),))
@@ -854,6 +1075,7 @@ def is_raid(disk):
 
 def stopSWRAID(device):
     util.runCmd2(["mdadm", "--stop", device])
+    refreshInventory()
 
 def dev_from_devpath(devpath):
     """Returns the dev number of the device as a tuple."""
@@ -908,3 +1130,29 @@ def fs_type_from_device(device):
     msg = "Failed to identify filesystem type on %s" % device
     logger.log(msg)
     raise Exception(msg)
+
+def mediaFilesystem(device):
+    """ Returns the type of the iso9660, vfat or ext filesystem on device,
+    as passed to mount, by looking for its signature, or None if there is
+    none (or no media).  Raises OSError if the device cannot be read. """
+    try:
+        fd = os.open(device, os.O_RDONLY)
+    except OSError as e:
+        if e.errno == errno.ENOMEDIUM:
+            return None
+        raise
+    try:
+        data = os.pread(fd, 32774, 0)
+    finally:
+        os.close(fd)
+
+    # primary volume descriptor in sector 16
+    if data[32769:32774] == b'CD001':
+        return 'iso9660'
+    # boot sector, which unlike a partition table names the FAT type
+    if data[510:512] == b'\x55\xaa' and (data[54:57] == b'FAT' or data[82:87] == b'FAT32'):
+        return 'vfat'
+    # superblock magic
+    if data[1080:1082] == b'\x53\xef':
+        return 'ext3'
+    return None
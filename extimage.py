@@ -0,0 +1,187 @@
+# SPDX-License-Identifier: GPL-2.0-only
+
+"""Copies an unmounted ext2/3/4 filesystem to another device by copying only
+the blocks its block bitmaps show to be in use."""
+
+import os
+import re
+import struct
+
+from xcp import logger
+
+SUPERBLOCK_OFFSET = 1024
+SUPERBLOCK_MAGIC = 0xEF53
+
+STATE_VALID = 0x1
+STATE_ERROR = 0x2
+
+INCOMPAT_RECOVER = 0x4
+INCOMPAT_JOURNAL_DEV = 0x8
+INCOMPAT_META_BG = 0x10
+INCOMPAT_64BIT = 0x80
+# features which don't change where the metadata is
+INCOMPAT_SUPPORTED = 0x2 | 0x40 | INCOMPAT_64BIT | 0x100 | 0x200 | 0x400 | 0x1000 | 0x2000 | 0x4000 | 0x8000 | 0x10000 | 0x20000
+
+RO_COMPAT_GDT_CSUM = 0x10
+RO_COMPAT_METADATA_CSUM = 0x400
+
+BG_BLOCK_UNINIT = 0x2
+
+# gaps smaller than this are copied too, so that I/O stays sequential
+MERGE_GAP = 2**20
+CHUNK_SIZE = 8 * 2**20
+
+class ExtFilesystem(object):
+    """ The layout of the ext filesystem on a device, read from its
+    superblock and group descriptors. """
+
+    def __init__(self, device, sb):
+        self.device = device
+        (inodes_count, blocks_lo, self.first_data_block, log_block_size, blocks_per_group,
+         self.inodes_per_group, state, rev_level, inode_size, feature_incompat,
+         feature_ro_compat, self.reserved_gdt_blocks, desc_size, blocks_hi) = \
+            [struct.unpack_from(fmt, sb, offset)[0] for fmt, offset in
+             (('<I', 0x0), ('<I', 0x4), ('<I', 0x14), ('<I', 0x18), ('<I', 0x20),
+              ('<I', 0x28), ('<H', 0x3A), ('<I', 0x4C), ('<H', 0x58), ('<I', 0x60),
+              ('<I', 0x64), ('<H', 0xCE), ('<H', 0xFE), ('<I', 0x150))]
+        self.state = state
+        self.feature_incompat = feature_incompat
+        self.block_size = 1024 << log_block_size
+        self.blocks_per_group = blocks_per_group
+        self.is64bit = bool(feature_incompat & INCOMPAT_64BIT)
+        self.blocks_count = blocks_lo | ((blocks_hi << 32) if self.is64bit else 0)
+        self.inode_size = inode_size if rev_level >= 1 else 128
+        self.desc_size = desc_size if self.is64bit and desc_size else 32
+        self.uninit_groups = bool(feature_ro_compat & (RO_COMPAT_GDT_CSUM | RO_COMPAT_METADATA_CSUM))
+        self.groups = -(-(self.blocks_count - self.first_data_block) // blocks_per_group)
+        self.gdt_blocks = -(-(self.groups * self.desc_size) // self.block_size)
+        self.size = self.blocks_count * self.block_size
+
+    def unsupported(self):
+        """ Returns why the filesystem can't be copied, or None if it can. """
+        if not self.state & STATE_VALID or self.state & STATE_ERROR:
+            return "it was not cleanly unmounted"
+        if self.feature_incompat & INCOMPAT_RECOVER:
+            return "its journal needs recovery"
+        if self.feature_incompat & ~INCOMPAT_SUPPORTED:
+            return "it has unsupported features %#x" % (self.feature_incompat & ~INCOMPAT_SUPPORTED)
+        if self.desc_size < 32 or self.blocks_per_group == 0 or self.groups == 0:
+            return "its superblock is invalid"
+        return None
+
+    def readGroupDescriptors(self, fd):
+        table = os.pread(fd, self.groups * self.desc_size, (self.first_data_block + 1) * self.block_size)
+        if len(table) < self.groups * self.desc_size:
+            raise RuntimeError("Group descriptors of %s are truncated" % self.device)
+        for g in range(self.groups):
+            desc = table[g * self.desc_size:(g + 1) * self.desc_size]
+            block_bitmap, inode_bitmap, inode_table = struct.unpack_from('<III', desc, 0)
+            flags = struct.unpack_from('<H', desc, 0x12)[0]
+            if self.desc_size >= 64:
+                hi = struct.unpack_from('<III', desc, 0x20)
+                block_bitmap |= hi[0] << 32
+                inode_bitmap |= hi[1] << 32
+                inode_table |= hi[2] << 32
+            yield block_bitmap, inode_bitmap, inode_table, flags
+
+    def allocatedExtents(self):
+        """ Returns a sorted list of (start, length) byte ranges of the
+        device which the filesystem is using, which may include some unused
+        blocks. """
+        bs = self.block_size
+        itable_blocks = -(-(self.inodes_per_group * self.inode_size) // bs)
+        sb_blocks = 1 + self.gdt_blocks + self.reserved_gdt_blocks
+        blocks = [(0, self.first_data_block + sb_blocks)]
+
+        fd = os.open(self.device, os.O_RDONLY)
+        try:
+            for g, (block_bitmap, inode_bitmap, inode_table, flags) in enumerate(self.readGroupDescriptors(fd)):
+                # the bitmaps and inode tables are always in use, and may be
+                # in another group
+                blocks += [(block_bitmap, 1), (inode_bitmap, 1), (inode_table, itable_blocks)]
+                group_start = self.first_data_block + g * self.blocks_per_group
+                group_blocks = min(self.blocks_per_group, self.blocks_count - group_start)
+
+                if self.uninit_groups and flags & BG_BLOCK_UNINIT:
+                    # nothing but (possibly) a backup superblock and descriptors
+                    blocks.append((group_start, min(sb_blocks, group_blocks)))
+                    continue
+
+                bitmap = os.pread(fd, bs, block_bitmap * bs)
+                # to the nearest 8 blocks, which is close enough
+                for m in re.finditer(b'[^\\x00]+', bitmap[:-(-group_blocks // 8)]):
+                    start = m.start() * 8
+                    blocks.append((group_start + start, min(m.end() * 8, group_blocks) - start))
+        finally:
+            os.close(fd)
+
+        extents = []
+        for start, count in sorted(blocks):
+            start, end = start * bs, min(start + count, self.blocks_count) * bs
+            if end <= start:
+                continue
+            if extents and start <= extents[-1][1] + MERGE_GAP:
+                extents[-1][1] = max(extents[-1][1], end)
+            else:
+                extents.append([start, end])
+        return [(start, end - start) for start, end in extents]
+
+def readExtFilesystem(device):
+    """ Returns an ExtFilesystem for the filesystem on device, or None if
+    it isn't an ext filesystem which can be copied. """
+    try:
+        fd = os.open(device, os.O_RDONLY)
+        try:
+            sb = os.pread(fd, 1024, SUPERBLOCK_OFFSET)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        logger.log("Can't read the superblock of %s: %s" % (device, e))
+        return None
+    if len(sb) < 1024 or struct.unpack_from('<H', sb, 0x38)[0] != SUPERBLOCK_MAGIC:
+        return None
+
+    fs = ExtFilesystem(device, sb)
+    reason = fs.unsupported()
+    if reason:
+        logger.log("Can't copy the filesystem on %s as an image: %s" % (device, reason))
+        return None
+    return fs
+
+def deviceSize(device):
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+
+def copyFilesystem(fs, destination, progress_callback=lambda copied, total: None):
+    """ Copies the blocks in use by fs to the same offsets of destination,
+    which must be at least fs.size bytes. """
+    extents = fs.allocatedExtents()
+    total = sum(length for _, length in extents)
+    logger.log("Copying %d of %d bytes of %s to %s" % (total, fs.size, fs.device, destination))
+
+    copied = 0
+    src = os.open(fs.device, os.O_RDONLY)
+    try:
+        dst = os.open(destination, os.O_WRONLY)
+        try:
+            for start, length in extents:
+                offset = start
+                while offset < start + length:
+                    data = os.pread(src, min(CHUNK_SIZE, start + length - offset), offset)
+                    if not data:
+                        raise RuntimeError("Unexpected end of %s at offset %d" % (fs.device, offset))
+                    view = memoryview(data)
+                    while view:
+                        n = os.pwrite(dst, view, offset)
+                        view = view[n:]
+                        offset += n
+                    copied += len(data)
+                    progress_callback(copied, total)
+            os.fsync(dst)
+        finally:
+            os.close(dst)
+    finally:
+        os.close(src)
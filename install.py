@@ -4,7 +4,6 @@
 
 import sys
 import traceback
-import time
 import os.path
 import simplejson as json
 
@@ -184,8 +183,7 @@ def go(ui, args, answerfile_address, answerfile_script):
                         for r in repository.repositoriesFromDefinition(media, address, drivers=True):
                             r.installPackages(lambda x: (), {'root': '/'})
 
-                util.runCmd2(util.udevsettleCmd())
-                time.sleep(1)
+                diskutil.waitForBlockDevices(settle=True)
                 diskutil.mpath_part_scan()
 
                 # ensure partitions/disks are not locked by LVM
@@ -1,6 +1,7 @@
 # SPDX-License-Identifier: GPL-2.0-only
 
 import os
+import concurrent.futures
 
 import diskutil
 import util
@@ -600,20 +601,36 @@ def findXenSourceBackups():
     partitions = diskutil.getQualifiedPartitionList()
     backups = []
 
-    for p in partitions:
+    def probe(p):
+        # Backups are written to a freshly made, unlabelled, ext filesystem,
+        # so don't mount anything else
+        try:
+            label = diskutil.readExtSuperblockLabel(p)
+        except EnvironmentError:
+            return None
+        if label is None or label.startswith(constants.rootfs_label % '') or \
+                label.startswith(constants.logsfs_label_prefix):
+            return None
+
         b = None
+        backup = None
         try:
             b = util.TempMount(p, 'backup-', ['ro'])
             if os.path.exists(os.path.join(b.mount_point, '.xen-backup-partition')):
                 backup = XenServerBackup(p, b.mount_point)
-                logger.log("Found a backup: %s" % (repr(backup),))
-                if backup.version >= XENSERVER_MIN_VERSION and \
-                        backup.version <= THIS_PLATFORM_VERSION:
-                    backups.append(backup)
         except:
             pass
         if b:
             b.unmount()
+        return backup
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=constants.MAX_PROBE_WORKERS) as pool:
+        for backup in pool.map(probe, partitions):
+            if backup:
+                logger.log("Found a backup: %s" % (repr(backup),))
+                if backup.version >= XENSERVER_MIN_VERSION and \
+                        backup.version <= THIS_PLATFORM_VERSION:
+                    backups.append(backup)
 
     return backups
 
@@ -626,10 +643,11 @@ def findXenSourceProducts():
 
     installs = []
 
-    for disk_device in diskutil.getQualifiedDiskList():
+    disk_devices = diskutil.getQualifiedDiskList()
+    for disk_device, probe in zip(disk_devices, diskutil.probeDisks(disk_devices)):
         inst = None
         try:
-            disk = diskutil.probeDisk(disk_device)
+            disk = probe.result()
             if disk.root[0] == diskutil.INSTALL_RETAIL:
                 inst = ExistingRetailInstallation(disk_device, disk.boot[1], disk.root[1], disk.state[1], disk.storage)
         except Exception as e:
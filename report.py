@@ -88,11 +88,11 @@ def get_local_disk(answers):
     entries = []
     target_is_sr = {}
 
-    for de in diskEntries:
+    for de, probe in zip(diskEntries, diskutil.probeDisks(diskEntries)):
         (vendor, model, size) = diskutil.getExtendedDiskInfo(de)
         # determine current usage
         target_is_sr[de] = False
-        disk = diskutil.probeDisk(de)
+        disk = probe.result()
         if disk.storage[0]:
             target_is_sr[de] = True
         (vendor, model, size) = diskutil.getExtendedDiskInfo(de)
@@ -6,18 +6,22 @@ import glob
 import errno
 import hashlib
 import tempfile
-import urllib.request, urllib.parse
+import urllib.request, urllib.parse, urllib.error
 import ftplib
 import signal
 import subprocess
 import re
-import gzip
 import shutil
 import time
+import zlib
 from io import BytesIO
-from xml.dom.minidom import parse
+import concurrent.futures
+import threading
+import json
+from xml.etree import ElementTree
 
 import diskutil
+import generalui
 import hardware
 import version
 import util
@@ -48,6 +52,15 @@ class UnknownPackageType(Exception):
 class ErrorInstallingPackage(Exception):
     pass
 
+class PackageVerificationError(ErrorInstallingPackage):
+    """ Raised when packages fail verification as they are staged for
+    installation; problems is the same list Repository.check returns. """
+    def __init__(self, problems):
+        ErrorInstallingPackage.__init__(
+            self, "Some packages appeared damaged.  These were: %s" %
+            generalui.makeHumanList([p.name for p in problems]))
+        self.problems = problems
+
 class Repository(object):
     """ Represents a repository containing packages and associated meta data. """
     def __init__(self, accessor):
@@ -58,24 +71,30 @@ class Repository(object):
         return self._accessor
 
     def check(self, progress=lambda x: ()):
-        """ Return a list of problematic packages. """
-        def pkg_progress(start, end):
-            def progress_fn(x):
-                progress(start + ((x * (end - start)) / 100))
-            return progress_fn
-
+        """ Return a list of problematic packages, in repository order.
+        Packages are checked concurrently by as many workers as the
+        accessor supports, and progress is reported from the calling
+        thread. """
         self._accessor.start()
 
         try:
-            problems = []
-            total_size = sum((p.size for p in self._packages))
-            total_progress = 0
-            for p in self._packages:
-                start = (total_progress * 100) / total_size
-                end = ((total_progress + p.size) * 100) / total_size
-                if not p.check(False, pkg_progress(start, end)):
-                    problems.append(p)
-                total_progress += p.size
+            packages = list(self._packages)
+            total_size = sum((p.size for p in packages)) or 1
+            checked = [0] * len(packages)
+
+            def pkg_progress(i):
+                def progress_fn(x):
+                    checked[i] = (x * packages[i].size) / 100
+                return progress_fn
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self._accessor.checkWorkers()) as pool:
+                results = [pool.submit(p.check, False, pkg_progress(i)) for i, p in enumerate(packages)]
+                pending = results
+                while pending:
+                    _, pending = concurrent.futures.wait(pending, timeout=0.2)
+                    progress((sum(checked) * 100) / total_size)
+
+            problems = [p for p, result in zip(packages, results) if not result.result()]
         finally:
             self._accessor.finish()
         return problems
@@ -103,18 +122,105 @@ def _quoteDnfString(s):
     return '"' + s.replace('\\', '\\\\').replace('\"', '\\"') + '"'
 
 
+def _localName(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def _iterPrimaryPackages(fp, chunk_size=65536):
+    """ Yields the (location, size, sha256) of each package described by the
+    gzipped primary.xml read from fp.  The data is decompressed and parsed as
+    it is read, and each package element is discarded once it has been
+    handled, so memory use does not grow with the size of the repository. """
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    root = None
+    while True:
+        data = fp.read(chunk_size)
+        if data:
+            parser.feed(decompressor.decompress(data))
+        else:
+            parser.feed(decompressor.flush())
+            parser.close()
+
+        for event, elem in parser.read_events():
+            if event == 'start':
+                if root is None:
+                    root = elem
+                continue
+            if _localName(elem.tag) != 'package':
+                continue
+
+            location = size = checksum = None
+            for child in elem:
+                name = _localName(child.tag)
+                if name == 'location':
+                    location = child.get('href')
+                elif name == 'size':
+                    size = child.get('package')
+                elif name == 'checksum' and child.get('type') == 'sha256':
+                    checksum = child.text.strip()
+            if location and size and checksum:
+                yield location, size, checksum
+            else:
+                logger.log("Ignoring package %s without sha256 checksum" % location)
+            root.clear()
+
+        if not data:
+            break
+
+def _stageFile(accessor, name, destination, algorithm=None, checksum=None, progress=lambda x: ()):
+    """ Copies name from accessor to the same relative path under
+    destination, hashing it as it is written.  Returns whether the copy
+    matches checksum; a mismatching copy is removed. """
+    path = os.path.normpath(os.path.join(destination, name))
+    if not path.startswith(os.path.join(destination, '')):
+        logger.log("Refusing to stage %s outside %s" % (name, destination))
+        return False
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        m = hashlib.new({'sha': 'sha1'}.get(algorithm, algorithm)) if algorithm else None
+        fp = accessor.openAddress(name)
+        try:
+            with open(path + '.part', 'wb') as out:
+                total_read = 0
+                while True:
+                    data = fp.read(1048576)
+                    if not data:
+                        break
+                    if m:
+                        m.update(data)
+                    out.write(data)
+                    total_read += len(data)
+                    progress(total_read)
+        finally:
+            fp.close()
+
+        if m and m.hexdigest() != checksum:
+            logger.log("Checksum mismatch staging %s" % name)
+            os.unlink(path + '.part')
+            return False
+        os.rename(path + '.part', path)
+    except Exception as e:
+        logger.log("Failed to stage %s: %s" % (name, e))
+        return False
+    return True
+
 _yumRepositoryId = 1
+_yumRepositoryIdLock = threading.Lock()
 class YumRepository(Repository):
     """ Represents a Yum repository containing packages and associated meta data. """
     REPOMD_FILENAME = "repodata/repomd.xml"
     _cachedir = "var/cache/yum/installer"
     _targets = None
+    _repomd_checksum = None
+    _repodata = None
 
     def __init__(self, accessor):
         super(YumRepository, self).__init__(accessor)
         global _yumRepositoryId
-        self._identifier = "repo%d" % _yumRepositoryId
-        _yumRepositoryId += 1
+        with _yumRepositoryIdLock:
+            self._identifier = "repo%d" % _yumRepositoryId
+            _yumRepositoryId += 1
 
     @property
     def _yum_conf(self):
@@ -126,39 +232,72 @@ class YumRepository(Repository):
     def _parse_repodata(self, accessor):
         # Read packages from xml
         repomdfp = accessor.openAddress(self.REPOMD_FILENAME)
-        repomd_xml = parse(repomdfp)
+        repomd_data = repomdfp.read()
+        self._repomd_checksum = hashlib.sha256(repomd_data).hexdigest()
+        repomd_xml = xml.dom.minidom.parseString(repomd_data)
         xml_datas = repomd_xml.getElementsByTagName("data")
+        self._repodata = [(self.REPOMD_FILENAME, 'sha256', self._repomd_checksum)]
         for data_node in xml_datas:
             data = data_node.getAttribute("type")
+            location = data_node.getElementsByTagName("location")[0].getAttribute("href")
+            checksum = data_node.getElementsByTagName("checksum")[0]
+            self._repodata.append((location, checksum.getAttribute("type"),
+                                   getText(checksum.childNodes).decode()))
             if data == "primary":
-                primary_location = data_node.getElementsByTagName("location")
-                primary_location = primary_location[0].getAttribute("href")
+                primary_location = location
         repomdfp.close()
 
         primaryfp = accessor.openAddress(primary_location)
+        try:
+            self._packages = [RPMPackage(self, name, size, checksum)
+                              for name, size, checksum in _iterPrimaryPackages(primaryfp)]
+        finally:
+            primaryfp.close()
+
+    def canStage(self):
+        """ Return whether the repository should be copied locally before
+        installing from it. """
+        return self._repodata is not None and self._accessor.isRemote()
+
+    def stage(self, destination, progress=lambda x: (), packages=None):
+        """ Copies the meta data and packages (by default all of them) of the
+        repository into destination, verifying each file as it arrives, and
+        returns a list of the packages which could not be staged, in
+        repository order. """
+        self._accessor.start()
 
-        # HTTP&FTP accessors don't implement tell(): read xml using BytesIO to gunzip it
-        with BytesIO(primaryfp.read()) as fp, gzip.GzipFile("", "r", fileobj=fp) as xml:
-            dom = parse(xml)
-            package_names = dom.getElementsByTagName("location")
-            package_sizes = dom.getElementsByTagName("size")
-            package_checksums = dom.getElementsByTagName("checksum")
-
-        primaryfp.close()
-
-        # Filter using only sha256 checksum
-        sha256_checksums = [x for x in package_checksums if x.getAttribute("type") == "sha256"]
-
-        # After the filter, the list of checksums will have the same size
-        # of the list of names
-        self._packages = []
-        for name_node, size_node, checksum_node in zip(package_names, package_sizes, sha256_checksums):
-            name = name_node.getAttribute("href")
-            size = size_node.getAttribute("package")
-            checksum = checksum_node.childNodes[0]
-            pkg = RPMPackage(self, name, size, checksum.data)
-            pkg.type = 'rpm'
-            self._packages.append(pkg)
+        try:
+            repodata = list(self._repodata)
+            signature = self.REPOMD_FILENAME + '.asc'
+            if self._accessor.access(signature):
+                repodata.append((signature, None, None))
+            for name, algorithm, checksum in repodata:
+                if not _stageFile(self._accessor, name, destination, algorithm, checksum):
+                    raise ErrorInstallingPackage("Unable to stage %s from %s" % (name, self))
+
+            if packages is None:
+                packages = list(self._packages)
+            total_size = sum((p.size for p in packages)) or 1
+            staged = [0] * len(packages)
+
+            def pkg_progress(i):
+                def progress_fn(x):
+                    staged[i] = x
+                return progress_fn
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self._accessor.checkWorkers()) as pool:
+                results = [pool.submit(_stageFile, self._accessor, p.name, destination,
+                                       'sha256', p.sha256sum, pkg_progress(i))
+                           for i, p in enumerate(packages)]
+                pending = results
+                while pending:
+                    _, pending = concurrent.futures.wait(pending, timeout=0.2)
+                    progress((sum(staged) * 100) / total_size)
+
+            problems = [p for p, result in zip(packages, results) if not result.result()]
+        finally:
+            self._accessor.finish()
+        return problems
 
     def __repr__(self):
         return "%s@yum" % self._identifier
@@ -174,6 +313,12 @@ class YumRepository(Repository):
     def name(self):
         return self._identifier
 
+    def identity(self):
+        """ Returns a value identifying the contents of the repository, which
+        is the same for another Repository object of the same contents, in
+        this run of the installer or a later one. """
+        return (None, self._repomd_checksum)
+
     def __eq__(self, other):
         return self.identifier() == other.identifier()
 
@@ -184,9 +329,18 @@ class YumRepository(Repository):
         installed_repos[str(self)] = self
         return installed_repos
 
-    def _installPackages(self, progress_callback, mounts):
+    def _installPackages(self, progress_callback, mounts, verify):
         assert self._targets is not None
-        url = self._accessor.url()
+        # don't stage into the installer's own root, which is held in memory
+        if os.path.realpath(mounts['root']) != '/':
+            staging_dir = os.path.join(mounts['root'], STAGING_DIR)
+            urls, progress_callback = _stageRepositories([self], self._targets, mounts, staging_dir,
+                                                         progress_callback, verify)
+            url = urls[self]
+        else:
+            if verify and self.canStage():
+                progress_callback = _checkRepositories([self], progress_callback)
+            url = self._accessor.url()
         logger.log("URL: " + str(url))
         with open('/root/yum.conf', 'w') as yum_conf:
             yum_conf.write(self._yum_conf)
@@ -209,11 +363,15 @@ baseurl=%s
         installFromYum(self._targets, mounts, progress_callback, self._cachedir)
         self.enableInitrdCreation()
 
-    def installPackages(self, progress_callback, mounts):
+    def installPackages(self, progress_callback, mounts, verify=False):
+        """ Installs the packages of the repository into mounts['root'].  If
+        verify is set, the packages must be verified first, which is done as
+        they are staged where the repository can be. """
         self._accessor.start()
         try:
-            self._installPackages(progress_callback, mounts)
+            self._installPackages(progress_callback, mounts, verify)
         finally:
+            shutil.rmtree(os.path.join(mounts['root'], STAGING_DIR), ignore_errors=True)
             self._accessor.finish()
 
     def disableInitrdCreation(self, root):
@@ -329,6 +487,9 @@ gpgkey=file://%s
     def name(self):
         return self._product_data.get('brand', self._identifier)
 
+    def identity(self):
+        return (self._build_number, self._repomd_checksum)
+
     def disableInitrdCreation(self, root):
         # Speed up the install by disabling initrd creation.
         # It is created after the yum install phase.
@@ -445,12 +606,86 @@ baseurl=%s
 
         return False
 
+class VerificationCache(object):
+    """ Records the packages that have been verified, keyed by the identity
+    of their repository, their name, size and expected checksum, along with
+    a fingerprint of the file where the accessor can provide one.  The cache
+    is saved to the logs partition at the end of an installation, and read
+    back with loadFromDisk from the logs partition of the target before
+    packages are verified again. """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._loaded = set()
+
+    @staticmethod
+    def _key(pkg):
+        return json.dumps([pkg.repository.identity(), pkg.name, pkg.size, pkg.sha256sum])
+
+    def verified(self, pkg, fingerprint):
+        key = self._key(pkg)
+        with self._lock:
+            return key in self._entries and self._entries[key] == fingerprint
+
+    def add(self, pkg, fingerprint):
+        key = self._key(pkg)
+        with self._lock:
+            self._entries[key] = fingerprint
+
+    def load(self, path):
+        with open(path) as fh:
+            entries = json.load(fh)
+        with self._lock:
+            for key, fingerprint in entries.items():
+                self._entries.setdefault(key, fingerprint)
+
+    def save(self, path):
+        # without a fingerprint, there's no way to tell whether a file has
+        # changed by the next installation
+        with self._lock:
+            entries = dict((key, fingerprint) for key, fingerprint in self._entries.items()
+                           if fingerprint is not None)
+        if entries:
+            with open(path, 'w') as fh:
+                json.dump(entries, fh)
+
+    def loadFromDisk(self, disk):
+        """ Loads the cache saved on the logs partition of disk, if any. """
+        with self._lock:
+            if disk in self._loaded:
+                return
+            self._loaded.add(disk)
+
+        try:
+            logs = diskutil.probeDisk(disk).logs
+            if not logs[0]:
+                return
+            logs_fs = util.TempMount(logs[1], 'logs-', options=['ro'])
+            try:
+                log_location = os.path.join(logs_fs.mount_point, "installer")
+                if os.path.islink(log_location):
+                    log_location = os.path.join(logs_fs.mount_point, os.readlink(log_location).lstrip("/"))
+                path = os.path.join(log_location, VERIFICATION_CACHE_FILE)
+                if os.path.exists(path):
+                    logger.log("Loading verified packages from %s" % logs[1])
+                    self.load(path)
+            finally:
+                logs_fs.unmount()
+        except Exception as e:
+            logger.log("Unable to load verified packages from %s: %s" % (disk, e))
+
+verification_cache = VerificationCache()
+
 class RPMPackage(object):
+    __slots__ = ('repository', 'name', 'size', 'sha256sum', 'type')
+
     def __init__(self, repository, name, size, sha256sum):
         self.repository = repository
         self.name = name
         self.size = int(size)
         self.sha256sum = sha256sum
+        self.type = 'rpm'
 
     def check(self, fast=False, progress=lambda x : ()):
         """ Check a package against it's known checksum, or if fast is
@@ -459,6 +694,12 @@ class RPMPackage(object):
             return self.repository.accessor().access(self.name)
         else:
             try:
+                fingerprint = self.repository.accessor().fingerprint(self.name)
+                if verification_cache.verified(self, fingerprint):
+                    logger.log("Package %s already validated" % self.name)
+                    progress(100)
+                    return True
+
                 logger.log("Validating package %s" % self.name)
                 namefp = self.repository.accessor().openAddress(self.name)
                 m = hashlib.sha256()
@@ -475,15 +716,32 @@ class RPMPackage(object):
                 namefp.close()
                 calculated = m.hexdigest()
                 valid = (self.sha256sum == calculated)
+                if valid:
+                    verification_cache.add(self, fingerprint)
                 return valid
             except Exception as e:
                 return False
 
 class Accessor:
+    # number of packages to verify concurrently
+    CHECK_WORKERS = 1
+
     def pathjoin(base, name):
         return os.path.join(base, name)
     pathjoin = staticmethod(pathjoin)
 
+    def checkWorkers(self):
+        return self.CHECK_WORKERS
+
+    def fingerprint(self, name):
+        """ Returns a value which changes if the object 'name' is modified,
+        or None if the accessor cannot tell. """
+        return None
+
+    def isRemote(self):
+        """ Return whether objects are fetched over the network. """
+        return False
+
     def access(self, name):
         """ Return boolean determining where 'name' is an accessible object
         in the target. """
@@ -515,6 +773,8 @@ class Accessor:
             return DriverUpdateYumRepository(self)
 
 class FilesystemAccessor(Accessor):
+    CHECK_WORKERS = 4
+
     def __init__(self, location):
         self.location = location
 
@@ -527,6 +787,10 @@ class FilesystemAccessor(Accessor):
     def openAddress(self, addr):
         return open(os.path.join(self.location, addr), "rb")
 
+    def fingerprint(self, addr):
+        st = os.stat(os.path.join(self.location, addr))
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
     def url(self):
         return util.URL("file://%s" % self.location)
 
@@ -583,6 +847,12 @@ class DeviceAccessor(MountingAccessor):
     def __repr__(self):
         return "<DeviceAccessor: %s>" % self.device
 
+    def checkWorkers(self):
+        # Concurrent reads from optical or rotating media only add seeks.
+        if diskutil.isRotational(self.device):
+            return 1
+        return self.CHECK_WORKERS
+
     def canEject(self):
         return diskutil.removable(self.device)
 
@@ -602,13 +872,28 @@ class NFSAccessor(MountingAccessor):
     def __init__(self, nfspath):
         MountingAccessor.__init__(self, ['nfs'], nfspath, ['ro', 'tcp'])
 
+    def isRemote(self):
+        return True
+
 class URLFileWrapper:
-    "This wrapper emulate seek (forwards) for URL streams"
+    """This wrapper emulates seek for URL streams.  If the server supports
+    range requests, seeks (including backward ones) are done by requesting
+    the data from the new offset, otherwise only forward seeks are
+    supported, by reading and discarding data."""
     SEEK_SET = 0 # SEEK_CUR and SEEK_END not supported
+    # Forward seeks shorter than this read and discard data even when range
+    # requests are possible, as that is cheaper than a new request.
+    RANGE_SEEK_MIN = 100000
 
-    def __init__(self, delegate):
+    def __init__(self, delegate, reopen=None):
+        """ reopen, if given, is a function returning a new stream which
+        starts at the given offset. """
         self.delegate = delegate
         self.pos = 0
+        self.reopen = None
+        getheader = getattr(delegate, 'getheader', None)
+        if reopen and getheader and getheader('Accept-Ranges', '').strip().lower() == 'bytes':
+            self.reopen = reopen
 
     def __getattr__(self, name):
         return getattr(self.delegate, name)
@@ -618,15 +903,22 @@ class URLFileWrapper:
         self.pos += len(ret_val)
         return ret_val
 
+    def tell(self):
+        return self.pos
+
     def seek(self, offset, whence=0):
+        if whence != self.SEEK_SET:
+            raise Exception('Only SEEK_SET supported')
+
+        if self.reopen and (offset < self.pos or offset - self.pos > self.RANGE_SEEK_MIN):
+            self._rangeSeek(offset)
+            return
+
         consume = 0
-        if whence == self.SEEK_SET:
-            if offset >= self.pos:
-                consume = offset - self.pos
-            else:
-                raise Exception('Backward seek not supported')
+        if offset >= self.pos:
+            consume = offset - self.pos
         else:
-            raise Exception('Only SEEK_SET supported')
+            raise Exception('Backward seek not supported')
 
         if consume > 0:
             step = 100000
@@ -637,8 +929,30 @@ class URLFileWrapper:
             if len(self.read(consume)) != consume: # Discard data
                 raise IOError('Seek beyond end of file')
 
+    def _rangeSeek(self, offset):
+        self.delegate.close()
+        try:
+            self.delegate = self.reopen(offset)
+        except urllib.error.HTTPError as e:
+            # Range Not Satisfiable: the offset is at or beyond the end
+            content_range = e.headers and e.headers.get('Content-Range', '') or ''
+            if e.code != 416 or content_range != 'bytes */%d' % offset:
+                raise IOError('Seek beyond end of file')
+            self.delegate = BytesIO(b'')
+            self.pos = offset
+            return
+
+        if getattr(self.delegate, 'status', None) == 206:
+            self.pos = offset
+        else:
+            # The server ignored the range and sent the whole file.
+            self.pos = 0
+            self.reopen = None
+            self.seek(offset)
 
 class URLAccessor(Accessor):
+    CHECK_WORKERS = 4
+
     def __init__(self, url):
         self._url = url
 
@@ -646,16 +960,13 @@ class URLAccessor(Accessor):
             raise Exception('Unsupported URL scheme')
 
         if self._url.getScheme() in ['http', 'https']:
-            username = self._url.getUsername()
-            if username is not None:
+            if self._url.getUsername() is not None:
                 logger.log("Using basic HTTP authentication")
-                baseUrl = self._url.getBaseURL()
-                password = self._url.getPassword()
-                self.passman = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-                self.passman.add_password(None, baseUrl, username, password)
-                self.authhandler = urllib.request.HTTPBasicAuthHandler(self.passman)
-                self.opener = urllib.request.build_opener(self.authhandler)
-                urllib.request.install_opener(self.opener)
+
+        # idle FTP sessions, and directory listings mapping names to sizes
+        self._ftp_sessions = []
+        self._ftp_listings = {}
+        self._ftp_lock = threading.Lock()
 
         logger.log("Initializing URLRepositoryAccessor with base address %s" % str(self._url))
 
@@ -682,10 +993,30 @@ class URLAccessor(Accessor):
         pass
 
     def finish(self):
-        pass
+        with self._ftp_lock:
+            sessions, self._ftp_sessions = self._ftp_sessions, []
+            self._ftp_listings = {}
+        for ftp in sessions:
+            try:
+                ftp.quit()
+            except:
+                ftp.close()
+
+    def isRemote(self):
+        return self._url.getScheme() != 'file'
+
+    def _address(self, address):
+        return util.URL(self._url_concat(self._url.getURL(), address))
 
     def access(self, path):
-        if not self._url.getScheme == 'ftp':
+        if self._url.getScheme() in ['http', 'https']:
+            try:
+                util.httpRequest(self._address(path), method='HEAD').close()
+            except:
+                return False
+            return True
+
+        if self._url.getScheme() != 'ftp':
             return Accessor.access(self, path)
 
         url = self._url_concat(self._url.getPlainURL(), path)
@@ -696,25 +1027,87 @@ class URLAccessor(Accessor):
             (scheme, netloc, path, params, query) = urllib.parse.urlsplit(url)
             fname = os.path.basename(path)
             directory = self._url_decode(os.path.dirname(path[1:]))
-            hostname = self._url.getHostname()
-            username = self._url.getUsername()
-            password = self._url.getPassword()
-
-            # now open a connection to the server and verify that fname is in
-            ftp = ftplib.FTP(hostname)
-            ftp.login(username, password)
-            ftp.cwd(directory)
-            if ftp.size(fname) is not None:
+            listing, complete = self._ftpListing(directory)
+            if fname in listing:
                 return True
-            lst = ftp.nlst()
-            return fname in lst
+            if complete:
+                return False
+            # NLST listings may leave out names such as dotfiles
+            return self._ftpSize(os.path.join(directory, fname)) is not None
         except:
-            # couldn't parse the server name out:
             return False
 
+    def _ftpSession(self):
+        """ Returns an idle logged in FTP session, in the login directory. """
+        with self._ftp_lock:
+            if self._ftp_sessions:
+                ftp = self._ftp_sessions.pop()
+                try:
+                    ftp.cwd(ftp.home)
+                    return ftp
+                except:
+                    ftp.close()
+
+        ftp = ftplib.FTP()
+        ftp.connect(self._url.getHostname(), urllib.parse.urlsplit(self._url.getPlainURL()).port or ftplib.FTP_PORT)
+        ftp.login(self._url.getUsername() or '', self._url.getPassword() or '')
+        ftp.home = ftp.pwd()
+        return ftp
+
+    def _ftpListing(self, directory):
+        """ Returns a dictionary mapping the names in directory, relative to
+        the login directory, to their sizes (or None if not known), and
+        whether the listing is known to be complete. """
+        with self._ftp_lock:
+            if directory in self._ftp_listings:
+                return self._ftp_listings[directory]
+
+        ftp = self._ftpSession()
+        try:
+            try:
+                listing = {}
+                for name, facts in ftp.mlsd(directory, ['size']):
+                    listing[name] = int(facts['size']) if 'size' in facts else None
+                complete = True
+            except ftplib.error_perm:
+                # MLSD is not supported by older servers, and what NLST
+                # returns is up to the server
+                ftp.cwd(directory)
+                listing = dict((os.path.basename(name), None) for name in ftp.nlst())
+                complete = False
+        except:
+            ftp.close()
+            raise
+
+        with self._ftp_lock:
+            self._ftp_sessions.append(ftp)
+            self._ftp_listings[directory] = (listing, complete)
+        return listing, complete
+
+    def _ftpSize(self, path):
+        """ Returns the size of path, relative to the login directory, or None
+        if it doesn't exist. """
+        ftp = self._ftpSession()
+        try:
+            # some servers only report sizes in binary mode
+            ftp.voidcmd('TYPE I')
+            size = ftp.size(path)
+        except ftplib.error_perm:
+            size = None
+        except:
+            ftp.close()
+            raise
+
+        with self._ftp_lock:
+            self._ftp_sessions.append(ftp)
+        return size
+
     def openAddress(self, address):
         if self._url.getScheme() in ['http', 'https']:
-            ret_val = urllib.request.urlopen(self._url_concat(self._url.getPlainURL(), address))
+            url = self._address(address)
+            ret_val = util.httpRequest(url)
+            return URLFileWrapper(ret_val,
+                                  lambda offset: util.httpRequest(url, headers={'Range': 'bytes=%d-' % offset}))
         else:
             ret_val = urllib.request.urlopen(self._url_concat(self._url.getURL(), address))
         return URLFileWrapper(ret_val)
@@ -769,33 +1162,44 @@ def findRepositoriesOnMedia(drivers=False):
                 if dev not in parent_devices:
                     parent_devices.append(dev)
 
-    da = None
-    repos = []
-    try:
-        for check in parent_devices + partitions:
-            device_path = "/dev/%s" % check
-            logger.log("Looking for repositories: %s" % device_path)
-            if os.path.exists(device_path):
-                da = DeviceAccessor(device_path)
-                try:
-                    da.start()
-                except util.MountFailureException:
-                    da = None
-                    continue
-                else:
-                    if drivers:
-                        repo = da.findDriverRepository()
-                    else:
-                        repo = da.findRepository()
-                    if repo:
-                        repos.append(repo)
-                    da.finish()
-                    da = None
-    finally:
-        if da:
+    def probe(device_path, fs):
+        da = DeviceAccessor(device_path, fs)
+        try:
+            da.start()
+        except util.MountFailureException:
+            return None
+        try:
+            if drivers:
+                return da.findDriverRepository()
+            else:
+                return da.findRepository()
+        finally:
             da.finish()
 
-    return repos
+    # only mount devices with a filesystem which could hold a repository
+    candidates = []
+    for check in parent_devices + partitions:
+        device_path = "/dev/%s" % check
+        if not os.path.exists(device_path):
+            continue
+        try:
+            fs = diskutil.mediaFilesystem(device_path)
+        except OSError as e:
+            logger.log("Unable to read filesystem signature from %s: %s" % (device_path, e))
+            fs = ['iso9660', 'vfat', 'ext3']
+        else:
+            if fs is None:
+                continue
+            fs = [fs]
+        logger.log("Looking for repositories: %s" % device_path)
+        candidates.append((device_path, fs))
+
+    # checking for driver repositories writes /root/yum.conf, so is serial
+    workers = 1 if drivers else MAX_PROBE_WORKERS
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(lambda c: probe(*c), candidates))
+
+    return [repo for repo in results if repo]
 
 def installFromYum(targets, mounts, progress_callback, cachedir):
         dnf_cmd = ['dnf', '--releasever=/', '--config=/root/yum.conf',
@@ -859,44 +1263,150 @@ def installFromYum(targets, mounts, progress_callback, cachedir):
 
         shutil.rmtree(os.path.join(mounts['root'], cachedir), ignore_errors=True)
 
-def installFromRepos(progress_callback, repos, mounts):
-    """Install from a stacked set of repositories"""
-
-    cachedir = "var/cache/yum/installer"
+def _writeRepositories(yum_conf, repos, urls):
     for repo in repos:
-        repo._accessor.start()
-
-    try:
-        # Build a yum config
-        with open('/root/yum.conf', 'w') as yum_conf:
-            yum_conf.write(_generateYumConf(cachedir))
-            for repo in repos:
-                url = repo._accessor.url()
-                yum_conf.write("""
+        url = urls[repo]
+        yum_conf.write("""
 [%s]
 name=%s
 baseurl=%s
 """ % (repo.identifier(), repo.identifier(), url.getPlainURL()))
-                username = url.getUsername()
-                if username is not None:
-                    yum_conf.write("username=%s\n" % _quoteDnfString(username))
-                password = url.getPassword()
-                if password is not None:
-                    yum_conf.write("password=%s\n" % _quoteDnfString(password))
-                repo_config = repo._repo_config()
-                if repo_config is not None:
-                    yum_conf.write(repo_config)
+        username = url.getUsername()
+        if username is not None:
+            yum_conf.write("username=%s\n" % _quoteDnfString(username))
+        password = url.getPassword()
+        if password is not None:
+            yum_conf.write("password=%s\n" % _quoteDnfString(password))
+        repo_config = repo._repo_config()
+        if repo_config is not None:
+            yum_conf.write(repo_config)
+
+def _packageRow(pkg):
+    """ Returns the (name, arch, version-release, repository) dnf lists in
+    a transaction for pkg, assuming the usual file name. """
+    base = os.path.basename(pkg.name)
+    if base.endswith('.rpm'):
+        base = base[:-4]
+    nvr, _, arch = base.rpartition('.')
+    name, version, release = (nvr.rsplit('-', 2) + ['', ''])[:3]
+    return (name, arch, '%s-%s' % (version, release), pkg.repository.identifier())
+
+def _resolvePackages(repos, targets, mounts):
+    """ Returns a dictionary mapping each of repos to the list of its packages
+    which installing targets into mounts['root'] will need, or None if
+    that can't be worked out. """
+    cachedir = "var/cache/yum/installer"
+    with open('/root/yum-resolve.conf', 'w') as yum_conf:
+        yum_conf.write(_generateYumConf(cachedir))
+        _writeRepositories(yum_conf, repos, dict((repo, repo._accessor.url()) for repo in repos))
+
+    rv, out = util.runCmd2(['dnf', '--releasever=/', '--config=/root/yum-resolve.conf',
+                            '--installroot', mounts['root'], 'install', '--assumeno'] + targets,
+                           with_stdout=True)
+    shutil.rmtree(os.path.join(mounts['root'], cachedir), ignore_errors=True)
+
+    # Match the rows of the transaction table against the packages, with
+    # any line wrapping and epoch removed, and check that all were found
+    # against the summary.
+    tokens = out.split()
+    rows = set((tokens[i], tokens[i + 1], tokens[i + 2].split(':', 1)[-1], tokens[i + 3])
+               for i in range(len(tokens) - 3))
+    expected = sum(int(m.group(1)) for m in
+                   re.finditer(r'^\s*(?:Install|Installing:|Upgrade|Upgrading:)\s+(\d+)\s+[Pp]ackages?\s*$', out, re.M))
+    packages = dict((repo, [p for p in repo if _packageRow(p) in rows]) for repo in repos)
+    found = sum(len(pkgs) for pkgs in packages.values())
+    if found == 0 or found != expected:
+        logger.log("Found %d of %d packages to be installed (dnf exited with %d)" % (found, expected, rv))
+        return None
+    return packages
+
+def _freeSpace(path):
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+def _checkRepositories(repos, progress_callback):
+    """ Verifies the packages of repos in place, for when they were to be
+    verified as they were staged but can't be.  Returns the progress
+    callback for the installation itself: verification accounts for the
+    first half of progress. """
+    for i, repo in enumerate(repos):
+        logger.log("Verifying %s" % repo)
+        problems = repo.check(lambda x: progress_callback(int((i * 100 + x) * 50 / (len(repos) * 100))))
+        if problems:
+            raise PackageVerificationError(problems)
+    return lambda x: progress_callback(50 + x // 2)
+
+def _stageRepositories(repos, targets, mounts, staging_dir, progress_callback, verify=False):
+    """ Copies the packages of the remote repositories in repos which are
+    needed to install targets into staging_dir, so that dnf is not held up
+    by the network, verifying them as they arrive.  Returns a dictionary
+    mapping each repository to the URL dnf should use, and the progress
+    callback for the installation itself: staging accounts for the first
+    half of progress.  If verify is set and the repositories can't be
+    staged, they are verified in place instead. """
+    urls = dict((repo, repo._accessor.url()) for repo in repos)
+    staged = [repo for repo in repos if repo.canStage()]
+    if not staged:
+        return urls, progress_callback
+
+    packages = _resolvePackages(repos, targets, mounts)
+    if packages is None:
+        logger.log("Staging all packages")
+        packages = dict((repo, list(repo)) for repo in staged)
+
+    # the installed packages take at least as much space again
+    total_size = sum(sum(p.size for p in packages[repo]) for repo in staged)
+    free = _freeSpace(staging_dir)
+    if total_size * 2 > free:
+        logger.log("Not staging %d bytes of packages with %d bytes free" % (total_size, free))
+        if verify:
+            return urls, _checkRepositories(staged, progress_callback)
+        return urls, progress_callback
+
+    total_size = total_size or 1
+    done = 0
+    for repo in staged:
+        repo_size = sum(p.size for p in packages[repo])
+        destination = os.path.join(staging_dir, repo.identifier())
+        logger.log("Staging %d packages of %s into %s" % (len(packages[repo]), repo, destination))
+        problems = repo.stage(destination,
+                              lambda x: progress_callback(int(((done + x * repo_size / 100) * 50) / total_size)),
+                              packages[repo])
+        if problems:
+            raise PackageVerificationError(problems)
+        done += repo_size
+        urls[repo] = util.URL('file://' + destination)
+    return urls, lambda x: progress_callback(50 + x // 2)
+
+def installFromRepos(progress_callback, repos, mounts, verify=False):
+    """Install from a stacked set of repositories, verifying their packages
+    first if verify is set"""
 
+    cachedir = "var/cache/yum/installer"
+    staging_dir = os.path.join(mounts['root'], STAGING_DIR)
+    for repo in repos:
+        repo._accessor.start()
 
-        repos[0].disableInitrdCreation(mounts['root'])
+    try:
         targets = []
         for repo in repos:
             if repo._targets:
                 targets += repo._targets
         targets = list(set(targets))
 
-        installFromYum(targets, mounts, progress_callback, cachedir)
+        urls, install_progress = _stageRepositories(repos, targets, mounts, staging_dir, progress_callback, verify)
+
+        # Build a yum config
+        with open('/root/yum.conf', 'w') as yum_conf:
+            yum_conf.write(_generateYumConf(cachedir))
+            _writeRepositories(yum_conf, repos, urls)
+
+        repos[0].disableInitrdCreation(mounts['root'])
+        installFromYum(targets, mounts, install_progress, cachedir)
         repos[0].enableInitrdCreation()
     finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
         for repo in repos:
             repo._accessor.finish()
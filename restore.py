@@ -5,6 +5,8 @@ import product
 from disktools import *
 import diskutil
 import util
+import extimage
+import treecopy
 import os
 import os.path
 import constants
@@ -14,6 +16,21 @@ import shutil
 import xcp.bootloader as bootloader
 from xcp import logger
 
+def restoreImage(image, restore_partition, progress):
+    """ Copies the backup filesystem image to restore_partition, then gives
+    it an identity of its own and grows it to fill the partition. """
+    if util.runCmd2(['wipefs', '-a', restore_partition]) != 0:
+        raise RuntimeError("Failed to wipe %s" % restore_partition)
+    extimage.copyFilesystem(image, restore_partition, lambda copied, total: progress(copied * 90 / max(total, 1)))
+
+    # tune2fs and resize2fs require a freshly checked filesystem
+    if util.runCmd2(['e2fsck', '-f', '-p', restore_partition]) not in (0, 1):
+        raise RuntimeError("Restored root filesystem on %s is damaged" % restore_partition)
+    if util.runCmd2(['tune2fs', '-U', 'random', restore_partition]) != 0:
+        raise RuntimeError("Failed to set the UUID of the root filesystem")
+    if util.runCmd2(['resize2fs', restore_partition]) != 0:
+        raise RuntimeError("Failed to resize the root filesystem")
+
 def restoreFromBackup(backup, progress=lambda x: ()):
     """ Restore files from backup_partition to the root partition on disk.
     Call progress with a value between 0 and 100.  Re-install bootloader.  Fails if
@@ -67,13 +84,21 @@ def restoreFromBackup(backup, progress=lambda x: ()):
             raise RuntimeError("Backup uses grub bootloader which is no longer supported - " + \
                 "to restore please use a version of the installer that matches the backup partition")
 
-        # format the restore partition(s):
+        # copy the blocks in use by the backup to the restore partition if
+        # possible, which is quicker than copying files, else format it:
         restore_fs_type = diskutil.fs_type_from_device(backup_partition)
-        try:
-            util.mkfs(restore_fs_type, restore_partition)
-        except Exception as e:
-            logger.critical("Failed to create root filesystem", exc_info=1)
-            raise RuntimeError("Failed to create root filesystem: %s" % e)
+        image = extimage.readExtFilesystem(backup_partition)
+        if image is not None and extimage.deviceSize(restore_partition) < image.size:
+            logger.log("Not restoring as an image: %s is too small" % restore_partition)
+            image = None
+        if image is not None:
+            restoreImage(image, restore_partition, progress)
+        else:
+            try:
+                util.mkfs(restore_fs_type, restore_partition)
+            except Exception as e:
+                logger.critical("Failed to create root filesystem", exc_info=1)
+                raise RuntimeError("Failed to create root filesystem: %s" % e)
 
         # format the logs partition if the fs_type is changing
         logs_partition = partitionDevice(disk, logs_partnum)
@@ -94,20 +119,38 @@ def restoreFromBackup(backup, progress=lambda x: ()):
             mounts = {'root': dest_fs.mount_point,
                         'boot': os.path.join(dest_fs.mount_point, 'boot'),
                         'esp': os.path.join(dest_fs.mount_point, 'boot', 'efi')}
-            os.makedirs(mounts['esp'])
+            backup_files = ['.xen-backup-partition', '.xen-gpt.bin', '.xen-backup-manifest']
+            if image is not None:
+                # the root filesystem is now a copy of the backup, which holds
+                # these and the contents of the boot partition
+                for x in backup_files:
+                    if os.path.exists(os.path.join(dest_fs.mount_point, x)):
+                        os.unlink(os.path.join(dest_fs.mount_point, x))
+                util.assertDir(mounts['esp'])
+                for x in os.listdir(mounts['esp']):
+                    treecopy.removePath(os.path.join(mounts['esp'], x))
+                backup_root = os.path.join(backup_fs.mount_point, 'boot', 'efi')
+                objs = os.listdir(backup_root) if os.path.isdir(backup_root) else []
+                dest_root = mounts['esp']
+                start, scale = 90, 10
+            else:
+                os.makedirs(mounts['esp'])
+                backup_root = backup_fs.mount_point
+                objs = [x for x in os.listdir(backup_fs.mount_point) if x not in ['lost+found'] + backup_files]
+                dest_root = dest_fs.mount_point
+                start, scale = 0, 100
             util.mount(boot_device, mounts['esp'])
 
             # copy files from the backup partition to the restore partition:
-            objs = [x for x in os.listdir(backup_fs.mount_point) if x not in ['lost+found', '.xen-backup-partition', '.xen-gpt.bin']]
             for i in range(len(objs)):
                 obj = objs[i]
                 logger.log("Restoring subtree %s..." % obj)
-                progress((i * 100) / len(objs))
+                progress(start + (i * scale) / len(objs))
 
                 # Use 'cp' here because Python's copying tools are useless and
                 # get stuck in an infinite loop when copying e.g. /dev/null.
-                if util.runCmd2(['cp', '-a', os.path.join(backup_fs.mount_point, obj),
-                                 dest_fs.mount_point]) != 0:
+                if util.runCmd2(['cp', '-a', os.path.join(backup_root, obj),
+                                 dest_root]) != 0:
                     raise RuntimeError("Failed to restore %s directory" % obj)
 
             logger.log("Data restoration complete.  About to re-install bootloader.")
@@ -148,6 +191,7 @@ def restoreFromBackup(backup, progress=lambda x: ()):
                 diskutil.stopSWRAID(disk)
                 if util.runCmd2(assembleCommand) != 0:
                     raise RuntimeError("Failed to re-assemble SWRAID device: %s" % disk)
+                diskutil.refreshInventory()
 
                 dest_fs = util.TempMount(restore_partition, 'restore-dest-')
                 os.makedirs(mounts['esp'])
@@ -0,0 +1,274 @@
+""" Unit test module for disktools"""
+import hashlib
+import json
+import os
+import stat
+import os.path
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+import uuid
+import zlib
+
+from import_helper import mocked_modules
+from mock import patch, Mock
+
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), '..'))
+
+with mocked_modules("xcp", "xcp.logger", "version"):
+    import disktools
+
+FULLREPORT = {"report": [
+    {"vg": [{"vg_name": "VG_XenStorage-1"}],
+     "pv": [{"pv_name": "/dev/null", "vg_name": "VG_XenStorage-1", "pe_start": "1048576",
+             "pv_size": "4194304000", "pv_free": "0", "pv_pe_count": "1000", "dev_size": "4194304000"}],
+     "lv": [{"lv_name": "MGT", "vg_name": "VG_XenStorage-1"}],
+     "seg": [{"seg_pe_ranges": "/dev/null:0-999"}]},
+    {"vg": [{"vg_name": "#orphans_lvm2"}],
+     "pv": [{"pv_name": "/dev/missing", "vg_name": "#orphans_lvm2", "pe_start": "0",
+             "pv_size": "0", "pv_free": "0", "pv_pe_count": "0", "dev_size": "1024"}]},
+]}
+
+class TestLVMSnapshot(unittest.TestCase):
+    def setUp(self):
+        disktools.LVMTool.invalidateSnapshot()
+        self.addCleanup(disktools.LVMTool.invalidateSnapshot)
+
+    @patch.object(disktools.LVMTool, "cmdWrap")
+    def test_fullreport(self, cmdWrap):
+        cmdWrap.return_value = json.dumps(FULLREPORT)
+        tool = disktools.LVMTool()
+        self.assertEqual(cmdWrap.call_count, 1)
+        self.assertEqual(tool.vgs, [{"vg_name": "VG_XenStorage-1"}])
+        self.assertEqual(tool.lvs, [{"lv_name": "MGT", "vg_name": "VG_XenStorage-1"}])
+        self.assertEqual([pv["vg_name"] for pv in tool.pvs], ["VG_XenStorage-1", ""])
+        self.assertEqual(tool.deviceSize("/dev/null"), 4194304000)
+        self.assertTrue(tool.isPartitionSR("/dev/null"))
+        self.assertIsNone(tool.deviceToPVOrNone("/dev/zero"))
+
+        # instances share the cached report but not its records
+        tool.deviceToPV("/dev/null")["free-pool"] = None
+        other = disktools.LVMTool()
+        self.assertEqual(cmdWrap.call_count, 1)
+        self.assertNotIn("free-pool", other.deviceToPV("/dev/null"))
+
+        disktools.LVMTool.invalidateSnapshot()
+        disktools.LVMTool()
+        self.assertEqual(cmdWrap.call_count, 2)
+
+    @patch.object(disktools.LVMTool, "cmdWrap")
+    def test_fallback(self, cmdWrap):
+        def reply(cmd):
+            if cmd[1] == "fullreport":
+                raise Exception("unrecognised command")
+            if cmd[1] == "pvs":
+                return "  /dev/null#VG_XenConfig#0#4096#0#1#4096\n"
+            return ""
+        cmdWrap.side_effect = reply
+        tool = disktools.LVMTool()
+        self.assertEqual(cmdWrap.call_count, 5)
+        self.assertTrue(tool.isPartitionConfig("/dev/null"))
+
+class TestMovePlanner(unittest.TestCase):
+    def plan(self, *moves):
+        return [(m.src, m.dest, m.size) for m in
+                disktools.LVMTool.planMoves([disktools.MoveChunk(*m) for m in moves])]
+
+    def test_coalesce(self):
+        # consecutive moves become one pvmove
+        self.assertEqual(self.plan((100, 0, 4), (104, 4, 6), (110, 10, 2)), [(100, 0, 12)])
+        # unless the destinations are not consecutive
+        self.assertEqual(self.plan((100, 0, 4), (104, 20, 6)), [(100, 0, 4), (104, 20, 6)])
+
+    def test_no_overlap(self):
+        # merging would make the source range overlap the destination range
+        self.assertEqual(self.plan((10, 0, 10), (20, 10, 10)), [(10, 0, 10), (20, 10, 10)])
+
+    def test_chunk_size(self):
+        plan = self.plan((1000, 0, 1000))
+        self.assertEqual(len(plan), disktools.LVMTool.MOVE_PROGRESS_STEPS)
+        self.assertEqual(sum(size for _, _, size in plan), 1000)
+        self.assertEqual(plan[1], (1050, 50, 50))
+        # small moves are still made MOVE_MIN_EXTENTS at a time
+        self.assertEqual(self.plan((100, 0, 20)), [(100, 0, 16), (116, 16, 4)])
+
+@unittest.skipUnless(os.geteuid() == 0 and os.path.exists("/sbin/lvm"),
+                     "requires root and LVM to create loop devices")
+class TestLoopDeviceMoves(unittest.TestCase):
+    """Shrinks PVs on loop devices and checks the data and layout afterwards"""
+    EXTENT_MB = 4
+
+    def run_cmd(self, *cmd):
+        return subprocess.check_output(cmd, universal_newlines=True).strip()
+
+    def create_vg(self, index):
+        image = os.path.join(self.tmpdir.name, "pv%d.img" % index)
+        with open(image, "wb") as f:
+            f.truncate(64 * 2**20)
+        device = self.run_cmd("losetup", "--find", "--show", image)
+        self.addCleanup(self.run_cmd, "losetup", "-d", device)
+        vg = "VG_TestMoves%d_%d" % (os.getpid(), index)
+        self.run_cmd("vgcreate", "-s", "%dm" % self.EXTENT_MB, vg, device)
+        self.addCleanup(self.run_cmd, "vgremove", "-f", vg)
+        # leave a gap in the middle of the PV for the last LV to move to
+        sizes = [("first", 4), ("gap", 6), ("last", 3)]
+        for name, extents in sizes:
+            self.run_cmd("lvcreate", "-y", "-W", "n", "-Z", "n", "-n", name, "-l", str(extents), vg)
+        self.run_cmd("lvremove", "-f", "%s/gap" % vg)
+        for name, extents in sizes:
+            if name != "gap":
+                with open("/dev/mapper/%s-%s" % (vg, name), "r+b") as f:
+                    f.write(os.urandom(extents * self.EXTENT_MB * 2**20))
+        return device, vg
+
+    def checksums(self, vg):
+        rv = {}
+        for name in ["first", "last"]:
+            with open("/dev/mapper/%s-%s" % (vg, name), "rb") as f:
+                rv[name] = hashlib.sha256(f.read()).hexdigest()
+        return rv
+
+    def used_extents(self, tool, device):
+        return set(e for seg in tool.segmentList(device) for e in range(seg.start, seg.end()))
+
+    def test_shrink(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        vgs = [self.create_vg(i) for i in range(2)]
+        before = dict((vg, self.checksums(vg)) for _, vg in vgs)
+
+        disktools.LVMTool.invalidateSnapshot()
+        tool = disktools.LVMTool()
+        expected = {}
+        for device, _ in vgs:
+            tool.resizeDevice(device, 48 * 2**20)
+            moved = {}
+            for move in tool.moveLists[device]:
+                for i in range(move.size):
+                    moved[move.src + i] = move.dest + i
+            expected[device] = set(moved.get(e, e) for e in self.used_extents(tool, device))
+        tool.commit()
+
+        for device, vg in vgs:
+            self.run_cmd("vgchange", "-ay", vg)
+            self.assertEqual(self.checksums(vg), before[vg])
+            self.assertEqual(self.used_extents(tool, device), expected[device])
+            self.assertLessEqual(tool.deviceSize(device), 48 * 2**20)
+            self.run_cmd("vgchange", "-an", vg)
+
+def gpt_image(path, partitions, sector_size=512, corrupt=False):
+    """Writes a disk image with a protective MBR and primary GPT"""
+    entries = b""
+    for type_guid, part_guid, first, last, attributes, name in partitions:
+        entries += struct.pack("<16s16sQQQ72s", uuid.UUID(type_guid).bytes_le, uuid.UUID(part_guid).bytes_le,
+                               first, last, attributes, name.encode("utf-16-le"))
+    entries += b"\0" * (128 * 128 - len(entries))
+    header = struct.pack("<8s4sII4sQQQQ16sQIII", b"EFI PART", b"\0\0\1\0", 92, 0, b"\0" * 4,
+                         1, 2047, 34, 2014, uuid.uuid4().bytes_le, 2, 128, 128, zlib.crc32(entries))
+    header = header[:16] + struct.pack("<I", zlib.crc32(header)) + header[20:]
+    if corrupt:
+        entries = entries[:-1] + b"\1"
+    with open(path, "wb") as f:
+        f.truncate(2048 * sector_size)
+        f.seek(510)
+        f.write(b"\x55\xaa")
+        f.seek(sector_size)
+        f.write(header)
+        f.seek(2 * sector_size)
+        f.write(entries)
+
+class TestGPTReader(unittest.TestCase):
+    PARTUUID = "6A4D0CD6-9B5E-4C5D-8F2E-1A2B3C4D5E6F"
+
+    def tool(self, path):
+        tool = disktools.GPTPartitionTool.__new__(disktools.GPTPartitionTool)
+        tool.device = path
+        tool.sectorSize = 512
+        tool.sgdiskPartitionTable = Mock(return_value={})
+        return tool
+
+    def test_read(self):
+        with tempfile.NamedTemporaryFile() as f:
+            gpt_image(f.name, [
+                (disktools.GPTPartitionTool.ID_BIOS_BOOT, self.PARTUUID, 34, 2047, 1 << 2, "bios"),
+                (disktools.GPTPartitionTool.ID_LINUX, str(uuid.uuid4()), 2048, 4095, 1 << 62, ""),
+            ])
+            tool = self.tool(f.name)
+            partitions = tool.partitionTable()
+        self.assertFalse(tool.sgdiskPartitionTable.called)
+        self.assertEqual(sorted(partitions), [1, 2])
+        self.assertEqual(partitions[1], {
+            'start': 34, 'size': 2014, 'partlabel': 'bios', 'active': True, 'hidden': False,
+            'id': disktools.GPTPartitionTool.ID_BIOS_BOOT, 'partuuid': self.PARTUUID})
+        self.assertEqual(partitions[2]['id'], disktools.GPTPartitionTool.ID_LINUX)
+        self.assertTrue(partitions[2]['hidden'])
+        self.assertFalse(partitions[2]['active'])
+
+    def test_fallback(self):
+        with tempfile.NamedTemporaryFile() as f:
+            gpt_image(f.name, [(disktools.GPTPartitionTool.ID_LINUX, self.PARTUUID, 34, 2047, 0, "")],
+                      corrupt=True)
+            tool = self.tool(f.name)
+            tool.partitionTable()
+        self.assertTrue(tool.sgdiskPartitionTable.called)
+
+    def test_blank(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.truncate(2048 * 512)
+            tool = self.tool(f.name)
+            self.assertEqual(tool.partitionTable(), {})
+        self.assertFalse(tool.sgdiskPartitionTable.called)
+
+class TestPartitionToolRegistry(unittest.TestCase):
+    def setUp(self):
+        fake_stat = os.stat_result((stat.S_IFBLK | 0o600, 0, 0, 0, 0, 0, 0, 0, 0, 0), {"st_rdev": 0x800})
+        for target, kwargs in [
+                (patch.object(disktools.os, "stat"), {"return_value": fake_stat}),
+                (patch.object(disktools, "probePartitioningScheme"), {"return_value": disktools.constants.PARTITION_GPT}),
+                (patch.object(disktools.GPTPartitionTool, "readDiskDetails"), {}),
+                (patch.object(disktools.GPTPartitionTool, "partitionTable"), {"return_value": {1: {"start": 2048}}}),
+                (patch.object(disktools.GPTPartitionTool, "writeThisPartitionTable"), {}),
+                (patch.object(disktools.GPTPartitionTool, "waitForDeviceNodes"), {})]:
+            mock = target.start()
+            mock.configure_mock(**kwargs)
+            self.addCleanup(target.stop)
+        disktools.invalidatePartitionTool("/dev/sda")
+        self.addCleanup(disktools.invalidatePartitionTool, "/dev/sda")
+
+    def test_shared(self):
+        tool = disktools.PartitionTool("/dev/sda")
+        tool.partitions[1]["start"] = 4096
+        other = disktools.PartitionTool("/dev/disk/by-id/scsi-1")
+        self.assertEqual(disktools.GPTPartitionTool.partitionTable.call_count, 1)
+        self.assertEqual(disktools.probePartitioningScheme.call_count, 1)
+        self.assertEqual(other.getPartition(1), {"start": 2048})
+        self.assertEqual(other._partitionDevice(1), "/dev/disk/by-id/scsi-1-part1")
+
+    def test_invalidated_on_commit(self):
+        tool = disktools.PartitionTool("/dev/sda")
+        tool.commit()
+        disktools.PartitionTool("/dev/sda")
+        self.assertEqual(disktools.GPTPartitionTool.partitionTable.call_count, 2)
+
+@unittest.skipUnless(os.path.exists("/sys/class/block/loop0") and os.path.exists("/dev/loop0"),
+                     "needs a loop device")
+class TestDeviceGraph(unittest.TestCase):
+    def test_lookups(self):
+        disktools.invalidateDeviceGraph()
+        self.assertEqual(disktools.getSysfsDir("/dev/loop0"), "/sys/block/loop0")
+        self.assertEqual(disktools.getDeviceSlaves("/dev/loop0"), [])
+        self.assertFalse(disktools.hasDeviceMapperHolder("/dev/loop0"))
+        self.assertIsNone(disktools.getMpathMaster("/dev/loop0"))
+        self.assertRaises(RuntimeError, disktools.getSysfsDir, "/dev/null")
+
+    def test_rebuilt_after_changes(self):
+        graph = disktools.getDeviceGraph()
+        self.assertIs(disktools.getDeviceGraph(), graph)
+        disktools.invalidateDeviceGraph()
+        rebuilt = disktools.getDeviceGraph()
+        self.assertIsNot(rebuilt, graph)
+        with patch("os.stat"):
+            disktools.invalidatePartitionTool("/dev/loop0")
+        self.assertIsNot(disktools.getDeviceGraph(), rebuilt)
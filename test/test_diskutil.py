@@ -0,0 +1,146 @@
+""" Unit test module for diskutil"""
+import os.path
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+from mock import patch, Mock
+
+from import_helper import mocked_modules
+
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), '..'))
+
+with mocked_modules("xcp", "xcp.logger", "version", "snackutil", "disktools", "netutil"):
+    import diskutil
+
+class TestMediaFilesystem(unittest.TestCase):
+    def image(self, *fields):
+        f = tempfile.NamedTemporaryFile()
+        f.write(b"\0" * 65536)
+        for offset, data in fields:
+            f.seek(offset)
+            f.write(data)
+        f.flush()
+        self.addCleanup(f.close)
+        return f.name
+
+    def test_signatures(self):
+        self.assertEqual(diskutil.mediaFilesystem(self.image((32769, b"CD001"))), "iso9660")
+        self.assertEqual(diskutil.mediaFilesystem(self.image((54, b"FAT16   "), (510, b"\x55\xaa"))), "vfat")
+        self.assertEqual(diskutil.mediaFilesystem(self.image((82, b"FAT32   "), (510, b"\x55\xaa"))), "vfat")
+        self.assertEqual(diskutil.mediaFilesystem(self.image((1080, struct.pack("<H", 0xEF53)))), "ext3")
+
+    def test_ext_label(self):
+        magic = (1080, struct.pack("<H", 0xEF53))
+        self.assertEqual(diskutil.readExtSuperblockLabel(self.image(magic, (1144, b"logs-abc\0"))), "logs-abc")
+        self.assertEqual(diskutil.readExtSuperblockLabel(self.image(magic)), "")
+        self.assertEqual(diskutil.readExtPartitionLabel(self.image(magic, (1144, b"root-0123456789ab"))),
+                         "root-0123456789a")
+        self.assertIsNone(diskutil.readExtSuperblockLabel(self.image((1144, b"root-abc"))))
+        self.assertRaises(Exception, diskutil.readExtPartitionLabel, self.image())
+        self.assertRaises(Exception, diskutil.readExtPartitionLabel, "/nonexistent")
+
+    def test_no_signature(self):
+        # a partition table also ends with 0x55AA
+        self.assertIsNone(diskutil.mediaFilesystem(self.image((510, b"\x55\xaa"))))
+        self.assertIsNone(diskutil.mediaFilesystem(self.image()))
+        with tempfile.NamedTemporaryFile() as f:
+            self.assertIsNone(diskutil.mediaFilesystem(f.name))
+
+@unittest.skipUnless(os.path.exists("/sys/class/block/loop0"), "needs a loop device")
+class TestDiskInventory(unittest.TestCase):
+    def setUp(self):
+        patcher = patch.object(diskutil, "partitionTableGeneration", create=True, return_value=0)
+        self.generation = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(diskutil, "_inventory", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lookup(self):
+        with open("/sys/class/block/loop0/size") as f:
+            size = int(f.read())
+        inventory = diskutil.getInventory()
+        self.assertIs(inventory.lookup("loop0"), inventory.lookup("/dev/loop0"))
+        self.assertEqual(diskutil.getDiskDeviceSize("/dev/loop0"), size)
+        self.assertIsNone(inventory.lookup("/dev/nonexistent"))
+        self.assertEqual(diskutil.getDiskDeviceSize("nonexistent"), 0)
+        self.assertRaises(Exception, diskutil.getDiskBlockSize, "nonexistent")
+
+    def test_refresh_on_partition_change(self):
+        inventory = diskutil.getInventory()
+        byName = inventory.byName
+        inventory.lookup("loop0")
+        self.assertIs(inventory.byName, byName)
+        self.generation.return_value = 1
+        inventory.lookup("loop0")
+        self.assertIsNot(inventory.byName, byName)
+
+    def test_physical(self):
+        def record(name, devnum, dm_uuid=None, slaves=()):
+            dev = Mock(spec=diskutil.BlockDevice)
+            dev.name, dev.devnum, dev.dm_uuid, dev.slaves = name, devnum, dm_uuid, list(slaves)
+            return dev
+        # a partition of a multipath device, on two paths
+        part = record("dm-1", 1, "part1-mpath-X", ["dm-0"])
+        mpath = record("dm-0", 0, "mpath-X", ["sdb", "sdc"])
+        sdb, sdc = record("sdb", 16), record("sdc", 32)
+        inventory = diskutil.DiskInventory.__new__(diskutil.DiskInventory)
+        inventory.byName = dict((r.name, r) for r in [part, mpath, sdb, sdc])
+        with patch.object(inventory, "lookup", side_effect=lambda dev: inventory.byName.get(dev)):
+            self.assertIs(inventory.physical("dm-1"), sdb)
+            self.assertIs(inventory.physical("dm-0"), sdb)
+            self.assertIs(inventory.physical("sdc"), sdc)
+
+            # a loop in the device graph doesn't hang
+            mpath.slaves = ["dm-1"]
+            self.assertIsNone(inventory.physical("dm-1"))
+
+class TestSerialNumbers(unittest.TestCase):
+    def record(self, serial=None):
+        record = Mock(spec=diskutil.BlockDevice)
+        record.name = "nonexistent"
+        record.devnum = os.makedev(259, 999)
+        record.serial = serial
+        return record
+
+    def test_sources(self):
+        self.assertEqual(diskutil._readSerialNumber(self.record("SYSFS")), "SYSFS")
+        with patch.object(diskutil.util, "readUdevProperties", return_value={"ID_SERIAL_SHORT": "UDEV"}):
+            self.assertEqual(diskutil._readSerialNumber(self.record()), "UDEV")
+        with patch.object(diskutil.util, "readUdevProperties", return_value={}), \
+                patch.object(diskutil.util, "runCmd2", return_value=(0, "\n    SDPARM\n")):
+            self.assertEqual(diskutil._readSerialNumber(self.record()), "SDPARM")
+        with patch.object(diskutil.util, "readUdevProperties", return_value={}), \
+                patch.object(diskutil.util, "runCmd2", side_effect=subprocess.TimeoutExpired("sdparm", 5)):
+            self.assertEqual(diskutil._readSerialNumber(self.record()), "")
+
+    def test_cached(self):
+        record = self.record()
+        inventory = Mock()
+        inventory.physical.return_value = record
+        record.md = False
+        reader = Mock(return_value="S1")
+        with patch.object(diskutil, "getInventory", return_value=inventory), \
+                patch.object(diskutil, "_readSerialNumber", reader), \
+                patch.object(diskutil, "_serialNumbers", {}):
+            diskutil.prefetchDiskSerialNumbers(["a"])
+            self.assertEqual(diskutil.getDiskSerialNumbers(["a", "b"]), {"a": "S1", "b": "S1"})
+            self.assertEqual(diskutil.getDiskSerialNumber("a"), "S1")
+        reader.assert_called_once_with(record)
+
+class TestProbeDisks(unittest.TestCase):
+    def test_order_and_errors(self):
+        lv_tool = Mock()
+        def probe(device, tool):
+            self.assertIs(tool, lv_tool)
+            if device == "/dev/sdb":
+                raise Exception("unreadable")
+            return device.upper()
+        with patch.object(diskutil, "LVMTool", create=True, return_value=lv_tool), \
+                patch.object(diskutil, "probeDisk", side_effect=probe):
+            probes = diskutil.probeDisks(["/dev/sda", "/dev/sdb", "/dev/sdc"])
+        self.assertEqual(probes[0].result(), "/DEV/SDA")
+        self.assertRaises(Exception, probes[1].result)
+        self.assertEqual(probes[2].result(), "/DEV/SDC")
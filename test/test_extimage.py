@@ -0,0 +1,76 @@
+""" Unit test module for extimage"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from import_helper import mocked_modules
+
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), '..'))
+
+with mocked_modules("xcp", "xcp.logger"):
+    import extimage
+
+@unittest.skipUnless(shutil.which("mke2fs") and shutil.which("e2fsck") and shutil.which("debugfs"),
+                     "needs e2fsprogs")
+class TestExtImage(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.root = os.path.join(self.tmp, "root")
+        os.makedirs(os.path.join(self.root, "usr", "lib"))
+        self.files = {}
+        for i in range(200):
+            self.files["usr/lib/file%d" % i] = os.urandom(i * 97)
+        self.files["big"] = os.urandom(3 * 2**20)
+        for path, data in self.files.items():
+            with open(os.path.join(self.root, path), "wb") as f:
+                f.write(data)
+
+    def image(self, name, size, fill=b"\0"):
+        path = os.path.join(self.tmp, name)
+        with open(path, "wb") as f:
+            for _ in range(size // 2**20):
+                f.write(fill * 2**20)
+        return path
+
+    def mkfs(self, *options):
+        src = self.image("src", 64 * 2**20)
+        subprocess.check_call(["mke2fs", "-q", "-F", "-d", self.root] + list(options) + [src])
+        return src
+
+    def check_copy(self, src):
+        fs = extimage.readExtFilesystem(src)
+        self.assertIsNotNone(fs)
+        dst = self.image("dst", 64 * 2**20, b"\xa5")
+        progress = []
+        extimage.copyFilesystem(fs, dst, lambda copied, total: progress.append((copied, total)))
+        copied, total = progress[-1]
+        self.assertEqual(copied, total)
+        self.assertLess(total, fs.size / 2)
+
+        subprocess.check_call(["e2fsck", "-fn", dst], stdout=subprocess.DEVNULL)
+        for path, data in self.files.items():
+            out = subprocess.check_output(["debugfs", "-R", "cat /" + path, dst], stderr=subprocess.DEVNULL)
+            self.assertEqual(out, data, path)
+
+    def test_ext4(self):
+        self.check_copy(self.mkfs("-t", "ext4"))
+
+    def test_ext4_64bit_1k_blocks(self):
+        self.check_copy(self.mkfs("-t", "ext4", "-b", "1024", "-O", "64bit,^metadata_csum,uninit_bg"))
+
+    def test_ext3(self):
+        self.check_copy(self.mkfs("-t", "ext3"))
+
+    def test_unsupported(self):
+        self.assertIsNone(extimage.readExtFilesystem(self.image("zero", 2**20)))
+        src = self.mkfs("-t", "ext4")
+        with open(src, "r+b") as f:
+            # not cleanly unmounted
+            f.seek(1024 + 0x3A)
+            f.write(b"\0\0")
+        self.assertIsNone(extimage.readExtFilesystem(src))
@@ -0,0 +1,278 @@
+""" Unit test module for repository"""
+import gzip
+import hashlib
+import io
+import os.path
+import sys
+import tempfile
+import ftplib
+import unittest
+
+from mock import Mock, patch
+
+from import_helper import mocked_modules
+
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), '..'))
+
+with mocked_modules("xcp", "xcp.version", "xcp.logger", "version", "diskutil", "hardware"):
+    import repository
+    import util
+
+PRIMARY_XML = b"""<?xml version="1.0" encoding="UTF-8"?>
+<metadata xmlns="http://linux.duke.edu/metadata/common" xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="3">
+<package type="rpm">
+  <name>bash</name>
+  <checksum type="sha256" pkgid="YES">%s</checksum>
+  <size package="1000" installed="4000" archive="4100"/>
+  <location href="Packages/bash-5.1-1.x86_64.rpm"/>
+  <format><rpm:license>GPLv3+</rpm:license></format>
+</package>
+<package type="rpm">
+  <name>old</name>
+  <checksum type="sha" pkgid="YES">0123456789abcdef0123456789abcdef01234567</checksum>
+  <size package="10" installed="40" archive="41"/>
+  <location href="Packages/old-1.0-1.noarch.rpm"/>
+</package>
+<package type="rpm">
+  <name>zlib</name>
+  <location href="Packages/zlib-1.2-1.x86_64.rpm"/>
+  <size package="2000" installed="8000" archive="8100"/>
+  <checksum type="sha256" pkgid="YES">%s</checksum>
+</package>
+</metadata>
+""" % (b"a" * 64, b"b" * 64)
+
+class TestPrimaryParser(unittest.TestCase):
+    def test_packages(self):
+        fp = io.BytesIO(gzip.compress(PRIMARY_XML))
+        # a small chunk size exercises elements split across reads
+        packages = list(repository._iterPrimaryPackages(fp, chunk_size=17))
+        self.assertEqual(packages, [
+            ("Packages/bash-5.1-1.x86_64.rpm", "1000", "a" * 64),
+            ("Packages/zlib-1.2-1.x86_64.rpm", "2000", "b" * 64),
+        ])
+
+    def test_records(self):
+        pkg = repository.RPMPackage(None, "Packages/zlib-1.2-1.x86_64.rpm", "2000", "b" * 64)
+        self.assertEqual(pkg.size, 2000)
+        self.assertEqual(pkg.type, 'rpm')
+        self.assertFalse(hasattr(pkg, '__dict__'))
+
+class TestCheck(unittest.TestCase):
+    def test_problems_in_order(self):
+        with tempfile.TemporaryDirectory() as location:
+            repo = repository.YumRepository(repository.FilesystemAccessor(location))
+            repo._packages = []
+            for i in range(20):
+                name = "pkg%02d.rpm" % i
+                data = b"x" * (i * 1000 + 1)
+                with open(os.path.join(location, name), "wb") as f:
+                    f.write(data)
+                checksum = hashlib.sha256(data).hexdigest()
+                if i % 7 == 3:
+                    checksum = "0" * 64
+                repo._packages.append(repository.RPMPackage(repo, name, len(data), checksum))
+            os.unlink(os.path.join(location, "pkg05.rpm"))
+
+            progress = []
+            problems = repo.check(progress.append)
+
+        self.assertEqual([p.name for p in problems],
+                         ["pkg03.rpm", "pkg05.rpm", "pkg10.rpm", "pkg17.rpm"])
+        self.assertEqual(progress, sorted(progress))
+
+class TestStage(unittest.TestCase):
+    def test_stage(self):
+        with tempfile.TemporaryDirectory() as location, tempfile.TemporaryDirectory() as target:
+            repo = repository.YumRepository(repository.FilesystemAccessor(location))
+            os.makedirs(os.path.join(location, "repodata"))
+            os.makedirs(os.path.join(location, "Packages"))
+            with open(os.path.join(location, "repodata", "repomd.xml"), "wb") as f:
+                f.write(b"<repomd/>")
+            repo._repodata = [("repodata/repomd.xml", "sha256", hashlib.sha256(b"<repomd/>").hexdigest())]
+            repo._packages = []
+            for name, data, checksum in [("Packages/good.rpm", b"good", None),
+                                         ("Packages/bad.rpm", b"bad", "0" * 64),
+                                         ("../escape.rpm", b"escape", None)]:
+                with open(os.path.normpath(os.path.join(location, name)), "wb") as f:
+                    f.write(data)
+                checksum = checksum or hashlib.sha256(data).hexdigest()
+                repo._packages.append(repository.RPMPackage(repo, name, len(data), checksum))
+
+            destination = os.path.join(target, "repo1")
+            progress = []
+            problems = repo.stage(destination, progress.append)
+
+            self.assertEqual([p.name for p in problems], ["Packages/bad.rpm", "../escape.rpm"])
+            self.assertEqual(sorted(os.listdir(os.path.join(destination, "Packages"))), ["good.rpm"])
+            self.assertTrue(os.path.exists(os.path.join(destination, "repodata", "repomd.xml")))
+            self.assertFalse(os.path.exists(os.path.join(target, "escape.rpm")))
+            self.assertEqual(progress, sorted(progress))
+
+        error = repository.PackageVerificationError(problems)
+        self.assertEqual(error.problems, problems)
+        self.assertIn("Packages/bad.rpm and ../escape.rpm", str(error))
+
+class TestResolvePackages(unittest.TestCase):
+    DNF_OUTPUT = """Dependencies resolved.
+================================================================================
+ Package                       Arch     Version           Repository      Size
+================================================================================
+Installing group/module packages:
+ bash                          x86_64   5.1-1.xs8         repo1          1.8 M
+Installing dependencies:
+ a-package-with-a-very-long-name-indeed
+                               noarch   1:2.0-3           repo1           10 k
+
+Transaction Summary
+================================================================================
+Install  2 Packages
+
+Total download size: 1.8 M
+Operation aborted.
+"""
+
+    def test_resolve(self):
+        with tempfile.TemporaryDirectory() as location:
+            repo = repository.YumRepository(repository.FilesystemAccessor(location))
+            repo._identifier = "repo1"
+            repo._packages = [repository.RPMPackage(repo, "Packages/" + name, 10, "0" * 64)
+                              for name in ["bash-5.1-1.xs8.x86_64.rpm",
+                                           "a-package-with-a-very-long-name-indeed-2.0-3.noarch.rpm",
+                                           "zsh-5.8-1.xs8.x86_64.rpm"]]
+            with patch("builtins.open"), \
+                 patch("repository.util.runCmd2", return_value=(1, self.DNF_OUTPUT)):
+                packages = repository._resolvePackages([repo], ["@group"], {"root": location})
+            self.assertEqual([p.name for p in packages[repo]],
+                             ["Packages/bash-5.1-1.xs8.x86_64.rpm",
+                              "Packages/a-package-with-a-very-long-name-indeed-2.0-3.noarch.rpm"])
+
+            # everything is staged unless all the packages are found
+            with patch("builtins.open"), \
+                 patch("repository.util.runCmd2", return_value=(1, self.DNF_OUTPUT.replace("Install  2", "Install  3"))):
+                self.assertIsNone(repository._resolvePackages([repo], ["@group"], {"root": location}))
+
+class TestStageLowSpace(unittest.TestCase):
+    def setUp(self):
+        self.location = tempfile.TemporaryDirectory()
+        self.addCleanup(self.location.cleanup)
+        self.repo = repository.YumRepository(repository.FilesystemAccessor(self.location.name))
+        self.repo._packages = [repository.RPMPackage(self.repo, "Packages/pkg.rpm", 1000, "0" * 64)]
+        for target in [patch.object(self.repo, "canStage", return_value=True),
+                       patch.object(repository, "_resolvePackages", return_value=None),
+                       patch.object(repository, "_freeSpace", return_value=1500)]:
+            target.start()
+            self.addCleanup(target.stop)
+
+    def stage(self, verify):
+        return repository._stageRepositories([self.repo], [], {"root": self.location.name},
+                                             os.path.join(self.location.name, "staging"),
+                                             lambda x: None, verify)
+
+    def test_not_verified(self):
+        with patch.object(self.repo, "check") as check:
+            urls, _ = self.stage(False)
+        self.assertEqual(str(urls[self.repo]), str(self.repo.accessor().url()))
+        check.assert_not_called()
+
+    def test_verified_in_place(self):
+        with patch.object(self.repo, "check", return_value=[]) as check:
+            urls, _ = self.stage(True)
+        self.assertEqual(str(urls[self.repo]), str(self.repo.accessor().url()))
+        check.assert_called_once()
+
+        with patch.object(self.repo, "check", return_value=self.repo._packages):
+            self.assertRaises(repository.PackageVerificationError, self.stage, True)
+
+class TestVerificationCache(unittest.TestCase):
+    def test_fingerprint(self):
+        with tempfile.TemporaryDirectory() as location:
+            repo = repository.YumRepository(repository.FilesystemAccessor(location))
+            path = os.path.join(location, "pkg.rpm")
+            with open(path, "wb") as f:
+                f.write(b"data")
+            pkg = repository.RPMPackage(repo, "pkg.rpm", 4, hashlib.sha256(b"data").hexdigest())
+            self.assertTrue(pkg.check())
+
+            cache = repository.VerificationCache()
+            repository.verification_cache.save(os.path.join(location, "cache.json"))
+            cache.load(os.path.join(location, "cache.json"))
+            self.assertTrue(cache.verified(pkg, repo.accessor().fingerprint("pkg.rpm")))
+
+            # the same repository found again, e.g. by a later installer run
+            again = repository.YumRepository(repository.FilesystemAccessor(location))
+            pkg_again = repository.RPMPackage(again, "pkg.rpm", 4, pkg.sha256sum)
+            self.assertTrue(cache.verified(pkg_again, again.accessor().fingerprint("pkg.rpm")))
+
+            # a modified file no longer matches its fingerprint
+            with open(path, "wb") as f:
+                f.write(b"DATA!")
+            self.assertFalse(cache.verified(pkg, repo.accessor().fingerprint("pkg.rpm")))
+            self.assertFalse(pkg.check())
+
+    def test_unfingerprinted_not_saved(self):
+        with tempfile.TemporaryDirectory() as location:
+            repo = repository.YumRepository(repository.FilesystemAccessor(location))
+            cache = repository.VerificationCache()
+            cache.add(repository.RPMPackage(repo, "pkg.rpm", 4, "0" * 64), None)
+            cache.save(os.path.join(location, "cache.json"))
+            self.assertFalse(os.path.exists(os.path.join(location, "cache.json")))
+
+class FakeResponse(io.BytesIO):
+    def __init__(self, data, status=200, ranges=True):
+        super().__init__(data)
+        self.status = status
+        self.headers = {'Accept-Ranges': 'bytes'} if ranges else {}
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+class TestFTPAccess(unittest.TestCase):
+    def test_nlst_fallback(self):
+        ftp = Mock()
+        ftp.pwd.return_value = "/"
+        ftp.mlsd.side_effect = ftplib.error_perm("500 Unknown command")
+        ftp.nlst.return_value = ["repodata"]
+        def size(path):
+            if path != "os/.treeinfo":
+                raise ftplib.error_perm("550 No such file")
+            return 10
+        ftp.size.side_effect = size
+        with patch("ftplib.FTP", return_value=ftp):
+            accessor = repository.URLAccessor(util.URL("ftp://server/"))
+            self.assertTrue(accessor.access("os/repodata"))
+            # dotfiles are missing from NLST listings
+            self.assertTrue(accessor.access("os/.treeinfo"))
+            self.assertFalse(accessor.access("os/missing"))
+
+class TestURLFileWrapper(unittest.TestCase):
+    DATA = bytes(range(256)) * 4000
+
+    def setUp(self):
+        self.requests = []
+
+    def reopen(self, offset):
+        self.requests.append(offset)
+        return FakeResponse(self.DATA[offset:], status=206)
+
+    def test_range_seeks(self):
+        f = repository.URLFileWrapper(FakeResponse(self.DATA), self.reopen)
+        f.seek(500000)
+        self.assertEqual(f.read(4), self.DATA[500000:500004])
+        f.seek(10)
+        self.assertEqual(f.tell(), 10)
+        self.assertEqual(f.read(4), self.DATA[10:14])
+        # short forward seeks read and discard instead
+        f.seek(1000)
+        self.assertEqual(f.read(4), self.DATA[1000:1004])
+        self.assertEqual(self.requests, [500000, 10])
+
+    def test_no_ranges(self):
+        f = repository.URLFileWrapper(FakeResponse(self.DATA, ranges=False), self.reopen)
+        f.seek(500000)
+        self.assertEqual(f.read(4), self.DATA[500000:500004])
+        self.assertRaises(Exception, f.seek, 10)
+        self.assertEqual(self.requests, [])
+
+if __name__ == '__main__':
+    unittest.main()
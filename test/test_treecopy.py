@@ -0,0 +1,117 @@
+""" Unit test module for treecopy"""
+import os
+import stat
+import sys
+import tempfile
+import unittest
+
+from import_helper import mocked_modules
+
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), '..'))
+
+with mocked_modules("xcp", "xcp.logger", "version"):
+    import treecopy
+
+class TestTreeCopier(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.src = os.path.join(tmp.name, "src")
+        self.dst = os.path.join(tmp.name, "dst")
+        os.makedirs(os.path.join(self.src, "usr", "bin"))
+        os.mkdir(self.dst)
+
+    def write(self, path, data, mode=0o644):
+        path = os.path.join(self.src, path)
+        with open(path, "wb") as f:
+            f.write(data)
+        os.chmod(path, mode)
+        return path
+
+    def test_copy(self):
+        self.write("usr/bin/tool", b"#!/bin/sh\n", 0o4755)
+        os.link(os.path.join(self.src, "usr/bin/tool"), os.path.join(self.src, "usr/bin/alias"))
+        os.symlink("tool", os.path.join(self.src, "usr/bin/link"))
+        os.mkfifo(os.path.join(self.src, "usr/fifo"))
+        sparse = self.write("usr/sparse", b"")
+        with open(sparse, "r+b") as f:
+            f.seek(8 * 2**20)
+            f.write(b"end")
+        big = self.write("usr/big", os.urandom(3 * treecopy.CHUNK_SIZE // 2))
+        os.utime(big, ns=(1000000000, 2000000000))
+        os.chmod(os.path.join(self.src, "usr/bin"), 0o711)
+        os.utime(os.path.join(self.src, "usr/bin"), (3, 4))
+
+        copier = treecopy.TreeCopier([os.path.join(self.src, "usr")], self.dst, workers=3)
+        total = copier.scan()
+        self.assertEqual(total, 10 + 8 * 2**20 + 3 + 3 * treecopy.CHUNK_SIZE // 2)
+        progress = []
+        copier.copy(progress.append)
+        self.assertEqual(progress[-1], total)
+        self.assertEqual(progress, sorted(progress))
+
+        for path in ["usr", "usr/bin", "usr/bin/tool", "usr/bin/link", "usr/fifo", "usr/sparse", "usr/big"]:
+            a = os.lstat(os.path.join(self.src, path))
+            b = os.lstat(os.path.join(self.dst, path))
+            self.assertEqual((a.st_mode, a.st_uid, a.st_gid), (b.st_mode, b.st_uid, b.st_gid), path)
+            if not stat.S_ISLNK(a.st_mode):
+                self.assertEqual(a.st_mtime_ns, b.st_mtime_ns, path)
+            if stat.S_ISREG(a.st_mode):
+                with open(os.path.join(self.src, path), "rb") as f1, open(os.path.join(self.dst, path), "rb") as f2:
+                    self.assertEqual(f1.read(), f2.read(), path)
+
+        self.assertEqual(os.readlink(os.path.join(self.dst, "usr/bin/link")), "tool")
+        self.assertEqual(os.stat(os.path.join(self.dst, "usr/bin/alias")).st_ino,
+                         os.stat(os.path.join(self.dst, "usr/bin/tool")).st_ino)
+        self.assertLess(os.stat(os.path.join(self.dst, "usr/sparse")).st_blocks * 512, 2**20)
+
+    def test_failure(self):
+        self.write("usr/file", b"data")
+        os.mkdir(os.path.join(self.dst, "usr"))
+        self.write("../dst/usr/file", b"already here")
+        copier = treecopy.TreeCopier([os.path.join(self.src, "usr")], self.dst)
+        self.assertRaises(RuntimeError, copier.copy)
+
+    def test_xattrs(self):
+        path = self.write("usr/file", b"data")
+        try:
+            os.setxattr(path, "user.test", b"value")
+        except OSError:
+            self.skipTest("no user extended attributes here")
+        treecopy.TreeCopier([os.path.join(self.src, "usr")], self.dst).copy()
+        self.assertEqual(os.getxattr(os.path.join(self.dst, "usr/file"), "user.test"), b"value")
+
+    def test_update(self):
+        self.write("usr/same", b"same")
+        self.write("usr/changed", b"old")
+        self.write("usr/deleted", b"gone")
+        os.mkdir(os.path.join(self.src, "usr/dir"))
+        self.write("usr/dir/file", b"file")
+        first = treecopy.TreeCopier([os.path.join(self.src, "usr")], self.dst)
+        first.copy()
+        manifest = first.manifest()
+
+        self.write("usr/changed", b"new")
+        os.unlink(os.path.join(self.src, "usr/deleted"))
+        self.write("usr/added", b"added")
+        # replaced by a file
+        os.unlink(os.path.join(self.src, "usr/dir/file"))
+        os.rmdir(os.path.join(self.src, "usr/dir"))
+        self.write("usr/dir", b"dir")
+        # the copy was changed, but the source wasn't
+        with open(os.path.join(self.dst, "usr/bin/extra"), "w") as f:
+            f.write("extra")
+
+        update = treecopy.TreeCopier([os.path.join(self.src, "usr")], self.dst, manifest=manifest)
+        self.assertEqual(update.scan(), len(b"new") + len(b"added") + len(b"dir"))
+        same = os.stat(os.path.join(self.dst, "usr/same")).st_ino
+        update.copy()
+
+        self.assertEqual(os.stat(os.path.join(self.dst, "usr/same")).st_ino, same)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dst, "usr"))),
+                         ["added", "bin", "changed", "dir", "same"])
+        self.assertEqual(os.listdir(os.path.join(self.dst, "usr/bin")), [])
+        for name in ["changed", "added", "dir"]:
+            with open(os.path.join(self.dst, "usr", name), "rb") as f1, \
+                    open(os.path.join(self.src, "usr", name), "rb") as f2:
+                self.assertEqual(f1.read(), f2.read())
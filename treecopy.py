@@ -0,0 +1,271 @@
+# SPDX-License-Identifier: GPL-2.0-only
+
+"""In-process equivalent of cp -a, which copies regular files concurrently
+and reports progress in bytes."""
+
+import errno
+import os
+import shutil
+import stat
+import threading
+import concurrent.futures
+
+import constants
+from xcp import logger
+
+# amount copied between progress updates
+CHUNK_SIZE = 16 * 2**20
+
+def removePath(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+class Entry(object):
+    __slots__ = ('src', 'dst', 'st', 'link', 'current')
+
+    def __init__(self, src, dst, st):
+        self.src = src
+        self.dst = dst
+        self.st = st
+        # earlier entry for the same inode, if this is a hard link to it
+        self.link = None
+        # whether dst is already an up to date copy
+        self.current = False
+
+class TreeCopier(object):
+    """ Copies sources, each a file or directory tree, into the directory
+    destination, preserving ownership, modes, timestamps, extended
+    attributes (and so ACLs), hard links, sparseness and special files.
+
+    If manifest is given, destination holds an earlier copy, which was
+    described by manifest() at the time, and is updated rather than copied
+    again: files are only copied if they have changed since, and anything
+    no longer in the sources is removed. """
+
+    def __init__(self, sources, destination, workers=constants.MAX_COPY_WORKERS, manifest=None):
+        self.sources = sources
+        self.destination = destination
+        self.workers = workers
+        self.previous = manifest
+        self.entries = None
+        self.stale = None
+        self.total = 0
+        self.copied = 0
+        self.lock = threading.Lock()
+        self.xattrFailures = set()
+
+    def scan(self):
+        """ Walks the sources, recording what is to be copied and the total
+        number of bytes in the files to be copied, which is returned. """
+        self.entries = []
+        self.stale = []
+        self.total = 0
+        inodes = {}
+
+        def add(src, dst):
+            st = os.lstat(src)
+            entry = Entry(src, dst, st)
+            if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+                entry.link = inodes.get((st.st_dev, st.st_ino))
+                if entry.link is None:
+                    inodes[(st.st_dev, st.st_ino)] = entry
+            if self.previous is not None:
+                self.compare(entry)
+            if stat.S_ISREG(st.st_mode) and entry.link is None and not entry.current:
+                self.total += st.st_size
+            self.entries.append(entry)
+            if stat.S_ISDIR(st.st_mode):
+                names = sorted(os.listdir(src))
+                if self.previous is not None and os.path.isdir(dst) and not os.path.islink(dst):
+                    self.stale.extend(os.path.join(dst, name) for name in sorted(set(os.listdir(dst)) - set(names)))
+                for name in names:
+                    add(os.path.join(src, name), os.path.join(dst, name))
+
+        for src in self.sources:
+            add(src, os.path.join(self.destination, os.path.basename(src.rstrip('/'))))
+        return self.total
+
+    def compare(self, entry):
+        """ Works out whether the existing copy of entry is up to date, and
+        otherwise whether something in the way needs to be removed. """
+        st = entry.st
+        try:
+            dst_st = os.lstat(entry.dst)
+        except OSError:
+            return
+        same_type = stat.S_IFMT(dst_st.st_mode) == stat.S_IFMT(st.st_mode)
+        if stat.S_ISDIR(st.st_mode):
+            if not same_type:
+                self.stale.append(entry.dst)
+            return
+
+        # The source inode and its change time catch files which have been
+        # replaced or had their metadata changed; the copy's size and
+        # modification time catch copies changed since they were made.
+        record = self.previous.get(os.path.relpath(entry.dst, self.destination))
+        entry.current = entry.link is None and same_type and \
+            record == [st.st_ino, st.st_ctime_ns] and \
+            (dst_st.st_size, dst_st.st_mtime_ns) == (st.st_size, st.st_mtime_ns)
+        if not entry.current:
+            self.stale.append(entry.dst)
+
+    def manifest(self):
+        """ Returns a description of the sources, to be passed to a later
+        TreeCopier to update this copy. """
+        return dict((os.path.relpath(e.dst, self.destination), [e.st.st_ino, e.st.st_ctime_ns])
+                    for e in self.entries if not stat.S_ISDIR(e.st.st_mode))
+
+    def copy(self, progress_callback=lambda copied: None):
+        """ Performs the copy, calling progress_callback from this thread
+        with the number of bytes copied so far. """
+        if self.entries is None:
+            self.scan()
+        self.copied = 0
+
+        for path in self.stale:
+            try:
+                removePath(path)
+            except EnvironmentError as e:
+                raise RuntimeError("Failed to remove %s: %s" % (path, e))
+
+        # Directories first, so that files can be created in them; their
+        # metadata is set once they are complete so that it isn't changed.
+        dirs = [e for e in self.entries if stat.S_ISDIR(e.st.st_mode)]
+        for entry in dirs:
+            self._run(self.makeDirectory, entry)
+
+        files = [e for e in self.entries if not stat.S_ISDIR(e.st.st_mode) and e.link is None and not e.current]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = set(pool.submit(self._run, self.copyEntry, entry) for entry in files)
+            try:
+                while pending:
+                    done, pending = concurrent.futures.wait(pending, timeout=0.5,
+                                                            return_when=concurrent.futures.FIRST_EXCEPTION)
+                    for future in done:
+                        future.result()
+                    progress_callback(self.copied)
+            except:
+                for future in pending:
+                    future.cancel()
+                raise
+
+        for entry in self.entries:
+            if entry.link is not None:
+                self._run(lambda e: os.link(e.link.dst, e.dst), entry)
+        for entry in reversed(dirs):
+            self._run(self.setMetadata, entry)
+        progress_callback(self.copied)
+
+    def _run(self, fn, entry):
+        try:
+            fn(entry)
+        except EnvironmentError as e:
+            raise RuntimeError("Failed to copy %s to %s: %s" % (entry.src, entry.dst, e))
+
+    def makeDirectory(self, entry):
+        try:
+            os.mkdir(entry.dst, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST or not os.path.isdir(entry.dst):
+                raise
+
+    def copyEntry(self, entry):
+        mode = entry.st.st_mode
+        if stat.S_ISREG(mode):
+            self.copyFile(entry)
+        elif stat.S_ISLNK(mode):
+            os.symlink(os.readlink(entry.src), entry.dst)
+            self.setMetadata(entry)
+        else:
+            # device nodes, FIFOs and sockets
+            os.mknod(entry.dst, mode, entry.st.st_rdev)
+            self.setMetadata(entry)
+
+    def copyFile(self, entry):
+        size = entry.st.st_size
+        src = os.open(entry.src, os.O_RDONLY)
+        try:
+            dst = os.open(entry.dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            try:
+                offset = 0
+                for start, end in self.dataExtents(src, size):
+                    self.progress(start - offset)
+                    while start < end:
+                        n = self.copyRange(src, dst, start, min(CHUNK_SIZE, end - start))
+                        if n == 0:
+                            # the file shrank while we were copying it
+                            end = start
+                            break
+                        start += n
+                        self.progress(n)
+                    offset = end
+                self.progress(size - offset)
+                os.ftruncate(dst, size)
+                self.setMetadata(entry, dst)
+            finally:
+                os.close(dst)
+        finally:
+            os.close(src)
+
+    @staticmethod
+    def dataExtents(fd, size):
+        """ Yields the (start, end) ranges of fd which contain data, skipping
+        holes where the filesystem can report them. """
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+                if start >= size:
+                    return
+                end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # only a hole remains
+                    return
+                if e.errno != errno.EINVAL:
+                    raise
+                start, end = offset, size
+            yield start, end
+            offset = end
+
+    @staticmethod
+    def copyRange(src, dst, offset, count):
+        try:
+            return os.copy_file_range(src, dst, count, offset, offset)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+        os.lseek(dst, offset, os.SEEK_SET)
+        return os.sendfile(dst, src, offset, count)
+
+    def progress(self, n):
+        with self.lock:
+            self.copied += n
+
+    def setMetadata(self, entry, fd=None):
+        st = entry.st
+        path = fd if fd is not None else entry.dst
+        follow = not stat.S_ISLNK(st.st_mode)
+
+        os.chown(path, st.st_uid, st.st_gid, follow_symlinks=follow)
+        if follow:
+            # after chown, which clears setuid and setgid bits
+            os.chmod(path, stat.S_IMODE(st.st_mode))
+
+        # Like cp -a, don't fail if extended attributes can't be preserved
+        try:
+            names = os.listxattr(entry.src, follow_symlinks=False)
+        except OSError:
+            names = []
+        for name in names:
+            try:
+                os.setxattr(path, name, os.getxattr(entry.src, name, follow_symlinks=False),
+                            follow_symlinks=follow)
+            except OSError as e:
+                if name not in self.xattrFailures:
+                    self.xattrFailures.add(name)
+                    logger.log("Failed to copy extended attribute %s of %s: %s" % (name, entry.src, e))
+
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=follow)
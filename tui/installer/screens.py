@@ -2,7 +2,6 @@
 
 import datetime
 import os.path
-import time
 import functools
 
 import generalui
@@ -97,8 +96,7 @@ Please make sure you have backed up any data you wish to preserve before proceed
         return EXIT
 
     logger.log("Waiting for partitions to appear...")
-    util.runCmd2(util.udevsettleCmd())
-    time.sleep(1)
+    diskutil.waitForBlockDevices(settle=True)
     diskutil.mpath_part_scan()
 
     # ensure partitions/disks are not locked by LVM
@@ -738,7 +736,10 @@ def disk_more_info(context):
     return True
 
 def sorted_disk_list(): # Smallest to largest, then alphabetical
-    return sorted(diskutil.getQualifiedDiskList(), key=lambda disk: (len(disk), disk))
+    disks = sorted(diskutil.getQualifiedDiskList(), key=lambda disk: (len(disk), disk))
+    # so that the details dialog doesn't wait for slow disks
+    diskutil.prefetchDiskSerialNumbers(disks)
+    return disks
 
 def confirm_disk_erase(disk):
     sr_overwrite_msg = """The selected disk, {}, contains a storage repository. The storage repository may currently be used by other hosts.
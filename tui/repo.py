@@ -275,7 +275,7 @@ def confirm_load_repo(answers, label, installed_repos):
 
             rc2 = ButtonChoiceWindow(
                 tui.screen, "Repository Information", text2, ['Ok', 'Back'], width=60)
-            if rc2 == 'ok' and interactive_source_verification(selected_repos, label):
+            if rc2 == 'ok' and interactive_source_verification(selected_repos, label, answers):
                 default_button = USE
 
     tui.screen.popWindow()
@@ -300,7 +300,7 @@ def verify_source(answers, label, require_base_repo):
         text = "Would you like to test your media?"
         default = selectDefault(VERIFY, entries)
     else:
-        text = "Would you like to test your %s repository?  This may cause significant network traffic." % label
+        text = "Would you like to verify your %s repository?  Packages will be checked as they are downloaded for installation." % label
         default = selectDefault(SKIP, entries)
 
     while not done:
@@ -322,8 +322,13 @@ def verify_source(answers, label, require_base_repo):
                         tui.screen, "Error",
                         """A base installation repository was not found.  Please check the address was valid and/or that the media was inserted correctly, and try again.""",
                         ['Ok'])
+                elif all(r.canStage() for r in repos):
+                    # remote packages are verified as they are staged for
+                    # installation, so avoid downloading them twice
+                    done = deferred_source_verification(repos, label)
+                    answers['deferred-verification'] = True
                 else:
-                    done = interactive_source_verification(repos, label)
+                    done = interactive_source_verification(repos, label, answers)
             except Exception as e:
                 logger.logException(e)
                 ButtonChoiceWindow(
@@ -331,12 +336,32 @@ def verify_source(answers, label, require_base_repo):
                     """Unable to access location specified.  Please check the address was valid and/or that the media was inserted correctly, and try again.""",
                     ['Ok'])
         else:
+            if require_base_repo:
+                answers.pop('deferred-verification', None)
             done = True
 
     return RIGHT_FORWARDS
 
-def interactive_source_verification(repos, label):
+def deferred_source_verification(repos, label):
+    repo_names = generalui.makeHumanList( ['"%s"' %x.name() for x in repos])
+    ButtonChoiceWindow(
+        tui.screen,
+        "Verification Deferred",
+        "The packages in your %s(s) %s will be verified as they are downloaded during installation, which is after the target disk has been partitioned and formatted.  The installation will stop if any are found to be damaged, and will need to be started again." % (label, repo_names),
+        ['Ok']
+        )
+    return True
+
+def interactive_source_verification(repos, label, answers):
     cap_label = ' '.join([a.capitalize() for a in label.split()])
+
+    # packages which were verified by an earlier installation to the same
+    # disk needn't be checked again
+    if 'installation-to-overwrite' in answers:
+        repository.verification_cache.loadFromDisk(answers['installation-to-overwrite'].primary_disk)
+    elif 'primary-disk' in answers:
+        repository.verification_cache.loadFromDisk(answers['primary-disk'])
+
     errors = []
     pd = tui.progress.initProgressDialog(
         "Verifying %s Source" % cap_label, "Initializing...",
@@ -3,6 +3,7 @@
 import os
 import re
 import shutil
+import json
 
 import diskutil
 import product
@@ -11,6 +12,8 @@ from xcp import logger
 from disktools import *
 from netinterface import *
 import util
+import treecopy
+import extimage
 import constants
 import version
 import netutil
@@ -334,6 +337,7 @@ class ThirdGenUpgrader(Upgrader):
                         util.mkfs('ext3', '/dev/' + self.vgs_output + '/' + sr_uuid, ['-F'])
                     except Exception as e:
                         raise RuntimeError("Backup: Failed to format filesystem on %s: %s" % (storage_part, e))
+                LVMTool.invalidateSnapshot()
         else:
             # If the boot partition already, exists, no partition updates are
             # necessary.
@@ -355,7 +359,8 @@ class ThirdGenUpgrader(Upgrader):
         self.testUpgradeForbidden(tool)
 
         # Check if possible to create new partition layout, increasing the size, using plugin result
-        if self.safe2upgrade and logs_partition is None: 
+        repartitioned = self.safe2upgrade and logs_partition is None
+        if repartitioned:
             if storage_partnum > 0:
                 # Get current Volume Group
                 rc, out = util.runCmd2(['pvs', '-o', 'pv_name,vg_name', '--noheadings'], with_stdout=True)
@@ -371,6 +376,7 @@ class ThirdGenUpgrader(Upgrader):
                     # Remove LVM Phisical Volume
                     storage_part = partitionDevice(target_disk, storage_partnum)
                     util.runCmd2(['pvremove', storage_part])
+                    LVMTool.invalidateSnapshot()
                 # Delete LVM partition
                 tool.deletePartition(storage_partnum)
             # Resize backup partition
@@ -378,15 +384,43 @@ class ThirdGenUpgrader(Upgrader):
             # Write partition table
             tool.commit(log=True)
 
-        # format the backup partition:
+        # format the backup partition, unless it holds an earlier backup
+        # of this installation which can be brought up to date:
         backupfs_type = diskutil.fs_type_from_device(self.source.root_device)
         backup_partition = partitionDevice(target_disk, backup_partnum)
-        try:
-            util.mkfs(backupfs_type, backup_partition)
-        except Exception as e:
-            raise RuntimeError("Backup: Failed to format filesystem on %s: %s" % (backup_partition, e))
+        manifest = None
+        image = None
+        if not repartitioned:
+            manifest = self.readBackupManifest(backup_partition, backupfs_type)
+        if manifest is None:
+            # copying the blocks in use is quicker than copying the files
+            image = extimage.readExtFilesystem(self.source.root_device)
+            if image is not None and extimage.deviceSize(backup_partition) < image.size:
+                logger.log("Not backing up as an image: %s is too small" % backup_partition)
+                image = None
+        if image is not None:
+            if util.runCmd2(['wipefs', '-a', backup_partition]) != 0:
+                raise RuntimeError("Backup: Failed to wipe %s" % backup_partition)
+        elif manifest is None:
+            try:
+                util.mkfs(backupfs_type, backup_partition)
+            except Exception as e:
+                raise RuntimeError("Backup: Failed to format filesystem on %s: %s" % (backup_partition, e))
+        else:
+            logger.log("Updating the existing backup on %s" % backup_partition)
         progress_callback(10)
 
+        if image is not None:
+            extimage.copyFilesystem(image, backup_partition,
+                                    lambda copied, total: progress_callback(10 + 80 * copied // max(total, 1)))
+            # so that the copy isn't mistaken for the root filesystem, give
+            # it an identity of its own; tune2fs requires a freshly checked
+            # filesystem to change the UUID
+            if util.runCmd2(['e2fsck', '-f', '-p', backup_partition]) not in (0, 1):
+                raise RuntimeError("Backup: Copy of the root filesystem on %s is damaged" % backup_partition)
+            if util.runCmd2(['tune2fs', '-L', '', '-U', 'random', backup_partition]) != 0:
+                raise RuntimeError("Backup: Failed to relabel %s" % backup_partition)
+
         # copy the files across:
         primary_fs = util.TempMount(self.source.root_device, 'primary-', options=['ro'], boot_device=boot_device)
         try:
@@ -394,25 +428,55 @@ class ThirdGenUpgrader(Upgrader):
             try:
                 just_dirs = ['dev', 'proc', 'lost+found', 'sys']
                 top_dirs = os.listdir(primary_fs.mount_point)
-                val = 10
+                manifest_path = os.path.join(backup_fs.mount_point, '.xen-backup-manifest')
+                if manifest is not None:
+                    # until it is complete, the backup can't be updated again
+                    os.unlink(manifest_path)
+                    keep = top_dirs + ['lost+found', '.xen-backup-partition']
+                    for x in os.listdir(backup_fs.mount_point):
+                        if x not in keep:
+                            treecopy.removePath(os.path.join(backup_fs.mount_point, x))
                 for x in top_dirs:
                     if x in just_dirs:
                         path = os.path.join(backup_fs.mount_point, x)
                         if not os.path.exists(path):
                             os.mkdir(path, 0o755)
-                    else:
-                        cmd = ['cp', '-a'] + \
-                              [ os.path.join(primary_fs.mount_point, x) ] + \
-                              ['%s/' % backup_fs.mount_point]
-                        if util.runCmd2(cmd) != 0:
-                            raise RuntimeError("Backup of %s directory failed" % x)
-                    val += 90 / len(top_dirs)
-                    progress_callback(val)
+
+                sources = [os.path.join(primary_fs.mount_point, x) for x in top_dirs if x not in just_dirs]
+                if image is None:
+                    copier = treecopy.TreeCopier(sources, backup_fs.mount_point, manifest=manifest)
+                    start, scale = 10, 90
+                else:
+                    # the image doesn't include the boot partition mounted within it
+                    boot_sources = []
+                    destination = backup_fs.mount_point
+                    if primary_fs.boot_mounted:
+                        destination += primary_fs.boot_mount_point[len(primary_fs.mount_point):]
+                        util.assertDir(destination)
+                        for x in os.listdir(destination):
+                            treecopy.removePath(os.path.join(destination, x))
+                        boot_sources = [os.path.join(primary_fs.boot_mount_point, x)
+                                        for x in os.listdir(primary_fs.boot_mount_point)]
+                    copier = treecopy.TreeCopier(boot_sources, destination)
+                    start, scale = 90, 10
+                total = copier.scan()
+                logger.log("Backing up %d bytes" % total)
+                copier.copy(lambda copied: progress_callback(start + scale * copied // max(total, 1)))
 
                 # save the GPT table
                 rc, err = util.runCmd2(["sgdisk", "-b", os.path.join(backup_fs.mount_point, '.xen-gpt.bin'), target_disk], with_stderr=True)
                 if rc != 0:
                     raise RuntimeError("Failed to save partition layout: %s" % err)
+
+                if image is not None:
+                    # The image keeps the inode numbers and timestamps of
+                    # the files, so the backup can be described as though
+                    # they had been copied one by one, and updated next time.
+                    copier = treecopy.TreeCopier(sources, backup_fs.mount_point)
+                    copier.scan()
+                with open(manifest_path, 'w') as fh:
+                    json.dump({'installation-uuid': self.source.getInventoryValue("INSTALLATION_UUID"),
+                               'files': copier.manifest()}, fh)
             finally:
                 # replace rolling pool upgrade bootloader config
                 def replace_config(config_file, destination):
@@ -433,6 +497,34 @@ class ThirdGenUpgrader(Upgrader):
         finally:
             primary_fs.unmount()
 
+    def readBackupManifest(self, backup_partition, backupfs_type):
+        """ Returns the manifest of the files in the backup of this
+        installation on backup_partition, or None if there isn't one which
+        can be updated. """
+        try:
+            if diskutil.fs_type_from_device(backup_partition) != backupfs_type:
+                return None
+            if util.runCmd2(['fsck', '-p', backup_partition]) not in (0, 1):
+                logger.log("Not updating the backup on %s: it is damaged" % backup_partition)
+                return None
+            backup_fs = util.TempMount(backup_partition, 'backup-', ['ro'])
+            try:
+                manifest_path = os.path.join(backup_fs.mount_point, '.xen-backup-manifest')
+                if not os.path.exists(os.path.join(backup_fs.mount_point, '.xen-backup-partition')) or \
+                        not os.path.exists(manifest_path):
+                    return None
+                with open(manifest_path) as fh:
+                    manifest = json.load(fh)
+            finally:
+                backup_fs.unmount()
+            if manifest['installation-uuid'] != self.source.getInventoryValue("INSTALLATION_UUID"):
+                logger.log("Not updating the backup on %s: it is of another installation" % backup_partition)
+                return None
+            return manifest['files']
+        except Exception as e:
+            logger.log("Not updating the backup on %s: %s" % (backup_partition, e))
+            return None
+
     prepUpgradeArgs = []
     prepStateChanges = ['installation-uuid', 'control-domain-uuid']
     def prepareUpgrade(self, progress_callback):
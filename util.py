@@ -3,7 +3,9 @@
 import os
 import os.path
 import subprocess
-import urllib.request, urllib.parse
+import urllib.request, urllib.parse, urllib.error
+import http.client
+import base64
 import shutil
 import re
 import datetime
@@ -12,6 +14,12 @@ import random
 import string
 import tempfile
 import errno
+import resource
+import threading
+import ctypes
+import ctypes.util
+import select
+import stat
 import constants
 from version import *
 from xcp import logger
@@ -52,12 +60,49 @@ def copyFilesFromDir(sourcedir, dest):
 ###
 # shell
 
-def runCmd2(command, with_stdout=False, with_stderr=False, inputtext=None):
+_commands_run = threading.local()
+_commands_total = 0
+_commands_lock = threading.Lock()
+
+class ResourceSample:
+    """ A snapshot of the resources used so far.  CPU time and block I/O
+    cover the whole installer process including the children it has reaped.
+    The count of commands run by runCmd2 is for the calling thread only,
+    unless whole_process is set. """
+
+    def __init__(self, whole_process=False):
+        self.time = time.time()
+        self.clock = time.monotonic()
+        usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+        self.cpu = sum(u.ru_utime + u.ru_stime for u in usage)
+        # counted in 512 byte blocks
+        self.read_bytes = sum(u.ru_inblock for u in usage) * 512
+        self.write_bytes = sum(u.ru_oublock for u in usage) * 512
+        if whole_process:
+            self.commands = _commands_total
+        else:
+            self.commands = getattr(_commands_run, 'count', 0)
+
+    def since(self, earlier):
+        """ Returns the resources used between earlier and this sample. """
+        return {'wall': round(self.clock - earlier.clock, 3),
+                'cpu': round(self.cpu - earlier.cpu, 3),
+                'subprocesses': self.commands - earlier.commands,
+                'read_bytes': self.read_bytes - earlier.read_bytes,
+                'write_bytes': self.write_bytes - earlier.write_bytes}
+
+def runCmd2(command, with_stdout=False, with_stderr=False, inputtext=None, timeout=None):
     """
     Run a command with subprocess.Popen
     Expects string output from stdout & stderr
+    If timeout seconds pass, the command is killed and
+    subprocess.TimeoutExpired raised
     """
 
+    global _commands_total
+    _commands_run.count = getattr(_commands_run, 'count', 0) + 1
+    with _commands_lock:
+        _commands_total += 1
     try:
         cmd = subprocess.Popen(command, bufsize=1,
                                stdin=(inputtext and subprocess.PIPE or None),
@@ -69,7 +114,12 @@ def runCmd2(command, with_stdout=False, with_stderr=False, inputtext=None):
 
         # We could poll stdout/stderr for commands outputing large amounts
         # of data, but the following should suffice in all cases
-        (out, err) = cmd.communicate(inputtext)
+        try:
+            (out, err) = cmd.communicate(inputtext, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            cmd.kill()
+            cmd.communicate()
+            raise
         rv = cmd.returncode
     except Exception as ex:
         logger.log("running %s caused an exception: %s" % (command, ex))
@@ -228,6 +278,133 @@ class InvalidSource(Exception):
 #  ftp://blah
 #  file://blah
 #  nfs://server:/path/blah
+class HTTPConnectionPool(object):
+    """ Keeps persistent HTTP/1.1 connections to each server, so that fetching
+    many files from a repository does not pay for a new TCP (and for https, a
+    new TLS) handshake per file.  A connection is returned to the pool once
+    the response using it has been read to the end. """
+
+    MAX_REDIRECTS = 5
+
+    def __init__(self):
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _newConnection(scheme, netloc):
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc)
+        return http.client.HTTPConnection(netloc)
+
+    def _connect(self, scheme, netloc):
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+        return self._newConnection(scheme, netloc), False
+
+    def _release(self, key, conn):
+        with self._lock:
+            self._idle.setdefault(key, []).append(conn)
+
+    def request(self, url, username=None, password=None, method='GET', headers=None):
+        """ Returns a file-like response for url, which must not contain a
+        username or password.  These are passed separately and are only sent
+        to the server named in url.  Redirects are followed and error
+        responses raise urllib.error.HTTPError, as with urlopen. """
+        auth_netloc = urllib.parse.urlsplit(url).netloc
+        for _ in range(self.MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+            request_headers = dict(headers or {})
+            if username is not None and parts.netloc == auth_netloc:
+                credentials = '%s:%s' % (username, password or '')
+                request_headers['Authorization'] = 'Basic ' + base64.b64encode(credentials.encode()).decode()
+
+            key = (parts.scheme, parts.netloc)
+            conn, reused = self._connect(*key)
+            try:
+                conn.request(method, path, headers=request_headers)
+                response = conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if not reused:
+                    raise
+                # The server closed the idle connection; retry on a new one.
+                conn = self._newConnection(*key)
+                conn.request(method, path, headers=request_headers)
+                response = conn.getresponse()
+
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+                response.read()
+                self._finish(key, conn, response)
+                url = urllib.parse.urljoin(url, response.getheader('Location'))
+                if response.status == 303:
+                    method = 'GET'
+                continue
+            if response.status >= 400:
+                response.read()
+                self._finish(key, conn, response)
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.msg, None)
+            return PooledResponse(self, key, conn, response, method == 'HEAD')
+        raise urllib.error.URLError("Too many redirects fetching %s" % url)
+
+    def _finish(self, key, conn, response):
+        if response.isclosed() and not response.will_close:
+            self._release(key, conn)
+        else:
+            conn.close()
+
+class PooledResponse(object):
+    """ A response from HTTPConnectionPool.request. """
+
+    def __init__(self, pool, key, conn, response, head=False):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.status = response.status
+        if head:
+            response.read()
+            self._done()
+
+    def _done(self):
+        if self._conn:
+            self._pool._finish(self._key, self._conn, self._response)
+            self._conn = None
+
+    def read(self, *params):
+        data = self._response.read(*params)
+        if self._response.isclosed():
+            self._done()
+        return data
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def close(self):
+        if self._conn:
+            if not self._response.isclosed():
+                # Part of the body is unread so the connection can't be reused.
+                self._response.close()
+                self._conn.close()
+                self._conn = None
+            self._done()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+_http_pool = HTTPConnectionPool()
+
+def httpRequest(url, method='GET', headers=None):
+    """ Make an HTTP(S) request for a util.URL using the shared connection
+    pool, with basic authentication if the URL has a username. """
+    return _http_pool.request(url.getPlainURL(), url.getUsername(), url.getPassword(),
+                              method=method, headers=headers)
+
 def fetchFile(source, dest):
     cleanup_dirs = []
 
@@ -257,17 +434,13 @@ def fetchFile(source, dest):
                source[:5] == 'file:' or \
                source[:4] == 'ftp:':
             # This something that can be fetched using urllib
-            request = source
-
             url = URL(source)
-            if url.getScheme() in ['http', 'https'] and url.getUsername(): # Auth HTTP(s)
-                passman = urllib2.HTTPPasswordMgrWithDefaultRealm()
-                passman.add_password(None, url.getBaseURL(), url.getUsername(), url.getPassword())
-                handler = urllib2.HTTPBasicAuthHandler(passman)
-                urllib2.install_opener(urllib2.build_opener(handler))
-                request = url.getPlainURL()
-
-            with urllib.request.urlopen(request) as fd_resp, open(dest, 'wb') as fd_dest:
+            if url.getScheme() in ['http', 'https']:
+                response = httpRequest(url)
+            else:
+                response = urllib.request.urlopen(source)
+
+            with response as fd_resp, open(dest, 'wb') as fd_dest:
                 shutil.copyfileobj(fd_resp, fd_dest)
         else:
             raise InvalidSource("Unknown source type.")
@@ -356,6 +529,151 @@ def udevtriggerCmd():
 def udevinfoCmd():
     return udevadmCmd('info')
 
+UDEV_DATA_DIR = '/run/udev/data'
+
+class _Inotify(object):
+    """ Minimal inotify wrapper, used to wake up when directories change. """
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    _libc = None
+
+    def __init__(self):
+        if _Inotify._libc is None:
+            _Inotify._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watched = set()
+
+    def watch(self, path):
+        if path not in self.watched:
+            mask = self.IN_CREATE | self.IN_MOVED_TO | self.IN_ATTRIB | self.IN_CLOSE_WRITE
+            if self._libc.inotify_add_watch(self.fd, path.encode(), mask) >= 0:
+                self.watched.add(path)
+
+    def wait(self, timeout):
+        """ Waits up to timeout seconds for an event, discarding the events. """
+        if select.select([self.fd], [], [], timeout)[0]:
+            try:
+                while os.read(self.fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        os.close(self.fd)
+
+def readUdevProperties(devnum):
+    """ Returns the properties udev recorded for the block device devnum,
+    or an empty dictionary. """
+    properties = {}
+    try:
+        with open(os.path.join(UDEV_DATA_DIR, 'b%d:%d' % (os.major(devnum), os.minor(devnum)))) as fh:
+            for line in fh:
+                if line.startswith('E:') and '=' in line:
+                    key, value = line[2:].rstrip('\n').split('=', 1)
+                    properties[key] = value
+    except EnvironmentError:
+        pass
+    return properties
+
+def deviceReady(path, since=None):
+    """ Returns whether path, a device node or a udev link to one, exists
+    and udev has finished processing the device (since time since, if
+    given). """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    if not stat.S_ISBLK(st.st_mode):
+        return False
+    if not os.path.isdir(UDEV_DATA_DIR):
+        return True
+    try:
+        db = os.stat(os.path.join(UDEV_DATA_DIR, 'b%d:%d' % (os.major(st.st_rdev), os.minor(st.st_rdev))))
+    except OSError:
+        return False
+    return since is None or db.st_mtime >= since
+
+def _udevUnwatched(path, since=None):
+    """ Returns whether path is a device for which udev may not record
+    anything, or (if since is given) may not send events, so that
+    waiting for it is pointless: md devices, and devices which udev
+    hadn't recorded by time since. """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    if not stat.S_ISBLK(st.st_mode):
+        return False
+    if os.path.isdir('/sys/dev/block/%d:%d/md' % (os.major(st.st_rdev), os.minor(st.st_rdev))):
+        return True
+    return since is not None and os.path.isdir(UDEV_DATA_DIR) and \
+        not os.path.exists(os.path.join(UDEV_DATA_DIR, 'b%d:%d' % (os.major(st.st_rdev), os.minor(st.st_rdev))))
+
+def waitUntilStable(fn, quiet, timeout):
+    """ Calls fn until its result hasn't changed for quiet seconds, or
+    timeout seconds have passed, and returns the last result. """
+    deadline = time.monotonic() + timeout
+    result = fn()
+    changed = time.monotonic()
+    while True:
+        now = time.monotonic()
+        if now - changed >= quiet or now >= deadline:
+            return result
+        time.sleep(min(0.1, deadline - now))
+        current = fn()
+        if current != result:
+            result = current
+            changed = time.monotonic()
+
+def waitForDevices(paths, timeout=30, since=None):
+    """ Waits until all of paths, which may be device nodes or udev links
+    such as /dev/disk/by-label/..., are ready, or timeout seconds have
+    passed.  If since is given, udev must also have processed an event for
+    each device since then.  Returns the list of paths which were not
+    ready; unlike 'udevadm settle' this is not held up by unrelated udev
+    events.  Devices udev doesn't record are returned straight away, for
+    the caller to fall back to 'udevadm settle'. """
+    deadline = time.monotonic() + timeout
+    unwatched = set(p for p in paths if _udevUnwatched(p, since))
+    try:
+        inotify = _Inotify()
+    except Exception as e:
+        logger.log("inotify unavailable, polling for devices: %s" % str(e))
+        inotify = None
+
+    try:
+        while True:
+            missing = [p for p in paths if not deviceReady(p, since)]
+            remaining = deadline - time.monotonic()
+            if not missing or remaining <= 0 or unwatched.issuperset(missing):
+                break
+            if inotify:
+                # watch the nearest existing directory of each path, and
+                # recheck periodically as directories may be created later
+                for d in set([UDEV_DATA_DIR] + [os.path.dirname(p) for p in missing]):
+                    while d != '/' and not os.path.isdir(d):
+                        d = os.path.dirname(d)
+                    inotify.watch(d)
+                inotify.wait(min(remaining, 1))
+            else:
+                time.sleep(min(remaining, 0.1))
+    finally:
+        if inotify:
+            inotify.close()
+
+    if missing and unwatched.issuperset(missing):
+        logger.log("Not waiting for devices udev doesn't record: %s" % ', '.join(missing))
+    elif missing:
+        logger.log("Timed out waiting for devices: %s" % ', '.join(missing))
+    return missing
+
 def randomLabelStr():
     return "".join([random.choice(string.ascii_lowercase) for x in range(6)])
 
@@ -36,9 +36,12 @@ def collectLogs(dst, tarball_dir=None):
     if dst != '/tmp':
         if os.path.exists("/tmp/install-log"):
             shutil.copy("/tmp/install-log", dst)
+        if os.path.exists(constants.TIMELINE_FILE):
+            shutil.copy(constants.TIMELINE_FILE, dst)
         if os.path.exists(constants.SCRIPTS_DIR):
             os.system("cp -r "+constants.SCRIPTS_DIR+" %s/" % dst)
     logs = [x for x in os.listdir(dst) if x.endswith('-log') or x == 'answerfile' or
+                  x == os.path.basename(constants.TIMELINE_FILE) or
                   x.startswith(os.path.basename(constants.SCRIPTS_DIR))]
     logs = " ".join(logs)
 